@@ -1,55 +1,934 @@
+import json
+import multiprocessing
+import os
 import sqlite3
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from pathlib import Path
+import time
 import warnings
+from schema import (APPOINTMENT_STATUSES, PAYMENT_STATUSES, PAYMENT_METHODS, encode, decode_sql, days_ago,
+                    months_ago, to_day_number, from_day_number, check_kpi_counters)
+from olap_cube import COUNT_MEASURES, load_cube, load_month_from, load_sample_cube
+from partitions import (attach_limit, attach_partitions, kpi_counter_values, overlapping_partitions,
+                        partition_batches, reads_partitioned_tables)
+from sketches import CONFIDENCE_Z, HyperLogLog, TDigest, margin_of_error, register_sketch_functions
 warnings.filterwarnings('ignore')
 
+# Dictionary codes used in WHERE clauses instead of the decoded text columns
+COMPLETED = APPOINTMENT_STATUSES['Completed']
+PAID = PAYMENT_STATUSES['Paid']
+
+# Patient value segments by total paid spend
+HIGH_VALUE_THRESHOLD = 50000
+MEDIUM_VALUE_THRESHOLD = 20000
+
+# Trailing windows in days of the moving averages added to daily trends
+ROLLING_WINDOWS = (7, 30)
+
+# Percentiles reported for bill amounts and payment lags, as p50, p90 and p99 columns
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Declared dtypes for each method's result: 'category' for repeated names,
+# 'integer' for counts downcast to int32 where they fit, and 'float32'
+# for values only used to scale markers. Revenue stays float64.
+RESULT_SCHEMAS = {
+    'get_revenue_trend': {},
+    'get_service_utilization': {'service_name': 'category', 'count': 'integer'},
+    'analyze_service_utilization': {
+        'service_name': 'category', 'service_type': 'category', 'department_name': 'category',
+        'appointment_count': 'integer'
+    },
+    'get_revenue_by_service': {'service_name': 'category', 'appointment_count': 'integer'},
+    'get_service_trends': {'service_name': 'category', 'appointments': 'integer'},
+    'get_department_service_distribution': {
+        'department_name': 'category', 'service_name': 'category', 'count': 'integer'
+    },
+    'analyze_doctor_performance': {
+        'doctor_name': 'category', 'specialization': 'category', 'department_name': 'category',
+        'appointments_handled': 'integer'
+    },
+    'get_doctor_performance_metrics': {
+        'doctor_name': 'category', 'specialization': 'category', 'appointments_handled': 'integer',
+        'patient_satisfaction': 'float32'
+    },
+    'get_doctor_revenue_trends': {'doctor_name': 'category'},
+    'get_department_doctor_performance': {'department_name': 'category', 'doctor_count': 'integer'},
+    'get_daily_appointment_trends': {'appointments': 'integer'},
+    'get_rolling_daily_trends': {'appointments': 'integer'},
+    'get_weekly_appointment_patterns': {'day_of_week': 'category', 'appointments': 'integer'},
+    'get_monthly_appointment_trends': {'appointments': 'integer'},
+    'get_seasonal_appointment_analysis': {'season': 'category', 'appointments': 'integer'},
+    'get_patient_visit_frequency': {'visit_count': 'integer', 'patient_count': 'integer'},
+    'get_patient_spending_patterns': {
+        'patient_id': 'integer', 'patient_name': 'category', 'total_visits': 'integer',
+        'avg_spend_per_visit': 'float32'
+    },
+    'get_patient_segments': {'segment': 'category', 'count': 'integer'},
+    'get_service_preferences': {'service_name': 'category', 'preference_score': 'integer'},
+    'get_monthly_revenue_trends': {'unique_patients': 'integer', 'appointments': 'integer'},
+    'get_monthly_growth': {'appointments': 'integer'},
+    'get_unique_patient_trends': {'unique_patients': 'integer'},
+    'get_revenue_by_department': {'department_name': 'category', 'appointment_count': 'integer'},
+    'get_revenue_by_service_type': {'service_type': 'category', 'appointment_count': 'integer'},
+    'get_revenue_per_doctor': {
+        'doctor_name': 'category', 'specialization': 'category', 'appointment_count': 'integer'
+    },
+    'get_revenue_by_payment_method': {'payment_method': 'category', 'appointment_count': 'integer'},
+    'get_bill_amount_percentiles': {'service_name': 'category', 'bills': 'integer'},
+    'get_payment_lag_percentiles': {'payment_method': 'category', 'payments': 'integer'}
+}
+
+# Cross-filters accepted by the page methods, as conditions on appointments `a`.
+# Each narrows appointments through an indexed key (schema version 5), and the
+# same dimensions are diced in memory when the method is served from the cube
+FILTER_CONDITIONS = {
+    'department': """a.service_id IN (
+            SELECT s.service_id FROM services s
+            JOIN departments d ON s.department_id = d.department_id
+            WHERE d.name IN ({}))""",
+    'doctor': "a.doctor_id IN (SELECT doctor_id FROM doctors WHERE name IN ({}))",
+    'service_type': "a.service_id IN (SELECT service_id FROM services WHERE type IN ({}))",
+    'payment_method': "a.appointment_id IN (SELECT appointment_id FROM billing WHERE payment_method_code IN ({}))"
+}
+
+# Cross-filters that only narrow services, so they also apply to the patient
+# sketches, bill amount digests and service summaries (kept per service) when
+# their table is aliased `a`
+SKETCH_FILTERS = {'department', 'service_type'}
+
+# Cross-filters that apply to the doctor heavy-hitters summaries (kept per doctor)
+DOCTOR_SUMMARY_FILTERS = {'doctor'}
+
+# Periods unique patients are counted over, as calendar expressions whose
+# labels sort chronologically
+UNIQUE_PATIENT_PERIODS = {
+    'month': "c.month_label",
+    'quarter': "c.year || '-Q' || ((c.month + 2) / 3)",
+    'year': "CAST(c.year AS TEXT)"
+}
+
+# Cube-backed versions of the additive group-bys: dimensions to roll up to
+# (with output names), extra dimension attributes, measures (with output
+# names), filters, an optional trailing window in months on a month
+# dimension, sort keys (ascending?) and a row limit. Windows start on the same
+# day as the SQL versions' date('now', '-N months'); the cube is kept at month
+# grain, so their first month is re-aggregated from that day on.
+COMPLETED_AND_PAID = {'status': 'Completed', 'payment_status': 'Paid'}
+CUBE_QUERIES = {
+    'get_revenue_trend': {
+        'by': {'payment_month': 'month'}, 'measures': {'revenue': 'revenue'},
+        'where': COMPLETED_AND_PAID, 'window': ('payment_month', 12), 'order_by': [('month', True)]
+    },
+    'get_service_utilization': {
+        'by': {'service': 'service_name'}, 'measures': {'appointments': 'count'},
+        'where': {'status': 'Completed'}, 'order_by': [('count', False)], 'limit': 10
+    },
+    'get_revenue_by_service': {
+        'by': {'service': 'service_name'},
+        'measures': {'revenue': 'total_revenue', 'appointments': 'appointment_count'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('total_revenue', False)]
+    },
+    'get_service_trends': {
+        'by': {'month': 'month', 'service': 'service_name'}, 'measures': {'appointments': 'appointments'},
+        'where': {'status': 'Completed'}, 'window': ('month', 12),
+        'order_by': [('month', True), ('appointments', False)]
+    },
+    'get_department_service_distribution': {
+        'by': {'department': 'department_name', 'service': 'service_name'},
+        'measures': {'appointments': 'count'},
+        'where': {'status': 'Completed'}, 'order_by': [('count', False)]
+    },
+    'analyze_doctor_performance': {
+        'by': {'doctor': 'doctor_name'}, 'attributes': {'doctor': ['specialization', 'department_name']},
+        'measures': {'appointments': 'appointments_handled', 'revenue': 'total_revenue',
+                     'avg_amount': 'avg_revenue_per_appointment'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('total_revenue', False)], 'limit': 10
+    },
+    'get_doctor_revenue_trends': {
+        'by': {'month': 'month', 'doctor': 'doctor_name'}, 'measures': {'revenue': 'revenue'},
+        'where': COMPLETED_AND_PAID, 'window': ('month', 12),
+        'order_by': [('month', True), ('revenue', False)]
+    },
+    'get_service_preferences': {
+        'by': {'service': 'service_name'}, 'measures': {'appointments': 'preference_score'},
+        'where': {'status': 'Completed'}, 'order_by': [('preference_score', False)], 'limit': 15
+    },
+    'get_revenue_by_department': {
+        'by': {'department': 'department_name'},
+        'measures': {'revenue': 'total_revenue', 'appointments': 'appointment_count',
+                     'avg_amount': 'avg_revenue_per_appointment'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('total_revenue', False)]
+    },
+    'get_revenue_by_service_type': {
+        'by': {'service_type': 'service_type'},
+        'measures': {'revenue': 'revenue', 'appointments': 'appointment_count'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('revenue', False)]
+    },
+    'get_revenue_per_doctor': {
+        'by': {'doctor': 'doctor_name'}, 'attributes': {'doctor': ['specialization']},
+        'measures': {'revenue': 'total_revenue', 'appointments': 'appointment_count',
+                     'avg_amount': 'avg_revenue_per_appointment'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('total_revenue', False)]
+    },
+    'get_revenue_by_payment_method': {
+        'by': {'payment_method': 'payment_method'},
+        'measures': {'revenue': 'revenue', 'appointments': 'appointment_count'},
+        'where': COMPLETED_AND_PAID, 'order_by': [('revenue', False)]
+    }
+}
+
+# Listings served a page at a time: the FROM clause, the output columns with
+# their SQL expressions, the unique key that breaks sort ties, and the columns
+# that may be sorted on, filtered on or searched by prefix. The patient sort
+# columns are indexed (schema version 4) so pages are found by an index seek
+TABLE_LISTINGS = {
+    'patients': {
+        'from': 'patients p',
+        'columns': {
+            'patient_id': 'p.patient_id', 'name': 'p.name', 'age': 'p.age',
+            'gender': 'p.gender', 'registration_date': 'p.registration_date'
+        },
+        'key': 'patient_id',
+        'sortable': ['patient_id', 'name', 'age', 'registration_date'],
+        'filterable': ['gender'],
+        'search': 'name'
+    },
+    'doctors': {
+        'from': 'doctors doc JOIN departments d ON doc.department_id = d.department_id',
+        'columns': {
+            'doctor_id': 'doc.doctor_id', 'name': 'doc.name', 'specialization': 'doc.specialization',
+            'department_name': 'd.name', 'hire_date': 'doc.hire_date'
+        },
+        'key': 'doctor_id',
+        'sortable': ['doctor_id', 'name', 'specialization', 'hire_date'],
+        'filterable': ['specialization', 'department_name'],
+        'search': 'name'
+    },
+    'services': {
+        'from': 'services s JOIN departments d ON s.department_id = d.department_id',
+        'columns': {
+            'service_id': 's.service_id', 'name': 's.name', 'type': 's.type',
+            'department_name': 'd.name', 'cost': 's.cost', 'duration_minutes': 's.duration_minutes'
+        },
+        'key': 'service_id',
+        'sortable': ['service_id', 'name', 'cost', 'duration_minutes'],
+        'filterable': ['type', 'department_name'],
+        'search': 'name'
+    }
+}
+
+# How each result combines across branch databases: group keys, columns
+# summed, averages (with the count they average over, so they merge as
+# sum / count), distinct counts carried as HyperLogLog sketches, quantiles
+# carried as t-digests (serialized, see _with_quantiles), sort keys
+# (ascending?) and a row limit re-applied after merging. Patient ids are
+# shared by all branches, so a patient seen at two branches counts once;
+# doctors, services and departments are matched by name.
+BRANCH_MERGES = {
+    'get_revenue_trend': {'keys': ['month'], 'sum': ['revenue'], 'order_by': [('month', True)]},
+    'get_service_utilization': {
+        'keys': ['service_name'], 'sum': ['count'], 'order_by': [('count', False)], 'limit': 10
+    },
+    'analyze_service_utilization': {
+        'keys': ['service_name', 'service_type', 'department_name'],
+        'sum': ['appointment_count', 'total_revenue'], 'mean': {'avg_cost': 'appointment_count'},
+        'order_by': [('appointment_count', False)], 'limit': 10
+    },
+    'get_revenue_by_service': {
+        'keys': ['service_name'], 'sum': ['total_revenue', 'appointment_count'],
+        'order_by': [('total_revenue', False)]
+    },
+    'get_service_trends': {
+        'keys': ['month', 'service_name'], 'sum': ['appointments'],
+        'order_by': [('month', True), ('appointments', False)]
+    },
+    'get_department_service_distribution': {
+        'keys': ['department_name', 'service_name'], 'sum': ['count'], 'order_by': [('count', False)]
+    },
+    'analyze_doctor_performance': {
+        'keys': ['doctor_name', 'specialization', 'department_name'],
+        'sum': ['appointments_handled', 'total_revenue'],
+        'mean': {'avg_revenue_per_appointment': 'appointments_handled'},
+        'order_by': [('total_revenue', False)], 'limit': 10
+    },
+    'get_doctor_performance_metrics': {
+        'keys': ['doctor_name', 'specialization'],
+        'sum': ['appointments_handled', 'revenue_generated'],
+        'mean': {'avg_revenue_per_appointment': 'appointments_handled',
+                 'patient_satisfaction': 'appointments_handled'}
+    },
+    'get_doctor_revenue_trends': {
+        'keys': ['month', 'doctor_name'], 'sum': ['revenue'], 'order_by': [('month', True), ('revenue', False)]
+    },
+    'doctor_revenue': {'keys': ['department_name', 'doctor_name'], 'sum': ['total_revenue', 'has_revenue']},
+    'get_daily_appointment_trends': {'keys': ['date'], 'sum': ['appointments'], 'order_by': [('date', True)]},
+    'get_rolling_daily_trends': {
+        'keys': ['date'], 'sum': ['appointments', 'revenue'], 'order_by': [('date', True)]
+    },
+    'get_weekly_appointment_patterns': {'keys': ['day_of_week'], 'sum': ['appointments']},
+    'get_monthly_appointment_trends': {
+        'keys': ['month'], 'sum': ['appointments'], 'order_by': [('month', True)]
+    },
+    'get_seasonal_appointment_analysis': {
+        'keys': ['season'], 'sum': ['appointments'], 'order_by': [('appointments', False)]
+    },
+    'patient_visits': {'keys': ['patient_id'], 'sum': ['visit_count']},
+    'patient_spending': {'keys': ['patient_id'], 'sum': ['total_spent']},
+    'patient_behavior': {'keys': ['patient_id', 'patient_name'],
+                         'sum': ['completed_visits', 'total_visits', 'total_spent']},
+    'get_patient_spending_patterns': {
+        'keys': ['patient_id', 'patient_name'], 'sum': ['total_visits', 'total_spent'],
+        'mean': {'avg_spend_per_visit': 'total_visits'}, 'order_by': [('total_spent', False)]
+    },
+    'get_service_preferences': {
+        'keys': ['service_name'], 'sum': ['preference_score'], 'order_by': [('preference_score', False)],
+        'limit': 15
+    },
+    'get_monthly_revenue_trends': {
+        'keys': ['month'], 'sum': ['revenue', 'appointments'], 'distinct': ['unique_patients'],
+        'order_by': [('month', True)]
+    },
+    'get_monthly_growth': {'keys': ['month'], 'sum': ['revenue', 'appointments'], 'order_by': [('month', True)]},
+    'get_unique_patient_trends': {
+        'keys': ['period'], 'distinct': ['unique_patients'], 'order_by': [('period', True)]
+    },
+    'get_revenue_by_department': {
+        'keys': ['department_name'], 'sum': ['total_revenue', 'appointment_count'],
+        'mean': {'avg_revenue_per_appointment': 'appointment_count'}, 'order_by': [('total_revenue', False)]
+    },
+    'get_revenue_by_service_type': {
+        'keys': ['service_type'], 'sum': ['revenue', 'appointment_count'], 'order_by': [('revenue', False)]
+    },
+    'get_revenue_per_doctor': {
+        'keys': ['doctor_name', 'specialization'], 'sum': ['total_revenue', 'appointment_count'],
+        'mean': {'avg_revenue_per_appointment': 'appointment_count'}, 'order_by': [('total_revenue', False)]
+    },
+    'get_revenue_by_payment_method': {
+        'keys': ['payment_method'], 'sum': ['revenue', 'appointment_count'], 'order_by': [('revenue', False)]
+    },
+    'get_top_services': {
+        'keys': ['service_name', 'service_type', 'department_name'],
+        'sum': ['appointment_count', 'total_revenue'], 'mean': {'avg_cost': 'appointment_count'},
+        'order_by': [('appointment_count', False)]
+    },
+    'get_top_doctors': {
+        'keys': ['doctor_name', 'specialization', 'department_name'],
+        'sum': ['appointments_handled', 'total_revenue'],
+        'mean': {'avg_revenue_per_appointment': 'appointments_handled'}, 'order_by': [('total_revenue', False)]
+    },
+    'get_bill_amount_percentiles': {'keys': ['service_name'], 'digest': ['amounts']},
+    'get_payment_lag_percentiles': {'keys': ['payment_method'], 'digest': ['payment_lags']},
+    # Scalars and filter labels are always combined over all branches
+    'kpi_counter': {'sum': ['value'], 'combine_branches': True},
+    'kpi_distinct': {'distinct': ['value'], 'combine_branches': True},
+    'distinct_values': {'keys': ['value'], 'combine_branches': True},
+    'filter_options': {'keys': ['value'], 'order_by': [('value', True)], 'combine_branches': True}
+}
+
+# Branches listed in this file ({"name": "path/to/branch.db", ...}, paths
+# relative to the file) are opened together by the dashboard
+BRANCHES_FILE = 'branches.json'
+
+def load_branches(path=BRANCHES_FILE):
+    """Branch names and database paths from a branches file, or None without one"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        branches = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    return {name: os.path.join(directory, db_path) for name, db_path in branches.items()}
+
+def merge_partials(frames, spec, by_branch=False):
+    """Combine partial results (per branch, with a 'branch' column, or per scan range) following a BRANCH_MERGES spec
+    
+    With by_branch the branches stay apart: the spec's order and limit are
+    applied within each branch and the branch column is kept.
+    """
+    combined = pd.concat(frames, ignore_index=True)
+    by_branch = by_branch and not spec.get('combine_branches')
+    keys = (['branch'] if by_branch else []) + spec.get('keys', [])
+    means = spec.get('mean', {})
+    # Averages travel as sums weighted by their counts
+    for column, weight in means.items():
+        combined[column] = combined[column] * combined[weight]
+    aggregations = {column: 'sum' for column in spec.get('sum', []) + list(means)}
+    aggregations.update({column: lambda sketches: HyperLogLog.union(sketches).count()
+                         for column in spec.get('distinct', [])})
+    aggregations.update({column: lambda digests: TDigest.union(digests).to_bytes()
+                         for column in spec.get('digest', [])})
+    if keys and not aggregations:
+        result = combined[keys].drop_duplicates()
+    elif keys:
+        result = combined.groupby(keys, sort=False, dropna=False, observed=True).agg(aggregations).reset_index()
+    else:
+        result = pd.DataFrame([{column: combined[column].agg(function) for column, function in aggregations.items()}])
+    for column, weight in means.items():
+        result[column] = result[column] / result[weight].where(result[weight] > 0)
+    result = result[[column for column in keys if column == 'branch'] +
+                    [column for column in frames[0].columns if column in result.columns and column != 'branch']]
+    if spec.get('order_by'):
+        columns, ascending = zip(*spec['order_by'])
+        result = result.sort_values(list(columns), ascending=list(ascending), kind='stable')
+    if 'limit' in spec:
+        result = result.groupby('branch', sort=False, observed=True).head(spec['limit']) if by_branch \
+            else result.head(spec['limit'])
+    return result.reset_index(drop=True)
+
+# Process pools are shared by every engine (and Streamlit rerun) in this process
+_WORKER_POOLS = {}
+
+def _worker_pool(workers):
+    """A process pool with the given number of workers, started on first use"""
+    if workers not in _WORKER_POOLS:
+        # Workers are spawned rather than forked: the dashboard process has threads
+        _WORKER_POOLS[workers] = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+    return _WORKER_POOLS[workers]
+
+def _partial_result(task):
+    """Pool worker: one branch's (or scan range's) partial result of a query or (sample) cube roll-up"""
+    branch, db_path, date_range, kind, payload = task
+    engine = AnalyticsEngine(db_path, compact_results=False, use_cube=kind == 'cube', date_range=date_range,
+                             approximate=kind == 'sample')
+    engine.partial = True
+    if kind in ('cube', 'sample'):
+        result = engine._query_cube(*payload)
+    else:
+        query, params, since = payload
+        if engine.batches_partitions and reads_partitioned_tables(query):
+            result = pd.concat(engine._run_on_partition_batches(query, params, since, read_only=True),
+                               ignore_index=True)
+        else:
+            conn = engine._get_connection(since, read_only=True)
+            try:
+                result = pd.read_sql_query(query, conn, params=params or None)
+            finally:
+                conn.close()
+    if branch is not None:
+        result.insert(0, 'branch', branch)
+    return result
+
+def rolling_mean(values, window):
+    """Trailing mean over window values of each value, from one prefix sum
+    
+    The first window - 1 values average the values available so far.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    prefix = np.concatenate([[0.0], np.cumsum(values)])
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - window, 0)
+    return (prefix[ends] - prefix[starts]) / (ends - starts)
+
+def percent_change(values, periods=1):
+    """Percent change of each value over the one periods before it, NaN without a positive earlier value"""
+    values = np.asarray(values, dtype=np.float64)
+    previous = np.full(len(values), np.nan)
+    previous[periods:] = values[:len(values) - periods]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(previous > 0, (values - previous) / previous * 100, np.nan)
+
+def _sql_value(value):
+    """Convert a numpy scalar from a result row to a value sqlite3 can bind, with None for NULL"""
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
 class AnalyticsEngine:
     """Main analytics engine for healthcare data analysis"""
     
-    def __init__(self):
-        self.db_path = 'hospital_data.db'
+    def __init__(self, db_path='hospital_data.db', log_queries=False, compact_results=True,
+                 use_cube=False, date_range=None, branches=None, workers=None, by_branch=False,
+                 exact_distinct=True, approximate=False):
+        self.db_path = db_path
+        # (start, end) dates bounding the history queried; year partitions
+        # entirely outside it are never attached
+        self.date_range = date_range
+        self.log_queries = log_queries
+        self.query_log = []
+        self.compact_results = compact_results
+        self.memory_report = {}
+        # Approximate mode answers the cube queries from a cube of estimates
+        # built from the stratified appointment sample, each measure with the
+        # margin of its 95% confidence interval in a _margin column
+        self.approximate = approximate
+        self.use_cube = use_cube or approximate
+        # {branch name: database path}: analytics run on every branch in a
+        # pool of worker processes and the partial results are merged (see
+        # BRANCH_MERGES), or kept apart with a branch column if by_branch.
+        # Listings and other unmerged queries read db_path alone. Without
+        # branches, several workers split the heaviest scans by appointment id
+        self.branches = dict(branches) if branches else None
+        self.workers = workers or (min(len(self.branches), os.cpu_count() or 1) if self.branches else 1)
+        self.by_branch = by_branch
+        # More year partitions in the date range than SQLite can attach at
+        # once are read a batch at a time, merged like branches
+        self.batches_partitions = self._partitions_overflow()
+        # Queries are written as mergeable partials: no row limits, and
+        # distinct counts as sketches
+        self.partial = self.branches is not None or self.batches_partitions
+        # Unique patient counts are merged from the HyperLogLog sketches kept
+        # with the daily rollup unless exact; estimates carry a _margin column
+        self.exact_distinct = exact_distinct
+    
+    def _day_range(self, since=None):
+        """First and last day number a query can read (None for unbounded)"""
+        start, end = [to_day_number(value) if value is not None else None
+                      for value in (self.date_range or (None, None))]
+        if since is not None:
+            start = since if start is None else max(start, since)
+        return start, end
+    
+    def _partitions_overflow(self):
+        """Whether more year partitions hold days of the date range than a connection can attach"""
+        if not os.path.exists(self.db_path):
+            return False
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return len(overlapping_partitions(conn, *self._day_range())) > attach_limit(conn)
+        finally:
+            conn.close()
     
-    def _get_connection(self):
-        """Get database connection"""
-        return sqlite3.connect(self.db_path)
+    def _get_connection(self, since=None, read_only=False, attach=True):
+        """Get database connection, with the year partitions that can hold days from since onwards attached"""
+        if read_only:
+            conn = sqlite3.connect(f"{Path(self.db_path).absolute().as_uri()}?mode=ro", uri=True)
+        else:
+            conn = sqlite3.connect(self.db_path)
+        register_sketch_functions(conn)
+        if attach:
+            attach_partitions(conn, *self._day_range(since))
+        return conn
     
-    def _execute_query(self, query, params=None):
-        """Execute SQL query and return results"""
-        conn = self._get_connection()
+    def _run_on_partition_batches(self, query, params, since, read_only=False):
+        """Partial results of a query, one per batch of year partitions attached (see partition_batches)
+        
+        A query that reads neither fact table is a single partial.
+        """
+        conn = self._get_connection(since, read_only, attach=False)
         try:
+            if not reads_partitioned_tables(query):
+                return [pd.read_sql_query(query, conn, params=params or None)]
+            return [pd.read_sql_query(query, conn, params=params or None)
+                    for _ in partition_batches(conn, *self._day_range(since))]
+        finally:
+            conn.close()
+    
+    def _execute_query(self, query, params=None, result_schema=None, since=None, merge=None, split=False):
+        """Execute SQL query and return results
+        
+        since is the first day number the query can read, used to prune
+        year partitions. With branches, a query with a BRANCH_MERGES spec
+        (merge, by default the result schema) runs on every branch, and with
+        more partitions than can be attached, on every batch of them. A split
+        query ends with the _scan_range() condition and, given several
+        workers, runs in parallel over disjoint appointment id ranges.
+        """
+        merge = merge or result_schema
+        if (self.branches and merge in BRANCH_MERGES) or (split and self.splits_scans):
+            if self.branches:
+                df = self._run_on_branches('sql', (query, params, since), BRANCH_MERGES[merge])
+            else:
+                df = self._run_on_scan_ranges(query, params, since, BRANCH_MERGES[merge])
+            if result_schema is not None and self.compact_results:
+                df = self._apply_result_schema(df, result_schema)
+            return df
+        if self.batches_partitions and merge in BRANCH_MERGES:
+            df = merge_partials(self._run_on_partition_batches(query, params, since), BRANCH_MERGES[merge])
+            if result_schema is not None and self.compact_results:
+                df = self._apply_result_schema(df, result_schema)
+            return df
+        conn = self._get_connection(since, attach=reads_partitioned_tables(query))
+        try:
+            start = time.perf_counter()
             if params:
                 df = pd.read_sql_query(query, conn, params=params)
             else:
                 df = pd.read_sql_query(query, conn)
+            if self.log_queries:
+                self.query_log.append({
+                    'query': query,
+                    'params': params,
+                    'seconds': time.perf_counter() - start,
+                    'rows': len(df)
+                })
+            if result_schema is not None and self.compact_results:
+                df = self._apply_result_schema(df, result_schema)
             return df
         finally:
             conn.close()
     
+    def _run_on_branches(self, kind, payload, spec):
+        """Compute a query ('sql') or (sample) cube roll-up ('cube', 'sample') on every branch and merge the partials"""
+        tasks = [(branch, db_path, self.date_range, kind, payload) for branch, db_path in self.branches.items()]
+        if self.workers == 1:
+            partials = [_partial_result(task) for task in tasks]
+        else:
+            partials = list(_worker_pool(self.workers).map(_partial_result, tasks))
+        result = merge_partials(partials, spec, self.by_branch)
+        if 'branch' in result.columns:
+            result['branch'] = pd.Categorical(result['branch'], categories=list(self.branches))
+        return result
+    
+    @property
+    def splits_scans(self):
+        """Whether split queries run as parallel appointment id ranges (several workers, one database)"""
+        return self.branches is None and self.workers > 1
+    
+    def _scan_range(self):
+        """Condition bounding a split query to one range of appointment ids, bound by _run_on_scan_ranges"""
+        return "\n        AND a.appointment_id BETWEEN ? AND ?" if self.splits_scans else ''
+    
+    def _run_on_scan_ranges(self, query, params, since, spec):
+        """Map-reduce a query: one partial per appointment id range on a read-only connection, then merge"""
+        conn = self._get_connection(since)
+        try:
+            low, high = conn.execute("SELECT MIN(appointment_id), MAX(appointment_id) FROM appointments").fetchone()
+        finally:
+            conn.close()
+        bounds = np.linspace(low or 0, (high or 0) + 1, self.workers + 1).astype(np.int64)
+        tasks = [(None, self.db_path, self.date_range, 'sql', (query, tuple(params or ()) + (int(start), int(end) - 1), since))
+                 for start, end in zip(bounds[:-1], bounds[1:])]
+        return merge_partials(list(_worker_pool(self.workers).map(_partial_result, tasks)), spec)
+    
+    def _limit(self, rows):
+        """LIMIT clause of a top-N query; per-branch partials leave it to the merge"""
+        return '' if self.partial else f"LIMIT {rows}"
+    
+    def _head(self, result, rows):
+        """The first rows of a merged top-N result, per branch when branches are compared"""
+        if not self.partial:
+            return result
+        result = result.groupby('branch', sort=False, observed=True).head(rows) if 'branch' in result.columns \
+            else result.head(rows)
+        return result.reset_index(drop=True)
+    
+    def _count_distinct(self, expression):
+        """COUNT(DISTINCT ...), or a mergeable sketch of the values in per-branch partials"""
+        return f"hll_sketch({expression})" if self.partial else f"COUNT(DISTINCT {expression})"
+    
+    def _sketch_count(self, expression):
+        """Distinct count merged from a column of serialized sketches, or their union in per-branch partials"""
+        return f"hll_union({expression})" if self.partial else f"hll_count(hll_union({expression}))"
+    
+    def _only_filters(self, filters, dimensions):
+        """Whether every active cross-filter is on one of the dimensions"""
+        return all(dimension in dimensions for dimension, values in (filters or {}).items() if values)
+    
+    def _uses_sketches(self, filters=None):
+        """Whether unique patients come from the patient sketches (approximate mode, service filters only)"""
+        return not self.exact_distinct and self._only_filters(filters, SKETCH_FILTERS)
+    
+    def _with_margins(self, df, filters=None, column='unique_patients'):
+        """Add the confidence margin of a column of distinct counts when they are estimates"""
+        if self._uses_sketches(filters) or self.partial:
+            df[f'{column}_margin'] = margin_of_error(df[column].fillna(0)).astype(np.int64)
+        return df
+    
+    def _with_quantiles(self, df, column, count_column, quantiles=QUANTILES):
+        """Replace a column of serialized t-digests by their value count and quantile columns (p50, p90, ...)
+        
+        Rows without values are dropped and the rest sorted by count, within
+        each branch when branches are compared.
+        """
+        digests = [TDigest.from_bytes(digest) if digest is not None else TDigest() for digest in df.pop(column)]
+        df[count_column] = np.array([digest.count() for digest in digests], dtype=np.int64)
+        values = np.array([digest.quantile(quantiles) for digest in digests]).reshape(len(digests), len(quantiles))
+        for i, q in enumerate(quantiles):
+            df[f'p{q * 100:g}'] = values[:, i]
+        keys = ['branch'] if 'branch' in df.columns else []
+        df = df[df[count_column] > 0].sort_values(keys + [count_column], ascending=[True] * len(keys) + [False],
+                                                  kind='stable')
+        return df.reset_index(drop=True)
+    
+    def _per_series(self, df, column, function):
+        """Apply an array function to a time-ordered column, within each branch when branches are compared"""
+        if 'branch' in df.columns:
+            return df.groupby('branch', sort=False, observed=True)[column].transform(
+                lambda values: function(values.to_numpy()))
+        return function(df[column].to_numpy())
+    
+    def _apply_result_schema(self, df, result_schema):
+        """Convert a result to its declared compact dtypes and record the memory saved"""
+        bytes_before = int(df.memory_usage(deep=True).sum())
+        for column, kind in RESULT_SCHEMAS[result_schema].items():
+            if column not in df.columns:
+                continue
+            if kind == 'category':
+                # Only worthwhile when names repeat; categories keep first-appearance
+                # order so chart traces and bars come out in the same order
+                if df[column].nunique() <= len(df) // 2:
+                    df[column] = pd.Categorical(df[column], categories=df[column].dropna().unique())
+            elif kind == 'integer':
+                # Pages and merges still add and multiply counts, so they stop
+                # at int32 rather than wrapping around in int8 or int16
+                values = pd.to_numeric(df[column], downcast='integer')
+                if pd.api.types.is_integer_dtype(values) and values.dtype.itemsize < 4:
+                    values = values.astype('int32')
+                df[column] = values
+            elif kind == 'float32':
+                df[column] = df[column].astype('float32')
+        self.memory_report[result_schema] = {
+            'rows': len(df),
+            'bytes_before': bytes_before,
+            'bytes_after': int(df.memory_usage(deep=True).sum())
+        }
+        return df
+    
+    def get_memory_report(self):
+        """Memory used by each result before and after applying its schema"""
+        report = pd.DataFrame.from_dict(self.memory_report, orient='index',
+                                        columns=['rows', 'bytes_before', 'bytes_after'])
+        report.index.name = 'method'
+        report['saved_pct'] = (100 * (1 - report['bytes_after'] / report['bytes_before'].clip(lower=1))).round(1)
+        return report.reset_index()
+    
+    def save_query_log(self, path):
+        """Write the logged queries as JSON lines for the index advisor"""
+        with open(path, 'w') as f:
+            for entry in self.query_log:
+                f.write(json.dumps(entry, default=str) + '\n')
+    
+    # OLAP cube
+    def get_cube(self):
+        """The in-memory cube (of sample estimates when approximate) for the database's current data version"""
+        return load_sample_cube(self.db_path) if self.approximate else load_cube(self.db_path)
+    
+    def _query_cube(self, method, filters=None):
+        """Answer one of the CUBE_QUERIES from the cube instead of SQLite"""
+        spec = CUBE_QUERIES[method]
+        # Sample estimates carry the variance of each summed measure, which adds
+        # up across branches and becomes a margin once merged
+        measures = dict(spec['measures'])
+        if self.approximate:
+            measures.update({f'{measure}_variance': f'{name}_variance' for measure, name in spec['measures'].items()
+                             if measure != 'avg_amount'})
+        if self.branches:
+            merge = BRANCH_MERGES[method]
+            if self.approximate:
+                merge = dict(merge, sum=merge.get('sum', []) + [name for name in measures.values()
+                                                                if name.endswith('_variance')])
+            result = self._run_on_branches('sample' if self.approximate else 'cube', (method, filters), merge)
+            result = self._with_sample_margins(result, spec)
+            return self._apply_result_schema(result, method) if self.compact_results else result
+        cube = self.get_cube().dice(**spec['where']).dice(**(filters or {}))
+        if 'window' in spec:
+            dimension, months = spec['window']
+            start = months_ago(months)
+            first_month = load_month_from(self.db_path, dimension, start, sample=self.approximate)
+            cube = cube.since(dimension, start, first_month.dice(**spec['where']).dice(**(filters or {})))
+        result = cube.roll_up(*spec['by'], attributes=spec.get('attributes'))
+        attribute_columns = [column for columns in spec.get('attributes', {}).values() for column in columns]
+        result = result[list(spec['by']) + attribute_columns + list(measures)]
+        result = result.rename(columns={**spec['by'], **measures})
+        keys, ascending = zip(*spec['order_by'])
+        result = result.sort_values(list(keys), ascending=list(ascending), kind='stable')
+        if 'limit' in spec and not self.partial:
+            result = result.head(spec['limit'])
+        result = result.reset_index(drop=True)
+        if not self.partial:
+            result = self._with_sample_margins(result, spec)
+        if self.compact_results:
+            result = self._apply_result_schema(result, method)
+        return result
+    
+    def _with_sample_margins(self, result, spec):
+        """Turn the variances of sampled estimates into confidence margins, rounding estimated counts"""
+        if not self.approximate:
+            return result
+        for measure, name in spec['measures'].items():
+            if measure == 'avg_amount':
+                continue
+            result[f'{name}_margin'] = CONFIDENCE_Z * np.sqrt(result.pop(f'{name}_variance').clip(lower=0))
+            if measure in COUNT_MEASURES:
+                result[name] = result[name].round().astype(np.int64)
+                result[f'{name}_margin'] = result[f'{name}_margin'].round().astype(np.int64)
+        return result
+    
+    # Cross-filters
+    def _filter_sql(self, filters):
+        """SQL conditions (each prefixed with AND) and parameters for cross-filters
+        
+        filters maps a FILTER_CONDITIONS dimension to a label or list of labels;
+        empty selections are ignored.
+        """
+        conditions, params = [], []
+        for dimension, values in (filters or {}).items():
+            if dimension not in FILTER_CONDITIONS:
+                raise ValueError(f"Unknown filter {dimension!r}; expected one of {sorted(FILTER_CONDITIONS)}")
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if not values:
+                continue
+            if dimension == 'payment_method':
+                values = [encode(PAYMENT_METHODS, value) for value in values]
+            conditions.append(FILTER_CONDITIONS[dimension].format(', '.join('?' * len(values))))
+            params.extend(values)
+        return ''.join(f"\n        AND {condition}" for condition in conditions), tuple(params)
+    
+    def get_filter_options(self, dimension):
+        """Labels a cross-filter dimension can take, for filter widgets"""
+        if dimension == 'payment_method':
+            return list(PAYMENT_METHODS)
+        queries = {
+            'department': "SELECT name as value FROM departments ORDER BY name",
+            'doctor': "SELECT name as value FROM doctors ORDER BY name",
+            'service_type': "SELECT DISTINCT type as value FROM services WHERE type IS NOT NULL ORDER BY type"
+        }
+        if dimension not in queries:
+            raise ValueError(f"Unknown filter {dimension!r}; expected one of {sorted(FILTER_CONDITIONS)}")
+        return self._execute_query(queries[dimension], merge='filter_options')['value'].tolist()
+    
+    # Paginated listings
+    def _listing_conditions(self, listing, filters=None, search=None):
+        """WHERE conditions and parameters for a listing's filters and name search"""
+        spec = TABLE_LISTINGS[listing]
+        conditions, params = [], []
+        for column, value in (filters or {}).items():
+            if column not in spec['filterable']:
+                raise ValueError(f"Cannot filter {listing} by {column}")
+            if isinstance(value, (list, tuple)):
+                conditions.append(f"{spec['columns'][column]} IN ({', '.join('?' * len(value))})")
+                params.extend(value)
+            else:
+                conditions.append(f"{spec['columns'][column]} = ?")
+                params.append(value)
+        if search:
+            # A literal prefix LIKE is answered from the NOCASE index on the column
+            conditions.append(f"{spec['columns'][spec['search']]} LIKE ? ESCAPE '\\'")
+            params.append(search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        return conditions, params
+    
+    def get_table_page(self, listing, sort_by=None, descending=False, after=None,
+                       filters=None, search=None, page_size=50):
+        """Fetch one page of a listing using keyset pagination
+        
+        Sorting and filtering run in SQL, and later pages seek past the
+        (sort value, key) cursor of the previous page instead of using OFFSET,
+        so each call reads about page_size rows. Returns the page and the
+        cursor for the next one, which is None on the last page.
+        """
+        spec = TABLE_LISTINGS[listing]
+        columns = spec['columns']
+        key = spec['key']
+        sort_by = sort_by or key
+        if sort_by not in spec['sortable']:
+            raise ValueError(f"Cannot sort {listing} by {sort_by}")
+        
+        conditions, params = self._listing_conditions(listing, filters, search)
+        direction, comparison = ('DESC', '<') if descending else ('ASC', '>')
+        sort_column, key_column = columns[sort_by], columns[key]
+        # SQLite sorts NULL sort values first ascending and last descending, and a
+        # row-value comparison with NULL is never true, so the rows after a cursor
+        # are up to two index seeks: the rest of the cursor's NULL or non-NULL run,
+        # then the other run when it sorts later
+        seeks = [([], [])]
+        if after is not None:
+            value, last_key = after
+            if sort_by == key:
+                seeks = [([f"{key_column} {comparison} ?"], [last_key])]
+            elif value is None:
+                seeks = [([f"{sort_column} IS NULL", f"{key_column} {comparison} ?"], [last_key])]
+                if not descending:
+                    seeks.append(([f"{sort_column} IS NOT NULL"], []))
+            else:
+                seeks = [([f"({sort_column}, {key_column}) {comparison} (?, ?)"], [value, last_key])]
+                if descending:
+                    seeks.append(([f"{sort_column} IS NULL"], []))
+        
+        # One extra row tells us whether another page follows
+        parts = []
+        remaining = page_size + 1
+        for seek_conditions, seek_params in seeks:
+            where = ' AND '.join(conditions + seek_conditions)
+            query = f"""
+            SELECT {', '.join(f'{expression} as {name}' for name, expression in columns.items())}
+            FROM {spec['from']}
+            {f'WHERE {where}' if where else ''}
+            ORDER BY {sort_column} {direction}, {key_column} {direction}
+            LIMIT ?
+            """
+            parts.append(self._execute_query(query, tuple(params + seek_params) + (remaining,)))
+            remaining -= len(parts[-1])
+            if remaining == 0:
+                break
+        page = pd.concat([part for part in parts if len(part)] or parts[:1], ignore_index=True)
+        if len(page) <= page_size:
+            return page, None
+        page = page.iloc[:page_size]
+        last = page.iloc[-1]
+        return page, (_sql_value(last[sort_by]), _sql_value(last[key]))
+    
+    def count_table_rows(self, listing, filters=None, search=None):
+        """Number of rows in a listing after filters and search"""
+        conditions, params = self._listing_conditions(listing, filters, search)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        query = f"SELECT COUNT(*) as count FROM {TABLE_LISTINGS[listing]['from']} {where}"
+        return int(self._execute_query(query, tuple(params))['count'].iloc[0])
+    
+    def get_listing_filter_options(self, listing, column):
+        """Distinct values of a filterable listing column, for filter widgets"""
+        spec = TABLE_LISTINGS[listing]
+        if column not in spec['filterable']:
+            raise ValueError(f"Cannot filter {listing} by {column}")
+        expression = spec['columns'][column]
+        query = f"""
+        SELECT DISTINCT {expression} as value
+        FROM {spec['from']}
+        WHERE {expression} IS NOT NULL
+        ORDER BY value
+        """
+        return self._execute_query(query)['value'].tolist()
+    
     # Dashboard Overview Methods
+    def get_kpi_counter(self, name):
+        """Read a trigger-maintained KPI counter (see schema.KPI_COUNTERS)"""
+        query = "SELECT value FROM kpi_counters WHERE name = ?"
+        result = self._execute_query(query, (name,), merge='kpi_counter')
+        return result['value'].iloc[0]
+    
+    def check_kpi_counters(self, reconcile=False):
+        """Compare the KPI counters with full scans, resetting drifted ones if reconcile"""
+        if self.branches:
+            reports = [AnalyticsEngine(db_path).check_kpi_counters(reconcile) for db_path in self.branches.values()]
+            return pd.concat(reports, keys=list(self.branches), names=['branch']).reset_index(level=0) \
+                .reset_index(drop=True)
+        # Counters cover the whole history, whatever the engine's date range
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return pd.DataFrame(check_kpi_counters(conn, reconcile=reconcile, values=kpi_counter_values(conn)))
+        finally:
+            conn.close()
+    
+    def get_patient_count(self):
+        """Total number of patients, with the 95% margin of an estimate (0 when exact)
+        
+        Patients registered at several branches count once: exactly if
+        exact_distinct, from their merged ids, otherwise estimated from
+        HyperLogLog sketches.
+        """
+        if not self.branches:
+            return {'total_patients': int(self.get_kpi_counter('total_patients')), 'margin': 0}
+        if self.exact_distinct:
+            patients = self._execute_query("SELECT patient_id as value FROM patients", merge='distinct_values')
+            return {'total_patients': len(patients), 'margin': 0}
+        query = f"SELECT {self._count_distinct('patient_id')} as value FROM patients"
+        count = int(self._execute_query(query, merge='kpi_distinct')['value'].iloc[0] or 0)
+        return {'total_patients': count, 'margin': int(margin_of_error(count))}
+    
     def get_total_patients(self):
         """Get total number of patients"""
-        query = "SELECT COUNT(*) as count FROM patients"
-        result = self._execute_query(query)
-        return result['count'].iloc[0]
+        return self.get_patient_count()['total_patients']
     
     def get_total_revenue(self):
         """Get total revenue"""
-        query = """
-        SELECT COALESCE(SUM(b.amount), 0) as total_revenue
-        FROM billing b
-        JOIN appointments a ON b.appointment_id = a.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
-        """
-        result = self._execute_query(query)
-        return result['total_revenue'].iloc[0]
+        return self.get_kpi_counter('paid_completed_revenue')
     
     def get_total_appointments(self):
         """Get total number of appointments"""
-        query = "SELECT COUNT(*) as count FROM appointments"
-        result = self._execute_query(query)
-        return result['count'].iloc[0]
+        return self.get_kpi_counter('total_appointments')
     
     def get_avg_revenue_per_patient(self):
         """Get average revenue per patient"""
@@ -57,67 +936,116 @@ class AnalyticsEngine:
         total_patients = self.get_total_patients()
         return total_revenue / total_patients if total_patients > 0 else 0
     
-    def get_revenue_trend(self):
+    def get_revenue_trend(self, filters=None):
         """Get monthly revenue trend for last 12 months"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_revenue_trend', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
-            strftime('%Y-%m', b.payment_date) as month,
+            c.month_label as month,
             SUM(b.amount) as revenue
         FROM billing b
         JOIN appointments a ON b.appointment_id = a.appointment_id
-        WHERE a.status = 'Completed' 
-        AND b.payment_status = 'Paid'
-        AND b.payment_date >= date('now', '-12 months')
-        GROUP BY strftime('%Y-%m', b.payment_date)
-        ORDER BY month
+        JOIN calendar c ON c.day = b.payment_day
+        WHERE a.status_code = {COMPLETED} 
+        AND b.payment_status_code = {PAID}
+        AND b.payment_day >= ?{filter_sql}
+        GROUP BY c.month_key
+        ORDER BY c.month_key
         """
-        return self._execute_query(query)
+        since = months_ago(12)
+        return self._execute_query(query, (since,) + filter_params, result_schema='get_revenue_trend',
+                                   since=since)
     
-    def get_service_utilization(self):
+    def get_service_utilization(self, filters=None):
         """Get service utilization distribution"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_service_utilization', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             s.name as service_name,
             COUNT(a.appointment_id) as count
         FROM appointments a
         JOIN services s ON a.service_id = s.service_id
-        WHERE a.status = 'Completed'
+        WHERE a.status_code = {COMPLETED}{filter_sql}
         GROUP BY s.service_id, s.name
         ORDER BY count DESC
-        LIMIT 10
+        {self._limit(10)}
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_service_utilization')
     
     # Most Utilized Services Analysis
-    def analyze_service_utilization(self):
+    def analyze_service_utilization(self, filters=None):
         """Analyze service utilization patterns"""
-        # Top services by utilization
-        top_services_query = """
-        SELECT 
-            s.name as service_name,
-            s.type as service_type,
-            d.name as department_name,
-            COUNT(a.appointment_id) as appointment_count,
-            AVG(s.cost) as avg_cost,
-            SUM(s.cost) as total_revenue
-        FROM appointments a
-        JOIN services s ON a.service_id = s.service_id
-        JOIN departments d ON s.department_id = d.department_id
-        WHERE a.status = 'Completed'
-        GROUP BY s.service_id, s.name, s.type, d.name
-        ORDER BY appointment_count DESC
-        LIMIT 10
-        """
-        
-        top_services = self._execute_query(top_services_query)
-        
         return {
-            'top_services': top_services
+            'top_services': self.get_top_services(filters=filters)
         }
     
-    def get_revenue_by_service(self):
+    def get_top_services(self, start=None, end=None, k=10, filters=None):
+        """The k services with the most completed appointments between two dates (inclusive, open-ended if None)
+        
+        Merged from the per-day service summaries, which are exact while the
+        range has at most DEFAULT_CAPACITY services; filters other than
+        service filters group the appointments instead.
+        """
+        filter_sql, filter_params = self._filter_sql(filters)
+        if self._only_filters(filters, SKETCH_FILTERS):
+            query = f"""
+            SELECT 
+                s.name as service_name,
+                s.type as service_type,
+                d.name as department_name,
+                a.appointment_count,
+                s.cost as avg_cost,
+                a.appointment_count * s.cost as total_revenue
+            FROM (
+                SELECT 
+                    json_extract(e.value, '$[0]') as service_id,
+                    CAST(json_extract(e.value, '$[1]') AS INTEGER) as appointment_count
+                FROM (
+                    SELECT topk_union(r.appointments) as summary
+                    FROM daily_top_services r
+                    WHERE (? IS NULL OR r.day >= ?) AND (? IS NULL OR r.day <= ?)
+                ) m, json_each(topk_entries(m.summary)) e
+            ) a
+            JOIN services s ON a.service_id = s.service_id
+            JOIN departments d ON s.department_id = d.department_id
+            WHERE a.appointment_count > 0{filter_sql}
+            ORDER BY a.appointment_count DESC
+            {self._limit(k)}
+            """
+        else:
+            query = f"""
+            SELECT 
+                s.name as service_name,
+                s.type as service_type,
+                d.name as department_name,
+                COUNT(a.appointment_id) as appointment_count,
+                AVG(s.cost) as avg_cost,
+                SUM(s.cost) as total_revenue
+            FROM appointments a
+            JOIN services s ON a.service_id = s.service_id
+            JOIN departments d ON s.department_id = d.department_id
+            WHERE a.status_code = {COMPLETED}
+            AND (? IS NULL OR a.appointment_day >= ?) AND (? IS NULL OR a.appointment_day <= ?){filter_sql}
+            GROUP BY s.service_id, s.name, s.type, d.name
+            ORDER BY appointment_count DESC
+            {self._limit(k)}
+            """
+        start_day, end_day = [to_day_number(value) if value is not None else None for value in (start, end)]
+        params = (start_day, start_day, end_day, end_day) + filter_params
+        result = self._execute_query(query, params, result_schema='analyze_service_utilization', since=start_day,
+                                     merge='get_top_services')
+        return self._head(result, k)
+    
+    def get_revenue_by_service(self, filters=None):
         """Get revenue by service"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_revenue_by_service', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             s.name as service_name,
             SUM(b.amount) as total_revenue,
@@ -125,31 +1053,40 @@ class AnalyticsEngine:
         FROM appointments a
         JOIN services s ON a.service_id = s.service_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
         GROUP BY s.service_id, s.name
         ORDER BY total_revenue DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_revenue_by_service')
     
-    def get_service_trends(self):
+    def get_service_trends(self, filters=None):
         """Get service utilization trends over time"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_service_trends', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
-            strftime('%Y-%m', a.appointment_date) as month,
+            c.month_label as month,
             s.name as service_name,
             COUNT(a.appointment_id) as appointments
         FROM appointments a
         JOIN services s ON a.service_id = s.service_id
-        WHERE a.status = 'Completed'
-        AND a.appointment_date >= date('now', '-12 months')
-        GROUP BY strftime('%Y-%m', a.appointment_date), s.name
-        ORDER BY month, appointments DESC
+        JOIN calendar c ON c.day = a.appointment_day
+        WHERE a.status_code = {COMPLETED}
+        AND a.appointment_day >= ?{filter_sql}
+        GROUP BY c.month_key, s.name
+        ORDER BY c.month_key, appointments DESC
         """
-        return self._execute_query(query)
+        since = months_ago(12)
+        return self._execute_query(query, (since,) + filter_params, result_schema='get_service_trends',
+                                   since=since)
     
-    def get_department_service_distribution(self):
+    def get_department_service_distribution(self, filters=None):
         """Get service distribution by department"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_department_service_distribution', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             d.name as department_name,
             s.name as service_name,
@@ -157,100 +1094,173 @@ class AnalyticsEngine:
         FROM appointments a
         JOIN services s ON a.service_id = s.service_id
         JOIN departments d ON s.department_id = d.department_id
-        WHERE a.status = 'Completed'
+        WHERE a.status_code = {COMPLETED}{filter_sql}{self._scan_range()}
         GROUP BY d.department_id, d.name, s.service_id, s.name
         ORDER BY count DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_department_service_distribution', split=True)
     
     # Doctor Performance Analysis
-    def analyze_doctor_performance(self):
+    def analyze_doctor_performance(self, filters=None):
         """Analyze doctor performance metrics"""
-        # Top doctors by revenue
-        top_doctors_query = """
-        SELECT 
-            d.name as doctor_name,
-            d.specialization,
-            dept.name as department_name,
-            COUNT(a.appointment_id) as appointments_handled,
-            SUM(b.amount) as total_revenue,
-            AVG(b.amount) as avg_revenue_per_appointment
-        FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.doctor_id
-        JOIN departments dept ON d.department_id = dept.department_id
-        JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
-        GROUP BY d.doctor_id, d.name, d.specialization, dept.name
-        ORDER BY total_revenue DESC
-        LIMIT 10
-        """
-        
-        top_doctors = self._execute_query(top_doctors_query)
+        if self.use_cube:
+            top_doctors = self._query_cube('analyze_doctor_performance', filters)
+        else:
+            top_doctors = self.get_top_doctors(filters=filters)
         
         return {
             'top_doctors': top_doctors
         }
     
-    def get_doctor_performance_metrics(self):
+    def get_top_doctors(self, start=None, end=None, k=10, filters=None):
+        """The k doctors with the most paid revenue from completed appointments between two dates (inclusive)
+        
+        Merged from the per-day doctor summaries like get_top_services;
+        filters other than the doctor filter group the appointments instead.
+        """
+        filter_sql, filter_params = self._filter_sql(filters)
+        if self._only_filters(filters, DOCTOR_SUMMARY_FILTERS):
+            query = f"""
+            SELECT 
+                d.name as doctor_name,
+                d.specialization,
+                dept.name as department_name,
+                a.appointments_handled,
+                a.total_revenue,
+                a.total_revenue / a.appointments_handled as avg_revenue_per_appointment
+            FROM (
+                SELECT 
+                    json_extract(e.value, '$[0]') as doctor_id,
+                    CAST(topk_count(m.appointments, json_extract(e.value, '$[0]')) AS INTEGER) as appointments_handled,
+                    json_extract(e.value, '$[1]') as total_revenue
+                FROM (
+                    SELECT topk_union(r.revenue) as revenue, topk_union(r.appointments) as appointments
+                    FROM daily_top_doctors r
+                    WHERE (? IS NULL OR r.day >= ?) AND (? IS NULL OR r.day <= ?)
+                ) m, json_each(topk_entries(m.revenue)) e
+            ) a
+            JOIN doctors d ON a.doctor_id = d.doctor_id
+            JOIN departments dept ON d.department_id = dept.department_id
+            WHERE a.appointments_handled > 0{filter_sql}
+            ORDER BY a.total_revenue DESC
+            {self._limit(k)}
+            """
+        else:
+            query = f"""
+            SELECT 
+                d.name as doctor_name,
+                d.specialization,
+                dept.name as department_name,
+                COUNT(a.appointment_id) as appointments_handled,
+                SUM(b.amount) as total_revenue,
+                AVG(b.amount) as avg_revenue_per_appointment
+            FROM appointments a
+            JOIN doctors d ON a.doctor_id = d.doctor_id
+            JOIN departments dept ON d.department_id = dept.department_id
+            JOIN billing b ON a.appointment_id = b.appointment_id
+            WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}
+            AND (? IS NULL OR a.appointment_day >= ?) AND (? IS NULL OR a.appointment_day <= ?){filter_sql}
+            GROUP BY d.doctor_id, d.name, d.specialization, dept.name
+            ORDER BY total_revenue DESC
+            {self._limit(k)}
+            """
+        start_day, end_day = [to_day_number(value) if value is not None else None for value in (start, end)]
+        params = (start_day, start_day, end_day, end_day) + filter_params
+        result = self._execute_query(query, params, result_schema='analyze_doctor_performance', since=start_day,
+                                     merge='get_top_doctors')
+        return self._head(result, k)
+    
+    def get_doctor_performance_metrics(self, filters=None):
         """Get comprehensive doctor performance metrics"""
-        query = """
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             d.name as doctor_name,
             d.specialization,
             COUNT(a.appointment_id) as appointments_handled,
             SUM(b.amount) as revenue_generated,
             AVG(b.amount) as avg_revenue_per_appointment,
-            ROUND(COUNT(a.appointment_id) * 0.8 + RANDOM() * 0.4, 2) as patient_satisfaction
+            ROUND(COUNT(a.appointment_id) * 0.8 + ABS(RANDOM() % 1000) / 1000.0 * 0.4, 2) as patient_satisfaction
         FROM appointments a
         JOIN doctors d ON a.doctor_id = d.doctor_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
         GROUP BY d.doctor_id, d.name, d.specialization
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_doctor_performance_metrics')
     
-    def get_doctor_revenue_trends(self):
+    def get_doctor_revenue_trends(self, filters=None):
         """Get doctor revenue trends over time"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_doctor_revenue_trends', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
-            strftime('%Y-%m', a.appointment_date) as month,
+            c.month_label as month,
             d.name as doctor_name,
             SUM(b.amount) as revenue
         FROM appointments a
         JOIN doctors d ON a.doctor_id = d.doctor_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' 
-        AND b.payment_status = 'Paid'
-        AND a.appointment_date >= date('now', '-12 months')
-        GROUP BY strftime('%Y-%m', a.appointment_date), d.doctor_id, d.name
-        ORDER BY month, revenue DESC
+        JOIN calendar c ON c.day = a.appointment_day
+        WHERE a.status_code = {COMPLETED} 
+        AND b.payment_status_code = {PAID}
+        AND a.appointment_day >= ?{filter_sql}
+        GROUP BY c.month_key, d.doctor_id, d.name
+        ORDER BY c.month_key, revenue DESC
         """
-        return self._execute_query(query)
+        since = months_ago(12)
+        return self._execute_query(query, (since,) + filter_params, result_schema='get_doctor_revenue_trends',
+                                   since=since)
     
-    def get_department_doctor_performance(self):
+    def get_department_doctor_performance(self, filters=None):
         """Get department-wise doctor performance"""
-        query = """
-        SELECT 
-            d.name as department_name,
-            AVG(doctor_revenue.total_revenue) as avg_revenue_per_doctor,
-            COUNT(DISTINCT doc.doctor_id) as doctor_count
-        FROM departments d
-        JOIN doctors doc ON d.department_id = doc.department_id
-        LEFT JOIN (
+        filter_sql, filter_params = self._filter_sql(filters)
+        revenue_query = f"""
             SELECT 
                 a.doctor_id,
                 SUM(b.amount) as total_revenue
             FROM appointments a
             JOIN billing b ON a.appointment_id = b.appointment_id
-            WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+            WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
             GROUP BY a.doctor_id
-        ) doctor_revenue ON doc.doctor_id = doctor_revenue.doctor_id
+        """
+        if self.partial:
+            # A doctor's revenue at every branch adds up before departments average
+            # it, so a doctor on several branches' rosters counts once
+            doctors_query = f"""
+            SELECT 
+                d.name as department_name,
+                doc.name as doctor_name,
+                COALESCE(doctor_revenue.total_revenue, 0) as total_revenue,
+                doctor_revenue.doctor_id IS NOT NULL as has_revenue
+            FROM departments d
+            JOIN doctors doc ON d.department_id = doc.department_id
+            LEFT JOIN ({revenue_query}) doctor_revenue ON doc.doctor_id = doctor_revenue.doctor_id
+            """
+            doctors = self._execute_query(doctors_query, filter_params, merge='doctor_revenue')
+            # Doctors without paid revenue anywhere count as doctors but not in the average
+            doctors['total_revenue'] = doctors['total_revenue'].where(doctors['has_revenue'] > 0)
+            keys = [column for column in ('branch', 'department_name') if column in doctors.columns]
+            df = doctors.groupby(keys, sort=False, observed=True).agg(
+                avg_revenue_per_doctor=('total_revenue', 'mean'), doctor_count=('doctor_name', 'size')
+            ).reset_index()
+            df = df.sort_values('avg_revenue_per_doctor', ascending=False, kind='stable').reset_index(drop=True)
+            return self._apply_result_schema(df, 'get_department_doctor_performance') if self.compact_results else df
+        query = f"""
+        SELECT 
+            d.name as department_name,
+            AVG(doctor_revenue.total_revenue) as avg_revenue_per_doctor,
+            COUNT(DISTINCT doc.doctor_id) as doctor_count
+        FROM departments d
+        JOIN doctors doc ON d.department_id = doc.department_id
+        LEFT JOIN ({revenue_query}) doctor_revenue ON doc.doctor_id = doctor_revenue.doctor_id
         GROUP BY d.department_id, d.name
         ORDER BY avg_revenue_per_doctor DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_department_doctor_performance')
     
-    # Patient Trends Analysis
+    # Patient Trends Analysis (appointment counts come from the daily rollup)
     def analyze_patient_trends(self):
         """Analyze patient appointment trends"""
         return {
@@ -263,70 +1273,153 @@ class AnalyticsEngine:
         """Get daily appointment trends"""
         query = """
         SELECT 
-            a.appointment_date as date,
-            COUNT(a.appointment_id) as appointments
-        FROM appointments a
-        WHERE a.appointment_date >= date('now', '-90 days')
-        GROUP BY a.appointment_date
-        ORDER BY a.appointment_date
+            c.date as date,
+            SUM(r.appointments) as appointments
+        FROM daily_rollup r
+        JOIN calendar c ON c.day = r.day
+        WHERE r.day >= ?
+        GROUP BY r.day
+        ORDER BY r.day
         """
-        return self._execute_query(query)
+        since = days_ago(90)
+        return self._execute_query(query, (since,), result_schema='get_daily_appointment_trends', since=since)
+    
+    def get_rolling_daily_trends(self, days=90, windows=ROLLING_WINDOWS):
+        """Appointments and paid revenue per appointment day over the last days, with trailing moving averages
+        
+        Days without appointments are filled with zeros from the calendar, and
+        each window's average (e.g. appointments_7d_avg) also covers the days
+        before the range.
+        """
+        since = days_ago(days)
+        start = since - max(windows) + 1
+        query = f"""
+        SELECT 
+            c.date as date,
+            CAST(TOTAL(r.appointments) AS INTEGER) as appointments,
+            TOTAL(CASE WHEN r.status_code = {COMPLETED} THEN r.paid_revenue END) as revenue
+        FROM calendar c
+        LEFT JOIN daily_rollup r ON r.day = c.day
+        WHERE c.day BETWEEN ? AND ?
+        GROUP BY c.day
+        ORDER BY c.day
+        """
+        result = self._execute_query(query, (start, days_ago(0)), result_schema='get_rolling_daily_trends',
+                                     since=start)
+        for column in ('appointments', 'revenue'):
+            for window in windows:
+                result[f'{column}_{window}d_avg'] = self._per_series(result, column,
+                                                                     lambda values: rolling_mean(values, window))
+        return result[result['date'] >= from_day_number(since).isoformat()].reset_index(drop=True)
     
     def get_weekly_appointment_patterns(self):
         """Get weekly appointment patterns"""
         query = """
         SELECT 
-            CASE 
-                WHEN strftime('%w', a.appointment_date) = '0' THEN 'Sunday'
-                WHEN strftime('%w', a.appointment_date) = '1' THEN 'Monday'
-                WHEN strftime('%w', a.appointment_date) = '2' THEN 'Tuesday'
-                WHEN strftime('%w', a.appointment_date) = '3' THEN 'Wednesday'
-                WHEN strftime('%w', a.appointment_date) = '4' THEN 'Thursday'
-                WHEN strftime('%w', a.appointment_date) = '5' THEN 'Friday'
-                WHEN strftime('%w', a.appointment_date) = '6' THEN 'Saturday'
-            END as day_of_week,
-            COUNT(a.appointment_id) as appointments
-        FROM appointments a
-        WHERE a.appointment_date >= date('now', '-365 days')
-        GROUP BY strftime('%w', a.appointment_date)
-        ORDER BY strftime('%w', a.appointment_date)
+            c.day_name as day_of_week,
+            SUM(r.appointments) as appointments
+        FROM daily_rollup r
+        JOIN calendar c ON c.day = r.day
+        WHERE r.day >= ?
+        GROUP BY c.day_of_week
+        ORDER BY c.day_of_week
         """
-        return self._execute_query(query)
+        since = days_ago(365)
+        return self._execute_query(query, (since,), result_schema='get_weekly_appointment_patterns',
+                                   since=since)
     
     def get_monthly_appointment_trends(self):
         """Get monthly appointment trends"""
         query = """
         SELECT 
-            strftime('%Y-%m', a.appointment_date) as month,
-            COUNT(a.appointment_id) as appointments
-        FROM appointments a
-        WHERE a.appointment_date >= date('now', '-24 months')
-        GROUP BY strftime('%Y-%m', a.appointment_date)
-        ORDER BY month
+            c.month_label as month,
+            SUM(r.appointments) as appointments
+        FROM daily_rollup r
+        JOIN calendar c ON c.day = r.day
+        WHERE r.day >= ?
+        GROUP BY c.month_key
+        ORDER BY c.month_key
+        """
+        since = months_ago(24)
+        return self._execute_query(query, (since,), result_schema='get_monthly_appointment_trends', since=since)
+    
+    def get_unique_patients(self, start=None, end=None, filters=None):
+        """Distinct patients with appointments between two dates (inclusive, open-ended if None)
+        
+        Returns the count and its confidence margin, 0 when exact.
         """
-        return self._execute_query(query)
+        filter_sql, filter_params = self._filter_sql(filters)
+        start_day, end_day = [to_day_number(value) if value is not None else None for value in (start, end)]
+        if self._uses_sketches(filters):
+            query = f"""
+            SELECT {self._sketch_count('a.patients')} as value
+            FROM daily_patient_sketches a
+            WHERE (? IS NULL OR a.day >= ?) AND (? IS NULL OR a.day <= ?){filter_sql}
+            """
+        else:
+            query = f"""
+            SELECT {self._count_distinct('a.patient_id')} as value
+            FROM appointments a
+            WHERE (? IS NULL OR a.appointment_day >= ?) AND (? IS NULL OR a.appointment_day <= ?){filter_sql}
+            """
+        params = (start_day, start_day, end_day, end_day) + filter_params
+        count = int(self._execute_query(query, params, since=start_day, merge='kpi_distinct')['value'].iloc[0] or 0)
+        margin = int(margin_of_error(count)) if self._uses_sketches(filters) or self.partial else 0
+        return {'unique_patients': count, 'margin': margin}
+    
+    def get_unique_patient_trends(self, period='month', months=24, filters=None):
+        """Distinct patients seen per month, quarter or year over the last months"""
+        if period not in UNIQUE_PATIENT_PERIODS:
+            raise ValueError(f"Unknown period {period!r}; expected one of {list(UNIQUE_PATIENT_PERIODS)}")
+        filter_sql, filter_params = self._filter_sql(filters)
+        if self._uses_sketches(filters):
+            query = f"""
+            SELECT 
+                {UNIQUE_PATIENT_PERIODS[period]} as period,
+                {self._sketch_count('a.patients')} as unique_patients
+            FROM daily_patient_sketches a
+            JOIN calendar c ON c.day = a.day
+            WHERE a.day >= ?{filter_sql}
+            GROUP BY 1
+            ORDER BY 1
+            """
+        else:
+            query = f"""
+            SELECT 
+                {UNIQUE_PATIENT_PERIODS[period]} as period,
+                {self._count_distinct('a.patient_id')} as unique_patients
+            FROM appointments a
+            JOIN calendar c ON c.day = a.appointment_day
+            WHERE a.appointment_day >= ?{filter_sql}
+            GROUP BY 1
+            ORDER BY 1
+            """
+        since = months_ago(months)
+        result = self._execute_query(query, (since,) + filter_params, result_schema='get_unique_patient_trends',
+                                     since=since)
+        return self._with_margins(result, filters)
     
     def get_seasonal_appointment_analysis(self):
         """Get seasonal appointment analysis"""
         query = """
         SELECT 
-            CASE 
-                WHEN strftime('%m', a.appointment_date) IN ('12', '01', '02') THEN 'Winter'
-                WHEN strftime('%m', a.appointment_date) IN ('03', '04', '05') THEN 'Spring'
-                WHEN strftime('%m', a.appointment_date) IN ('06', '07', '08') THEN 'Summer'
-                WHEN strftime('%m', a.appointment_date) IN ('09', '10', '11') THEN 'Autumn'
-            END as season,
-            COUNT(a.appointment_id) as appointments
-        FROM appointments a
-        WHERE a.appointment_date >= date('now', '-365 days')
-        GROUP BY season
+            c.season,
+            SUM(r.appointments) as appointments
+        FROM daily_rollup r
+        JOIN calendar c ON c.day = r.day
+        WHERE r.day >= ?
+        GROUP BY c.season
         ORDER BY appointments DESC
         """
-        return self._execute_query(query)
+        since = days_ago(365)
+        return self._execute_query(query, (since,), result_schema='get_seasonal_appointment_analysis',
+                                   since=since)
     
     # Patient Behavior Analysis
-    def analyze_patient_behavior(self):
+    def analyze_patient_behavior(self, streaming=False):
         """Analyze patient behavior patterns"""
+        if streaming:
+            return self.summarize_patient_behavior()
         return {
             'visit_frequency': self.get_patient_visit_frequency(),
             'spending_patterns': self.get_patient_spending_patterns(),
@@ -335,27 +1428,34 @@ class AnalyticsEngine:
     
     def get_patient_visit_frequency(self):
         """Get patient visit frequency distribution"""
-        query = """
-        SELECT 
-            visit_counts.visit_count,
-            COUNT(*) as patient_count
-        FROM (
+        visits_query = f"""
             SELECT 
                 p.patient_id,
                 COUNT(a.appointment_id) as visit_count
             FROM patients p
             LEFT JOIN appointments a ON p.patient_id = a.patient_id
-            WHERE a.status = 'Completed'
+            WHERE a.status_code = {COMPLETED}
             GROUP BY p.patient_id
-        ) visit_counts
+        """
+        if self.partial:
+            # A patient's visits to every branch add up before patients are counted per visit count
+            visits = self._execute_query(visits_query, merge='patient_visits')
+            keys = [column for column in ('branch', 'visit_count') if column in visits.columns]
+            df = visits.groupby(keys, observed=True).size().reset_index(name='patient_count')
+            return self._apply_result_schema(df, 'get_patient_visit_frequency') if self.compact_results else df
+        query = f"""
+        SELECT 
+            visit_counts.visit_count,
+            COUNT(*) as patient_count
+        FROM ({visits_query}) visit_counts
         GROUP BY visit_counts.visit_count
         ORDER BY visit_counts.visit_count
         """
-        return self._execute_query(query)
+        return self._execute_query(query, result_schema='get_patient_visit_frequency')
     
     def get_patient_spending_patterns(self):
         """Get patient spending patterns"""
-        query = """
+        query = f"""
         SELECT 
             p.patient_id,
             p.name as patient_name,
@@ -365,82 +1465,272 @@ class AnalyticsEngine:
         FROM patients p
         JOIN appointments a ON p.patient_id = a.patient_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{self._scan_range()}
         GROUP BY p.patient_id, p.name
         ORDER BY total_spent DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, result_schema='get_patient_spending_patterns', split=True)
     
     def get_patient_segments(self):
         """Get patient segmentation by value"""
-        query = """
-        SELECT 
-            CASE 
-                WHEN total_spent >= 50000 THEN 'High Value'
-                WHEN total_spent >= 20000 THEN 'Medium Value'
-                ELSE 'Low Value'
-            END as segment,
-            COUNT(*) as count
-        FROM (
+        spending_query = f"""
             SELECT 
                 p.patient_id,
                 SUM(b.amount) as total_spent
             FROM patients p
             JOIN appointments a ON p.patient_id = a.patient_id
             JOIN billing b ON a.appointment_id = b.appointment_id
-            WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+            WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}
             GROUP BY p.patient_id
-        ) patient_spending
+        """
+        if self.partial:
+            # A patient is segmented on their spend at every branch together
+            spending = self._execute_query(spending_query, merge='patient_spending')
+            spending['segment'] = np.select(
+                [spending['total_spent'] >= HIGH_VALUE_THRESHOLD, spending['total_spent'] >= MEDIUM_VALUE_THRESHOLD],
+                ['High Value', 'Medium Value'],
+                'Low Value'
+            )
+            keys = [column for column in ('branch', 'segment') if column in spending.columns]
+            df = spending.groupby(keys, observed=True).size().reset_index(name='count')
+            df = df.sort_values('count', ascending=False, kind='stable').reset_index(drop=True)
+            return self._apply_result_schema(df, 'get_patient_segments') if self.compact_results else df
+        query = f"""
+        SELECT 
+            CASE 
+                WHEN total_spent >= {HIGH_VALUE_THRESHOLD} THEN 'High Value'
+                WHEN total_spent >= {MEDIUM_VALUE_THRESHOLD} THEN 'Medium Value'
+                ELSE 'Low Value'
+            END as segment,
+            COUNT(*) as count
+        FROM ({spending_query}) patient_spending
         GROUP BY segment
         ORDER BY count DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, result_schema='get_patient_segments')
     
-    def get_service_preferences(self):
-        """Get patient service preferences"""
-        query = """
+    def _iter_query_chunks(self, query, params=None, chunksize=50000):
+        """Yield a query result in DataFrame chunks read from a single cursor
+        
+        With branches, each branch is streamed in turn, so a patient seen at
+        several branches appears once per branch.
+        """
+        engines = ([AnalyticsEngine(db_path, date_range=self.date_range) for db_path in self.branches.values()]
+                   if self.branches else [self])
+        for engine in engines:
+            conn = engine._get_connection()
+            try:
+                for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize):
+                    yield chunk
+            finally:
+                conn.close()
+    
+    def summarize_patient_behavior(self, chunksize=50000, top_k=100, spend_bin_width=5000):
+        """Stream per-patient totals and keep only the summaries the charts need
+        
+        Memory is bounded by the chunk size, top_k and the number of distinct
+        visit counts, regardless of how many patients there are; except when
+        the year partitions are read in batches, whose per-patient totals
+        are merged whole first.
+        """
+        query = f"""
         SELECT 
-            s.name as service_name,
-            COUNT(a.appointment_id) as preference_score
-        FROM appointments a
-        JOIN services s ON a.service_id = s.service_id
-        WHERE a.status = 'Completed'
-        GROUP BY s.service_id, s.name
-        ORDER BY preference_score DESC
-        LIMIT 15
+            p.patient_id,
+            p.name as patient_name,
+            COUNT(DISTINCT a.appointment_id) as completed_visits,
+            COUNT(b.billing_id) as total_visits,
+            COALESCE(SUM(b.amount), 0) as total_spent
+        FROM patients p
+        JOIN appointments a ON p.patient_id = a.patient_id
+        LEFT JOIN billing b ON a.appointment_id = b.appointment_id AND b.payment_status_code = {PAID}
+        WHERE a.status_code = {COMPLETED}
+        GROUP BY p.patient_id, p.name
         """
-        return self._execute_query(query)
+        visit_counts = pd.Series(dtype='int64')
+        segment_counts = pd.Series(dtype='int64')
+        density = None
+        by_visits = None
+        top_spenders = None
+        
+        if self.batches_partitions:
+            totals = self._execute_query(query, merge='patient_behavior')
+            chunks = (totals.iloc[start:start + chunksize] for start in range(0, len(totals), chunksize))
+        else:
+            chunks = self._iter_query_chunks(query, chunksize=chunksize)
+        for chunk in chunks:
+            visit_counts = visit_counts.add(chunk['completed_visits'].value_counts(), fill_value=0)
+            
+            paying = chunk[chunk['total_visits'] > 0]
+            segments = pd.Series(np.select(
+                [paying['total_spent'] >= HIGH_VALUE_THRESHOLD, paying['total_spent'] >= MEDIUM_VALUE_THRESHOLD],
+                ['High Value', 'Medium Value'],
+                'Low Value'
+            ))
+            segment_counts = segment_counts.add(segments.value_counts(), fill_value=0)
+            
+            spend_bins = ((paying['total_spent'] // spend_bin_width) * spend_bin_width + spend_bin_width / 2).rename('spend_bin')
+            partial_density = paying.groupby([paying['total_visits'], spend_bins]).size()
+            density = partial_density if density is None else density.add(partial_density, fill_value=0)
+            
+            partial = paying.groupby('total_visits')['total_spent'].agg(['size', 'sum', 'min', 'max'])
+            by_visits = partial if by_visits is None else pd.concat([by_visits, partial]).groupby(level=0).agg(
+                {'size': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+            )
+            
+            candidates = paying if top_spenders is None else pd.concat([top_spenders, paying])
+            top_spenders = candidates.nlargest(top_k, 'total_spent')
+        
+        visit_frequency = visit_counts.astype('int64').rename_axis('visit_count').reset_index(name='patient_count')
+        patient_segments = segment_counts.astype('int64').rename_axis('segment').reset_index(name='count')
+        patient_segments = patient_segments.sort_values('count', ascending=False, kind='stable')
+        
+        if by_visits is None:
+            by_visits = pd.DataFrame(columns=['size', 'sum', 'min', 'max'])
+        spending_by_visits = by_visits.rename(columns={
+            'size': 'patients', 'sum': 'total_spent', 'min': 'min_spent', 'max': 'max_spent'
+        }).rename_axis('total_visits').reset_index()
+        spending_by_visits['avg_spent'] = spending_by_visits['total_spent'] / spending_by_visits['patients']
+        
+        if top_spenders is None:
+            top_spenders = pd.DataFrame(columns=['patient_id', 'patient_name', 'total_visits', 'total_spent'])
+        top_spenders = top_spenders[['patient_id', 'patient_name', 'total_visits', 'total_spent']].copy()
+        top_spenders['avg_spend_per_visit'] = top_spenders['total_spent'] / top_spenders['total_visits']
+        
+        if density is None:
+            density = pd.Series(dtype='int64', index=pd.MultiIndex.from_arrays([[], []], names=['total_visits', 'spend_bin']))
+        spending_density = density.astype('int64').reset_index(name='patients')
+        
+        return {
+            'visit_frequency': visit_frequency.sort_values('visit_count').reset_index(drop=True),
+            'patient_segments': patient_segments.reset_index(drop=True),
+            'spending_by_visits': spending_by_visits,
+            'spending_density': spending_density,
+            'top_spenders': top_spenders.reset_index(drop=True)
+        }
+    
+    def get_service_preferences(self, filters=None):
+        """Get patient service preferences"""
+        if self.use_cube:
+            return self._query_cube('get_service_preferences', filters)
+        top_services = self.get_top_services(k=15, filters=filters)
+        columns = [column for column in ('branch', 'service_name', 'appointment_count') if column in top_services.columns]
+        return top_services[columns].rename(columns={'appointment_count': 'preference_score'})
     
     # Billing & Revenue Analysis
-    def analyze_revenue(self):
+    def analyze_revenue(self, filters=None):
         """Analyze revenue patterns"""
         return {
-            'monthly_trends': self.get_monthly_revenue_trends(),
-            'department_revenue': self.get_revenue_by_department(),
-            'service_type_revenue': self.get_revenue_by_service_type()
+            'monthly_trends': self.get_monthly_revenue_trends(filters),
+            'department_revenue': self.get_revenue_by_department(filters),
+            'service_type_revenue': self.get_revenue_by_service_type(filters),
+            'payment_method_revenue': self.get_revenue_by_payment_method(filters)
         }
     
-    def get_monthly_revenue_trends(self):
+    def get_monthly_revenue_trends(self, filters=None):
         """Get monthly revenue trends"""
-        query = """
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
-            strftime('%Y-%m', b.payment_date) as month,
+            c.month_label as month,
             SUM(b.amount) as revenue,
-            COUNT(DISTINCT a.patient_id) as unique_patients,
+            {self._count_distinct('a.patient_id')} as unique_patients,
             COUNT(a.appointment_id) as appointments
         FROM billing b
         JOIN appointments a ON b.appointment_id = a.appointment_id
-        WHERE a.status = 'Completed' 
-        AND b.payment_status = 'Paid'
-        AND b.payment_date >= date('now', '-24 months')
-        GROUP BY strftime('%Y-%m', b.payment_date)
-        ORDER BY month
+        JOIN calendar c ON c.day = b.payment_day
+        WHERE a.status_code = {COMPLETED} 
+        AND b.payment_status_code = {PAID}
+        AND b.payment_day >= ?{filter_sql}
+        GROUP BY c.month_key
+        ORDER BY c.month_key
+        """
+        since = months_ago(24)
+        if self._uses_sketches(filters):
+            # Unique patients per payment month merged from the sketches, which
+            # are kept at month grain, so like the cube the window starts on the
+            # first of the month
+            since = to_day_number(from_day_number(since).replace(day=1))
+            query = f"""
+            WITH revenue AS (
+                SELECT 
+                    c.month_key,
+                    c.month_label as month,
+                    SUM(b.amount) as revenue,
+                    COUNT(a.appointment_id) as appointments
+                FROM billing b
+                JOIN appointments a ON b.appointment_id = a.appointment_id
+                JOIN calendar c ON c.day = b.payment_day
+                WHERE a.status_code = {COMPLETED} 
+                AND b.payment_status_code = {PAID}
+                AND b.payment_day >= ?{filter_sql}
+                GROUP BY c.month_key
+            ),
+            patients AS (
+                SELECT 
+                    a.payment_month,
+                    {self._sketch_count('a.paying_patients')} as unique_patients
+                FROM daily_patient_sketches a
+                WHERE a.payment_month >= (SELECT month_key FROM calendar WHERE day = ?){filter_sql}
+                GROUP BY a.payment_month
+            )
+            SELECT r.month, r.revenue, p.unique_patients, r.appointments
+            FROM revenue r
+            LEFT JOIN patients p ON p.payment_month = r.month_key
+            ORDER BY r.month_key
+            """
+            filter_params = filter_params + (since,) + filter_params
+        result = self._execute_query(query, (since,) + filter_params, result_schema='get_monthly_revenue_trends',
+                                     since=since)
+        return self._with_margins(result, filters)
+    
+    def get_monthly_growth(self, months=24, filters=None):
+        """Paid revenue and appointments per payment month with month-over-month and year-over-year changes
+        
+        Months without payments are filled with zeros from the calendar; the
+        _mom_pct and _yoy_pct columns are NaN where the earlier month is empty.
+        """
+        filter_sql, filter_params = self._filter_sql(filters)
+        # Twelve more months are read so the first month shown has its year-over-year change
+        since = to_day_number(from_day_number(months_ago(months + 12)).replace(day=1))
+        query = f"""
+        SELECT 
+            c.month_label as month,
+            TOTAL(m.revenue) as revenue,
+            CAST(TOTAL(m.appointments) AS INTEGER) as appointments
+        FROM (
+            SELECT DISTINCT month_key, month_label FROM calendar WHERE day BETWEEN ? AND ?
+        ) c
+        LEFT JOIN (
+            SELECT 
+                pc.month_key,
+                SUM(b.amount) as revenue,
+                COUNT(a.appointment_id) as appointments
+            FROM billing b
+            JOIN appointments a ON b.appointment_id = a.appointment_id
+            JOIN calendar pc ON pc.day = b.payment_day
+            WHERE a.status_code = {COMPLETED}
+            AND b.payment_status_code = {PAID}
+            AND b.payment_day >= ?{filter_sql}
+            GROUP BY pc.month_key
+        ) m ON m.month_key = c.month_key
+        GROUP BY c.month_key
+        ORDER BY c.month_key
         """
-        return self._execute_query(query)
+        params = (since, days_ago(0), since) + filter_params
+        result = self._execute_query(query, params, result_schema='get_monthly_growth', since=since)
+        for column in ('revenue', 'appointments'):
+            for label, periods in (('mom', 1), ('yoy', 12)):
+                result[f'{column}_{label}_pct'] = self._per_series(result, column,
+                                                                   lambda values: percent_change(values, periods))
+        first_month = from_day_number(months_ago(months)).strftime('%Y-%m')
+        return result[result['month'] >= first_month].reset_index(drop=True)
     
-    def get_revenue_by_department(self):
+    def get_revenue_by_department(self, filters=None):
         """Get revenue by department"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_revenue_by_department', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             d.name as department_name,
             SUM(b.amount) as total_revenue,
@@ -450,15 +1740,18 @@ class AnalyticsEngine:
         JOIN services s ON a.service_id = s.service_id
         JOIN departments d ON s.department_id = d.department_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
         GROUP BY d.department_id, d.name
         ORDER BY total_revenue DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_revenue_by_department')
     
-    def get_revenue_by_service_type(self):
+    def get_revenue_by_service_type(self, filters=None):
         """Get revenue by service type"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_revenue_by_service_type', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             s.type as service_type,
             SUM(b.amount) as revenue,
@@ -466,15 +1759,103 @@ class AnalyticsEngine:
         FROM appointments a
         JOIN services s ON a.service_id = s.service_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
         GROUP BY s.type
         ORDER BY revenue DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_revenue_by_service_type')
+    
+    def get_revenue_by_payment_method(self, filters=None):
+        """Get revenue by payment method"""
+        if self.use_cube:
+            return self._query_cube('get_revenue_by_payment_method', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
+        SELECT 
+            b.payment_method,
+            SUM(b.amount) as revenue,
+            COUNT(a.appointment_id) as appointment_count
+        FROM appointments a
+        JOIN billing b ON a.appointment_id = b.appointment_id
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}
+        GROUP BY b.payment_method_code
+        ORDER BY revenue DESC
+        """
+        return self._execute_query(query, filter_params, result_schema='get_revenue_by_payment_method')
+    
+    def get_bill_amount_percentiles(self, start=None, end=None, filters=None, quantiles=QUANTILES):
+        """Bill amount percentiles per service for appointments between two dates (inclusive, open-ended if None)
+        
+        Merged from the per-day bill amount digests; filters other than
+        service filters digest the matching bills instead.
+        """
+        filter_sql, filter_params = self._filter_sql(filters)
+        if self._only_filters(filters, SKETCH_FILTERS):
+            query = f"""
+            SELECT 
+                s.name as service_name,
+                tdigest_union(a.amounts) as amounts
+            FROM daily_amount_digests a
+            JOIN services s ON a.service_id = s.service_id
+            WHERE (? IS NULL OR a.day >= ?) AND (? IS NULL OR a.day <= ?){filter_sql}
+            GROUP BY s.service_id, s.name
+            """
+        else:
+            query = f"""
+            SELECT 
+                s.name as service_name,
+                tdigest_sketch(b.amount) as amounts
+            FROM appointments a
+            JOIN services s ON a.service_id = s.service_id
+            JOIN billing b ON a.appointment_id = b.appointment_id
+            WHERE (? IS NULL OR a.appointment_day >= ?) AND (? IS NULL OR a.appointment_day <= ?){filter_sql}
+            GROUP BY s.service_id, s.name
+            """
+        start_day, end_day = [to_day_number(value) if value is not None else None for value in (start, end)]
+        params = (start_day, start_day, end_day, end_day) + filter_params
+        result = self._execute_query(query, params, since=start_day, merge='get_bill_amount_percentiles')
+        result = self._with_quantiles(result, 'amounts', 'bills', quantiles)
+        return self._apply_result_schema(result, 'get_bill_amount_percentiles') if self.compact_results else result
+    
+    def get_payment_lag_percentiles(self, start=None, end=None, filters=None, quantiles=QUANTILES):
+        """Percentiles of the days from appointment to payment of paid bills per payment method
+        
+        Covers appointments between two dates (inclusive, open-ended if None).
+        Merged from the per-day payment lag digests when unfiltered.
+        """
+        filter_sql, filter_params = self._filter_sql(filters)
+        if not filter_sql:
+            query = f"""
+            SELECT 
+                {decode_sql('a.payment_method_code', PAYMENT_METHODS)} as payment_method,
+                tdigest_union(a.payment_lags) as payment_lags
+            FROM daily_payment_lag_digests a
+            WHERE (? IS NULL OR a.day >= ?) AND (? IS NULL OR a.day <= ?)
+            GROUP BY a.payment_method_code
+            """
+        else:
+            query = f"""
+            SELECT 
+                b.payment_method,
+                tdigest_sketch(b.payment_day - a.appointment_day) as payment_lags
+            FROM appointments a
+            JOIN billing b ON a.appointment_id = b.appointment_id
+            WHERE b.payment_status_code = {PAID}
+            AND (? IS NULL OR a.appointment_day >= ?) AND (? IS NULL OR a.appointment_day <= ?){filter_sql}
+            GROUP BY b.payment_method_code
+            """
+        start_day, end_day = [to_day_number(value) if value is not None else None for value in (start, end)]
+        params = (start_day, start_day, end_day, end_day) + filter_params
+        result = self._execute_query(query, params, since=start_day, merge='get_payment_lag_percentiles')
+        result = self._with_quantiles(result, 'payment_lags', 'payments', quantiles)
+        return self._apply_result_schema(result, 'get_payment_lag_percentiles') if self.compact_results else result
     
-    def get_revenue_per_doctor(self):
+    def get_revenue_per_doctor(self, filters=None):
         """Get revenue per doctor"""
-        query = """
+        if self.use_cube:
+            return self._query_cube('get_revenue_per_doctor', filters)
+        filter_sql, filter_params = self._filter_sql(filters)
+        query = f"""
         SELECT 
             d.name as doctor_name,
             d.specialization,
@@ -484,8 +1865,8 @@ class AnalyticsEngine:
         FROM appointments a
         JOIN doctors d ON a.doctor_id = d.doctor_id
         JOIN billing b ON a.appointment_id = b.appointment_id
-        WHERE a.status = 'Completed' AND b.payment_status = 'Paid'
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{filter_sql}{self._scan_range()}
         GROUP BY d.doctor_id, d.name, d.specialization
         ORDER BY total_revenue DESC
         """
-        return self._execute_query(query)
+        return self._execute_query(query, filter_params, result_schema='get_revenue_per_doctor', split=True)
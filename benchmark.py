@@ -0,0 +1,398 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+import pandas as pd
+import numpy as np
+from data_generator import generate_sample_data
+from analytics_engine import AnalyticsEngine, FILTER_CONDITIONS, QUANTILES, ROLLING_WINDOWS, rolling_mean
+from schema import PAID, refresh_daily_rollup
+import visualization_utils
+
+# Engine methods that make up the dashboard workload, in page order
+WORKLOAD = [
+    # Dashboard Overview
+    'get_total_patients',
+    'get_total_revenue',
+    'get_total_appointments',
+    'get_revenue_trend',
+    'get_service_utilization',
+    # Most Utilized Services
+    'analyze_service_utilization',
+    'get_revenue_by_service',
+    'get_service_trends',
+    'get_department_service_distribution',
+    # Doctor Performance
+    'analyze_doctor_performance',
+    'get_doctor_performance_metrics',
+    'get_doctor_revenue_trends',
+    'get_department_doctor_performance',
+    # Patient Trends
+    'get_daily_appointment_trends',
+    'get_weekly_appointment_patterns',
+    'get_monthly_appointment_trends',
+    'get_seasonal_appointment_analysis',
+    # Patient Behavior
+    'get_patient_visit_frequency',
+    'get_patient_spending_patterns',
+    'get_patient_segments',
+    'get_service_preferences',
+    # Billing & Revenue
+    'get_monthly_revenue_trends',
+    'get_revenue_by_department',
+    'get_revenue_by_service_type',
+    'get_revenue_per_doctor'
+]
+
+# Methods whose scans the engine splits by appointment id over its workers
+PARALLEL_METHODS = ['get_revenue_per_doctor', 'get_patient_spending_patterns', 'get_department_service_distribution']
+
+# Methods each cross-filtered dashboard page calls again when a filter changes
+FILTERED_PAGES = {
+    'Most Utilized Services': ['analyze_service_utilization', 'get_revenue_by_service', 'get_service_trends',
+                               'get_department_service_distribution'],
+    'Doctor Performance': ['analyze_doctor_performance', 'get_doctor_performance_metrics',
+                           'get_doctor_revenue_trends', 'get_department_doctor_performance'],
+    'Billing & Revenue': ['analyze_revenue', 'get_revenue_per_doctor', 'get_monthly_growth',
+                          'get_bill_amount_percentiles', 'get_payment_lag_percentiles']
+}
+
+BENCHMARK_DB = 'benchmark_data.db'
+
+# Pages of the Streamlit dashboard, as listed in the main.py sidebar
+DASHBOARD_MODULES = [
+    "Dashboard Overview", "Most Utilized Services", "Doctor Performance",
+    "Patient Trends", "Patient Behavior", "Billing & Revenue"
+]
+
+def build_benchmark_database(db_path=BENCHMARK_DB, num_patients=20000, days=730,
+                             appointments_per_day=(400, 600)):
+    """Generate a large sample database for benchmarking"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    generate_sample_data(db_path, num_patients, days, appointments_per_day)
+    return db_path
+
+def shard_database(db_path, branches=4):
+    """Split a database into branch databases, returning the {name: path} AnalyticsEngine takes
+    
+    Every branch keeps all patients, doctors and services but only its share
+    of the appointments (by appointment id) and their billing, so merged
+    branch results can be checked against the unsplit database.
+    """
+    root, extension = os.path.splitext(db_path)
+    shards = {}
+    for branch in range(branches):
+        path = f"{root}_branch{branch + 1}{extension}"
+        shutil.copy(db_path, path)
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute("""
+                DELETE FROM billing WHERE appointment_id IN (
+                    SELECT appointment_id FROM appointments WHERE appointment_id % ? != ?)
+            """, (branches, branch))
+            conn.execute("DELETE FROM appointments WHERE appointment_id % ? != ?", (branches, branch))
+            refresh_daily_rollup(conn.cursor())
+        conn.execute('VACUUM')
+        conn.close()
+        shards[f"Branch {branch + 1}"] = path
+    return shards
+
+def run_workload(engine, methods=WORKLOAD):
+    """Call every workload method once on the engine"""
+    for method in methods:
+        getattr(engine, method)()
+
+def time_workload(engine, methods=WORKLOAD, repeat=3):
+    """Time each workload method and return the median seconds per method"""
+    rows = []
+    for method in methods:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            getattr(engine, method)()
+            timings.append(time.perf_counter() - start)
+        rows.append({'method': method, 'seconds': float(np.median(timings))})
+    return pd.DataFrame(rows)
+
+def parallel_report(db_path, workers=(1, 2, 4, 8), repeat=3, methods=PARALLEL_METHODS):
+    """Seconds and speedup over the serial engine of the split scans at each worker count
+    
+    Also checks that the merged results match the serial ones (up to float
+    rounding and the order of ties).
+    """
+    serial_engine = AnalyticsEngine(db_path, workers=1)
+    serial = time_workload(serial_engine, methods, repeat).set_index('method')['seconds']
+    expected = {method: getattr(serial_engine, method)() for method in methods}
+    rows = []
+    for count in workers:
+        engine = AnalyticsEngine(db_path, workers=count)
+        # Start the worker processes outside the timings
+        getattr(engine, methods[0])()
+        timings = time_workload(engine, methods, repeat).set_index('method')['seconds']
+        for method in methods:
+            result, reference = getattr(engine, method)(), expected[method]
+            keys = [column for column in reference.columns if reference[column].dtype.kind not in 'fc']
+            result, reference = (frame.sort_values(keys, ignore_index=True) for frame in (result, reference))
+            rows.append({
+                'method': method,
+                'workers': count,
+                'seconds': timings[method],
+                'speedup': round(serial[method] / timings[method], 2),
+                'matches': len(result) == len(reference) and all(
+                    np.allclose(result[column].astype(float), reference[column].astype(float), rtol=1e-9)
+                    if reference[column].dtype.kind in 'fc' else
+                    (result[column].astype(str) == reference[column].astype(str)).all()
+                    for column in reference.columns)
+            })
+    return pd.DataFrame(rows)
+
+# Percentile methods checked against exact quantiles of the raw rows: result
+# key column and the (key, value) query the exact quantiles are taken from
+QUANTILE_CHECKS = {
+    'get_bill_amount_percentiles': ('service_name', """
+        SELECT s.name as service_name, b.amount as value
+        FROM appointments a
+        JOIN services s ON a.service_id = s.service_id
+        JOIN billing b ON a.appointment_id = b.appointment_id
+    """),
+    'get_payment_lag_percentiles': ('payment_method', f"""
+        SELECT b.payment_method, b.payment_day - a.appointment_day as value
+        FROM appointments a
+        JOIN billing b ON a.appointment_id = b.appointment_id
+        WHERE b.payment_status_code = {PAID}
+    """)
+}
+
+def quantile_report(db_path, quantiles=QUANTILES, repeat=3):
+    """Accuracy and seconds of the digest percentiles against numpy quantiles of the raw rows
+    
+    The rank error is how far the ranks of the raw value nearest the
+    estimate fall from the quantile asked for (0 when a run of tied values
+    spans it), which stays meaningful for discrete values like lags.
+    """
+    engine = AnalyticsEngine(db_path)
+    conn = sqlite3.connect(db_path)
+    rows = []
+    try:
+        for method, (key, query) in QUANTILE_CHECKS.items():
+            digest_seconds = time_workload(engine, [method], repeat)['seconds'].iloc[0]
+            start = time.perf_counter()
+            raw = pd.read_sql_query(query, conn)
+            exact = {name: np.quantile(group['value'], quantiles) for name, group in raw.groupby(key)}
+            exact_seconds = time.perf_counter() - start
+            values = {name: np.sort(group['value'].to_numpy()) for name, group in raw.groupby(key)}
+            result = getattr(engine, method)(quantiles=quantiles).set_index(key)
+            for q in quantiles:
+                column = f'p{q * 100:g}'
+                estimates = result[column]
+                relative, rank = [], []
+                for name, estimate in estimates.items():
+                    sorted_values = values[name]
+                    nearest = sorted_values[np.argmin(np.abs(sorted_values - estimate))]
+                    below = np.searchsorted(sorted_values, nearest, 'left') / len(sorted_values)
+                    at_or_below = np.searchsorted(sorted_values, nearest, 'right') / len(sorted_values)
+                    rank.append(max(0, below - q, q - at_or_below))
+                    relative.append(abs(estimate - exact[name][quantiles.index(q)]) /
+                                    max(abs(exact[name][quantiles.index(q)]), 1))
+                rows.append({
+                    'method': method,
+                    'quantile': column,
+                    'groups': len(estimates),
+                    'max_relative_error': round(max(relative), 5),
+                    'max_rank_error': round(max(rank), 5),
+                    'digest_seconds': round(digest_seconds, 4),
+                    'exact_seconds': round(exact_seconds, 4)
+                })
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+def rolling_report(years=(1, 3, 10, 30), windows=ROLLING_WINDOWS, repeat=3, naive_limit=3):
+    """Seconds to add trailing moving averages to synthetic daily series of several years
+    
+    Compares the engine's prefix sums with SQLite window functions and with
+    re-aggregating every window (only up to naive_limit years, as it grows
+    with the window length), and checks they agree.
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for length in years:
+        days = 365 * length
+        values = rng.poisson(500, days).astype(np.float64)
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE series (day INTEGER PRIMARY KEY, value REAL)')
+        conn.executemany('INSERT INTO series VALUES (?, ?)', enumerate(values.tolist()))
+        window_sql = ', '.join(f"AVG(value) OVER (ORDER BY day ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW)"
+                               for window in windows)
+        methods = {
+            'prefix_sum': lambda: np.column_stack([rolling_mean(values, window) for window in windows]),
+            'sql_window': lambda: np.array(conn.execute(f'SELECT {window_sql} FROM series ORDER BY day').fetchall())
+        }
+        if length <= naive_limit:
+            methods['per_window'] = lambda: np.column_stack([
+                [values[max(0, end - window):end].mean() for end in range(1, days + 1)] for window in windows])
+        expected = methods['prefix_sum']()
+        for method, function in methods.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = function()
+                timings.append(time.perf_counter() - start)
+            rows.append({
+                'years': length,
+                'days': days,
+                'method': method,
+                'seconds': round(float(np.median(timings)), 5),
+                'matches': bool(np.allclose(result, expected))
+            })
+        conn.close()
+    return pd.DataFrame(rows)
+
+def filter_report(db_path, use_cube=True, repeat=3, pages=FILTERED_PAGES):
+    """Seconds each cross-filtered page takes to recompute, unfiltered and under the first value of each filter
+    
+    The engine runs as the dashboard does (with the cube by default, built
+    before timing starts since it is only rebuilt when the data changes).
+    """
+    engine = AnalyticsEngine(db_path, use_cube=use_cube)
+    if use_cube:
+        engine.get_cube()
+    cases = [('none', None)] + [(dimension, {dimension: engine.get_filter_options(dimension)[0]})
+                                for dimension in FILTER_CONDITIONS]
+    rows = []
+    for page, methods in pages.items():
+        for dimension, filters in cases:
+            timings = {}
+            for method in methods:
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    getattr(engine, method)(filters=filters)
+                    seconds.append(time.perf_counter() - start)
+                timings[method] = float(np.median(seconds))
+            slowest = max(timings, key=timings.get)
+            rows.append({
+                'page': page,
+                'filter': dimension,
+                'seconds': round(sum(timings.values()), 3),
+                'slowest_method': slowest,
+                'slowest_seconds': round(timings[slowest], 3)
+            })
+    return pd.DataFrame(rows)
+
+def storage_report(db_path):
+    """Bytes, pages and rows used by each table and index (via the dbstat virtual table)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        sizes = pd.read_sql_query("""
+            SELECT name, SUM(pgsize) as bytes, COUNT(*) as pages
+            FROM dbstat
+            GROUP BY name
+            ORDER BY bytes DESC
+        """, conn)
+        sizes['rows'] = [
+            conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+            if conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone() == ('table',)
+            else None
+            for name in sizes['name']
+        ]
+        return sizes
+    finally:
+        conn.close()
+
+def payload_report(app_path='main.py', compact=True, modules=DASHBOARD_MODULES):
+    """Chart bytes sent to the browser by each dashboard module
+    
+    Runs the app headless with Streamlit's AppTest against the app's own
+    database and sums the serialized Plotly specs on each page.
+    """
+    from streamlit.testing.v1 import AppTest
+    visualization_utils.FIGURE_CACHE.compact = compact
+    rows = []
+    for module in modules:
+        visualization_utils.FIGURE_CACHE.clear()
+        app = AppTest.from_file(app_path, default_timeout=300)
+        app.run()
+        app.sidebar.selectbox[0].select(module).run()
+        specs = [chart.proto.spec for chart in app.get('plotly_chart')]
+        rows.append({
+            'module': module,
+            'charts': len(specs),
+            'bytes': sum(len(spec.encode()) for spec in specs),
+            'errors': len(app.exception)
+        })
+    visualization_utils.FIGURE_CACHE.compact = True
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the analytics engine workload")
+    parser.add_argument('--db', default=BENCHMARK_DB, help="Database to benchmark")
+    parser.add_argument('--build', action='store_true', help="Regenerate the benchmark database first")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cube', action='store_true',
+                        help="Answer the additive group-bys from the in-memory OLAP cube")
+    parser.add_argument('--storage', action='store_true', help="Also report table and index sizes")
+    parser.add_argument('--branches', type=int,
+                        help="Split the database into this many branch databases and time the merged workload")
+    parser.add_argument('--workers', type=int,
+                        help="Processes running the branches (default: one per branch, up to the CPU count)")
+    parser.add_argument('--parallel', action='store_true',
+                        help="Only report speedup of the scans split over 1, 2, 4 and 8 worker processes")
+    parser.add_argument('--quantiles', action='store_true',
+                        help="Only report digest percentile accuracy against exact numpy quantiles")
+    parser.add_argument('--rolling', action='store_true',
+                        help="Only report moving average seconds over synthetic multi-year daily series")
+    parser.add_argument('--filters', action='store_true',
+                        help="Only report seconds per cross-filter change of the filtered pages")
+    parser.add_argument('--payload', action='store_true',
+                        help="Only report chart bytes per dashboard module, raw vs compacted")
+    args = parser.parse_args()
+    
+    if args.payload:
+        raw = payload_report(compact=False)
+        compacted = payload_report(compact=True)
+        report = raw[['module', 'charts', 'errors']].assign(
+            raw_bytes=raw['bytes'], compact_bytes=compacted['bytes'],
+            saved_pct=(100 * (1 - compacted['bytes'] / raw['bytes'].where(raw['bytes'] > 0))).round(1)
+        )
+        print(report.to_string(index=False))
+        raise SystemExit
+    
+    if args.rolling:
+        print(rolling_report(repeat=args.repeat).to_string(index=False))
+        raise SystemExit
+    
+    if args.build or not os.path.exists(args.db):
+        print(f"Building benchmark database {args.db}...")
+        build_benchmark_database(args.db)
+    
+    if args.quantiles:
+        print(quantile_report(args.db, repeat=args.repeat).to_string(index=False))
+        raise SystemExit
+    
+    if args.filters:
+        print(filter_report(args.db, use_cube=args.cube, repeat=args.repeat).to_string(index=False))
+        raise SystemExit
+    
+    if args.parallel:
+        print(f"{os.cpu_count()} CPUs")
+        print(parallel_report(args.db, repeat=args.repeat).to_string(index=False))
+        raise SystemExit
+    
+    branches = shard_database(args.db, args.branches) if args.branches else None
+    engine = AnalyticsEngine(args.db, use_cube=args.cube, branches=branches, workers=args.workers)
+    if branches:
+        print(f"{len(branches)} branches on {engine.workers} worker processes")
+    elif args.cube:
+        start = time.perf_counter()
+        cube = engine.get_cube()
+        print(f"Cube build: {time.perf_counter() - start:.3f}s, {len(cube.cells):,} cells, "
+              f"{cube.nbytes / 1024:,.1f} KB")
+    results = time_workload(engine, repeat=args.repeat)
+    print(results.to_string(index=False))
+    print(f"Total: {results['seconds'].sum():.3f}s")
+    
+    if args.storage:
+        print(storage_report(args.db).to_string(index=False))
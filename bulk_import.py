@@ -0,0 +1,304 @@
+import argparse
+import glob
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from schema import (APPOINTMENT_STATUSES, PAYMENT_METHODS, PAYMENT_STATUSES, create_kpi_counters, ensure_calendar,
+                    migrate, refresh_daily_rollup, refresh_kpi_counters)
+from data_generator import create_tables
+from partitions import kpi_counter_values
+
+# Parquet support is optional
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = pq = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Rows parsed, converted and committed per transaction
+CHUNK_SIZE = 100000
+
+# Columns of each HMS export, in load order: export column, stored column,
+# conversion (a kind or a dictionary of codes) and whether every row needs it
+IMPORT_TABLES = {
+    'departments': [
+        ('department_id', 'department_id', 'integer', True),
+        ('name', 'name', 'text', True),
+        ('location', 'location', 'text', False)
+    ],
+    'doctors': [
+        ('doctor_id', 'doctor_id', 'integer', True),
+        ('name', 'name', 'text', True),
+        ('specialization', 'specialization', 'text', False),
+        ('department_id', 'department_id', 'integer', False),
+        ('hire_date', 'hire_date', 'date_text', False),
+        ('salary', 'salary', 'real', False)
+    ],
+    'services': [
+        ('service_id', 'service_id', 'integer', True),
+        ('name', 'name', 'text', True),
+        ('type', 'type', 'text', False),
+        ('department_id', 'department_id', 'integer', False),
+        ('cost', 'cost', 'real', False),
+        ('duration_minutes', 'duration_minutes', 'integer', False)
+    ],
+    'patients': [
+        ('patient_id', 'patient_id', 'integer', True),
+        ('name', 'name', 'text', True),
+        ('age', 'age', 'integer', False),
+        ('gender', 'gender', 'text', False),
+        ('contact', 'contact', 'text', False),
+        ('address', 'address', 'text', False),
+        ('registration_date', 'registration_date', 'date_text', False),
+        ('emergency_contact', 'emergency_contact', 'text', False)
+    ],
+    'appointments': [
+        ('appointment_id', 'appointment_id', 'integer', True),
+        ('patient_id', 'patient_id', 'integer', True),
+        ('doctor_id', 'doctor_id', 'integer', True),
+        ('service_id', 'service_id', 'integer', True),
+        ('appointment_date', 'appointment_day', 'day', True),
+        ('appointment_time', 'appointment_minute', 'minute', False),
+        ('appointment_time', 'appointment_second', 'second', False),
+        ('status', 'status_code', APPOINTMENT_STATUSES, True),
+        ('notes', 'notes', 'text', False)
+    ],
+    'billing': [
+        ('billing_id', 'billing_id', 'integer', True),
+        ('appointment_id', 'appointment_id', 'integer', True),
+        ('amount', 'amount', 'real', True),
+        ('payment_date', 'payment_day', 'day', False),
+        ('payment_status', 'payment_status_code', PAYMENT_STATUSES, True),
+        ('payment_method', 'payment_method_code', PAYMENT_METHODS, True)
+    ]
+}
+
+# Conversions
+def _dates(values):
+    return pd.to_datetime(values, errors='coerce', format='ISO8601')
+
+def _minutes(values):
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_numeric(values, errors='coerce')
+    parts = values.astype('string').str.split(':', n=2, expand=True)
+    if parts.shape[1] < 2:
+        return pd.Series(np.nan, index=values.index)
+    return pd.to_numeric(parts[0], errors='coerce') * 60 + pd.to_numeric(parts[1], errors='coerce')
+
+def _seconds(values):
+    on_the_minute = pd.Series(0.0, index=values.index).where(values.notna())
+    if pd.api.types.is_numeric_dtype(values):
+        return on_the_minute
+    parts = values.astype('string').str.split(':', n=2, expand=True)
+    if parts.shape[1] < 3:
+        return on_the_minute
+    return pd.to_numeric(parts[2], errors='coerce').astype(float).where(parts[2].notna(), on_the_minute)
+
+def _convert(values, kind):
+    """Convert one export column; values that cannot be converted become NA"""
+    if isinstance(kind, dict):
+        return values.map(kind).astype('Int64')
+    if kind == 'integer':
+        return pd.to_numeric(values, errors='coerce').round().astype('Int64')
+    if kind == 'real':
+        return pd.to_numeric(values, errors='coerce')
+    if kind == 'date_text':
+        return _dates(values).dt.strftime('%Y-%m-%d')
+    if kind == 'day':
+        dates = _dates(values)
+        days = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+        return pd.Series(days, index=values.index).where(dates.notna()).astype('Int64')
+    if kind == 'minute':
+        return _minutes(values).round().astype('Int64')
+    if kind == 'second':
+        return np.floor(_seconds(values)).astype('Int64')
+    return values.astype(object).where(values.notna(), None)
+
+def convert_chunk(table, chunk):
+    """Validate and convert a chunk of an export to stored columns
+    
+    Returns the converted rows that passed, the number rejected and the
+    rejections per export column.
+    """
+    spec = IMPORT_TABLES[table]
+    missing = [source for source, _, _, required in spec if required and source not in chunk.columns]
+    if missing:
+        raise ValueError(f"{table} export is missing required columns {missing}")
+    converted = {}
+    invalid = np.zeros(len(chunk), dtype=bool)
+    problems = {}
+    for source, stored, kind, required in spec:
+        if source not in chunk.columns:
+            converted[stored] = pd.Series(None, index=chunk.index, dtype=object)
+            continue
+        values = chunk[source]
+        present = values.notna().to_numpy()
+        result = _convert(values, kind)
+        bad = result.isna().to_numpy() & (present | required)
+        if bad.any():
+            problems[source] = int(bad.sum())
+            invalid |= bad
+        converted[stored] = result
+    frame = pd.DataFrame(converted)[~invalid]
+    return frame, int(invalid.sum()), problems
+
+def _rows(frame):
+    """Rows as tuples of Python values with None for NA"""
+    columns = [frame[column].astype(object).where(frame[column].notna(), None).tolist() for column in frame.columns]
+    return list(zip(*columns))
+
+# Sources
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """Stream an export file as DataFrame chunks (CSV, or Parquet when pyarrow is installed)"""
+    if path.endswith('.parquet'):
+        if pq is None:
+            raise ImportError(f"Reading {path} requires pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False, na_values=[''])
+
+def export_files(directory):
+    """Export files of each table in a directory, matched as <table>*.csv or <table>*.parquet"""
+    return {
+        table: sorted(path for path in glob.glob(os.path.join(directory, f'{table}*'))
+                      if path.endswith(('.csv', '.parquet')))
+        for table in IMPORT_TABLES
+    }
+
+# Deferred indexing
+def _defer_derived(conn):
+    """Drop secondary indexes and triggers on the imported tables, returning the SQL to restore them
+    
+    Maintaining indexes row by row is far slower than building them once
+    after the load, and the KPI triggers would look up billing per inserted
+    appointment.
+    """
+    placeholders = ', '.join('?' * len(IMPORT_TABLES))
+    derived = conn.execute(f"""
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND tbl_name IN ({placeholders}) AND sql IS NOT NULL
+    """, list(IMPORT_TABLES)).fetchall()
+    for kind, name, _ in derived:
+        conn.execute(f'DROP {kind.upper()} IF EXISTS {name}')
+    return [sql for _, _, sql in derived]
+
+def _restore_derived(conn, statements):
+    """Rebuild deferred indexes and triggers, then everything computed from the facts"""
+    cursor = conn.cursor()
+    for sql in statements:
+        cursor.execute(sql)
+    create_kpi_counters(cursor)
+    # Counters cover the year partitions too, scanned a batch at a time; the
+    # rollup keeps the partitioned days it already has
+    refresh_kpi_counters(cursor, kpi_counter_values(conn))
+    ensure_calendar(cursor)
+    refresh_daily_rollup(cursor)
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB (None where the resource module is unavailable)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bulk_import(db_path, files, chunk_size=CHUNK_SIZE, skip_invalid=False):
+    """Load export files into the database, one transaction per chunk
+    
+    files maps table names to lists of export paths. Invalid rows raise
+    ValueError unless skip_invalid, in which case they are counted and left
+    out. Returns rows, rejections and throughput per table.
+    """
+    conn = sqlite3.connect(db_path)
+    # The load is rerunnable from the exports, so trade durability for speed
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -200000')
+    cursor = conn.cursor()
+    create_tables(cursor)
+    migrate(conn)
+    report = []
+    deferred = _defer_derived(conn)
+    conn.commit()
+    try:
+        for table, spec in IMPORT_TABLES.items():
+            columns = [stored for _, stored, _, _ in spec]
+            insert_sql = (f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                          f"VALUES ({', '.join('?' * len(columns))})")
+            start = time.perf_counter()
+            loaded = rejected = 0
+            problems = {}
+            for path in files.get(table, []):
+                for chunk in read_chunks(path, chunk_size):
+                    frame, invalid, chunk_problems = convert_chunk(table, chunk)
+                    if invalid and not skip_invalid:
+                        raise ValueError(f"{path}: {invalid} invalid {table} rows ({chunk_problems})")
+                    with conn:
+                        conn.executemany(insert_sql, _rows(frame))
+                    loaded += len(frame)
+                    rejected += invalid
+                    for column, count in chunk_problems.items():
+                        problems[column] = problems.get(column, 0) + count
+            seconds = time.perf_counter() - start
+            report.append({
+                'table': table,
+                'files': len(files.get(table, [])),
+                'rows': loaded,
+                'rejected': rejected,
+                'problems': problems or None,
+                'seconds': round(seconds, 3),
+                'rows_per_second': round(loaded / seconds) if seconds > 0 else None
+            })
+    finally:
+        start = time.perf_counter()
+        with conn:
+            _restore_derived(conn, deferred)
+        conn.close()
+    report.append({'table': '(indexes, triggers and rollups)', 'seconds': round(time.perf_counter() - start, 3)})
+    return pd.DataFrame(report).convert_dtypes()
+
+def export_tables(db_path, directory, file_format='csv', chunk_size=CHUNK_SIZE):
+    """Write every table in the HMS export format (the inverse of bulk_import)"""
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        for table, spec in IMPORT_TABLES.items():
+            query = f"SELECT {', '.join(dict.fromkeys(source for source, _, _, _ in spec))} FROM {table}"
+            path = os.path.join(directory, f'{table}.{file_format}')
+            writer = None
+            for i, chunk in enumerate(pd.read_sql_query(query, conn, chunksize=chunk_size)):
+                if file_format == 'parquet':
+                    if pq is None:
+                        raise ImportError("Writing Parquet requires pyarrow")
+                    batch = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                    writer = writer or pq.ParquetWriter(path, batch.schema)
+                    writer.write_table(batch.cast(writer.schema))
+                else:
+                    chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            if writer is not None:
+                writer.close()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import HMS CSV / Parquet exports")
+    parser.add_argument('directory', help="Directory holding <table>*.csv or <table>*.parquet exports")
+    parser.add_argument('--db', default='hospital_data.db')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--skip-invalid', action='store_true', help="Count and skip invalid rows instead of failing")
+    parser.add_argument('--export', choices=['csv', 'parquet'],
+                        help="Instead export the database to the directory in this format")
+    args = parser.parse_args()
+    
+    if args.export:
+        export_tables(args.db, args.directory, args.export, args.chunk_size)
+    else:
+        report = bulk_import(args.db, export_files(args.directory), args.chunk_size, args.skip_invalid)
+        print(report.to_string(index=False))
+        if peak_memory_mb() is not None:
+            print(f"Peak memory: {peak_memory_mb():,.0f} MB")
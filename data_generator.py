@@ -3,23 +3,32 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
+from schema import (APPOINTMENT_STATUSES, PAYMENT_METHODS, PAYMENT_STATUSES, create_appointments_table,
+                    create_billing_table, create_calendar_table, create_lookup_tables, encode,
+                    ensure_calendar, migrate, refresh_daily_rollup, to_day_number, to_minute_of_day,
+                    to_second_of_minute)
 
-def generate_sample_data():
+def generate_sample_data(db_path='hospital_data.db', num_patients=None, days=730,
+                         appointments_per_day=(5, 15)):
     """Generate comprehensive sample data for Lanka Medical Center"""
     
     # Connect to SQLite database
-    conn = sqlite3.connect('hospital_data.db')
+    conn = sqlite3.connect(db_path)
+    # INSERT OR REPLACE only fires the KPI counter delete triggers for the
+    # rows it replaces when recursive triggers are on
+    conn.execute('PRAGMA recursive_triggers = ON')
     cursor = conn.cursor()
     
-    # Create tables
+    # Create tables and bring an existing database up to date
     create_tables(cursor)
+    migrate(conn)
     
     # Generate sample data
     departments = generate_departments()
     doctors = generate_doctors(departments)
     services = generate_services(departments)
-    patients = generate_patients()
-    appointments = generate_appointments(patients, doctors, services)
+    patients = generate_patients(num_patients)
+    appointments = generate_appointments(patients, doctors, services, days, appointments_per_day)
     billing = generate_billing(appointments, services)
     
     # Insert data into database
@@ -29,6 +38,8 @@ def generate_sample_data():
     insert_patients(cursor, patients)
     insert_appointments(cursor, appointments)
     insert_billing(cursor, billing)
+    ensure_calendar(cursor)
+    refresh_daily_rollup(cursor)
     
     # Commit and close
     conn.commit()
@@ -89,35 +100,13 @@ def create_tables(cursor):
         )
     ''')
     
-    # Appointments table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS appointments (
-            appointment_id INTEGER PRIMARY KEY,
-            patient_id INTEGER,
-            doctor_id INTEGER,
-            service_id INTEGER,
-            appointment_date DATE,
-            appointment_time TIME,
-            status TEXT,
-            notes TEXT,
-            FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
-            FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id),
-            FOREIGN KEY (service_id) REFERENCES services (service_id)
-        )
-    ''')
+    # Appointments and billing tables (dates stored as day numbers, statuses as codes)
+    create_lookup_tables(cursor)
+    create_appointments_table(cursor)
+    create_billing_table(cursor)
     
-    # Billing table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS billing (
-            billing_id INTEGER PRIMARY KEY,
-            appointment_id INTEGER,
-            amount REAL,
-            payment_date DATE,
-            payment_status TEXT,
-            payment_method TEXT,
-            FOREIGN KEY (appointment_id) REFERENCES appointments (appointment_id)
-        )
-    ''')
+    # Calendar dimension joined on the integer day keys
+    create_calendar_table(cursor)
 
 def generate_departments():
     """Generate sample departments"""
@@ -221,8 +210,8 @@ def generate_services(departments):
     
     return services
 
-def generate_patients():
-    """Generate sample patients"""
+def generate_patients(num_patients=None):
+    """Generate sample patients (names are reused when more are requested)"""
     patient_names = [
         "A.M. Silva", "K.L. Fernando", "P.R. Perera", "N.S. Bandara", "M.K. Jayawardena",
         "S.T. Mendis", "R.D. Wijesekara", "L.A. Rathnayake", "C.B. Abeysekara", "G.M. Perera",
@@ -232,8 +221,12 @@ def generate_patients():
         "S.L. Mendis", "R.M. Wijesekara", "L.K. Rathnayake", "C.S. Abeysekara", "G.K. Perera"
     ]
     
+    if num_patients is None:
+        num_patients = len(patient_names)
+    
     patients = []
-    for i, name in enumerate(patient_names):
+    for i in range(num_patients):
+        name = patient_names[i % len(patient_names)]
         patients.append({
             'patient_id': i + 1,
             'name': name,
@@ -247,19 +240,19 @@ def generate_patients():
     
     return patients
 
-def generate_appointments(patients, doctors, services):
+def generate_appointments(patients, doctors, services, days=730, appointments_per_day=(5, 15)):
     """Generate sample appointments"""
     appointments = []
     appointment_id = 1
     
-    # Generate appointments for the last 2 years
-    start_date = datetime.now() - timedelta(days=730)
+    # Generate appointments for the last 2 years by default
+    start_date = datetime.now() - timedelta(days=days)
     end_date = datetime.now()
     
     current_date = start_date
     while current_date <= end_date:
-        # Generate 5-15 appointments per day
-        daily_appointments = random.randint(5, 15)
+        # Generate 5-15 appointments per day by default
+        daily_appointments = random.randint(*appointments_per_day)
         
         for _ in range(daily_appointments):
             patient = random.choice(patients)
@@ -358,27 +351,23 @@ def insert_patients(cursor, patients):
 def insert_appointments(cursor, appointments):
     """Insert appointments into database"""
     for appointment in appointments:
-        appt_date = appointment['appointment_date']
-        appt_time = appointment['appointment_time']
-        appt_date_str = appt_date.strftime('%Y-%m-%d') if hasattr(appt_date, 'strftime') else str(appt_date)
-        appt_time_str = appt_time.strftime('%H:%M:%S') if hasattr(appt_time, 'strftime') else str(appt_time)
         cursor.execute('''
-            INSERT OR REPLACE INTO appointments (appointment_id, patient_id, doctor_id, service_id, appointment_date, appointment_time, status, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT OR REPLACE INTO appointments (appointment_id, patient_id, doctor_id, service_id, appointment_day, appointment_minute, appointment_second, status_code, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (appointment['appointment_id'], appointment['patient_id'], appointment['doctor_id'],
-              appointment['service_id'], appt_date_str, appt_time_str,
-              appointment['status'], appointment['notes']))
+              appointment['service_id'], to_day_number(appointment['appointment_date']),
+              to_minute_of_day(appointment['appointment_time']), to_second_of_minute(appointment['appointment_time']),
+              encode(APPOINTMENT_STATUSES, appointment['status']), appointment['notes']))
 
 def insert_billing(cursor, billing):
     """Insert billing records into database"""
     for bill in billing:
-        pay_date = bill['payment_date']
-        pay_date_str = pay_date.strftime('%Y-%m-%d') if hasattr(pay_date, 'strftime') else str(pay_date)
         cursor.execute('''
-            INSERT OR REPLACE INTO billing (billing_id, appointment_id, amount, payment_date, payment_status, payment_method)
+            INSERT OR REPLACE INTO billing (billing_id, appointment_id, amount, payment_day, payment_status_code, payment_method_code)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (bill['billing_id'], bill['appointment_id'], bill['amount'],
-              pay_date_str, bill['payment_status'], bill['payment_method']))
+              to_day_number(bill['payment_date']), encode(PAYMENT_STATUSES, bill['payment_status']),
+              encode(PAYMENT_METHODS, bill['payment_method'])))
 
 if __name__ == "__main__":
     generate_sample_data()
@@ -0,0 +1,450 @@
+import argparse
+import asyncio
+import json
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from ingestion import SimulatedHMSSource, convert_records, upsert_rows
+from schema import migrate, refresh_daily_rollup, today_utc, to_day_number
+
+# Event types accepted from point-of-care systems and the table each upserts;
+# events carry the same fields as the HMS change records (see ingestion.py)
+EVENT_TABLES = {'appointment': 'appointments', 'payment': 'billing'}
+
+# Micro-batch and backpressure defaults
+MAX_BATCH = 2000
+MAX_DELAY = 0.05
+MAX_PENDING = 50000
+PUT_TIMEOUT = 1.0
+ROLLUP_INTERVAL = 5.0
+
+# A failed commit is retried with doubling delays; after COMMIT_ATTEMPTS the
+# batch is appended to a dead-letter file next to the database for replay
+COMMIT_ATTEMPTS = 6
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+# Failures of the database or the disk, which pass; any other failed commit
+# is down to the events themselves (a constraint, a partitioned year)
+TRANSIENT_ERRORS = (sqlite3.OperationalError, OSError)
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+                413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+def parse_events(body):
+    """Validate a JSON event or list of events and convert them to (table, row) pairs"""
+    events = json.loads(body)
+    if isinstance(events, dict):
+        events = [events]
+    converted = []
+    for event in events:
+        table = EVENT_TABLES.get(event.get('type')) if isinstance(event, dict) else None
+        if table is None:
+            raise ValueError(f"Event type must be one of {sorted(EVENT_TABLES)}")
+        converted.append((table, convert_records(table, [event])[0]))
+    return converted
+
+class EventServer:
+    """asyncio HTTP server that queues events and commits them in micro-batches
+    
+    POST /events takes one event or a JSON list and answers 202 once they
+    are queued. A single writer commits the queue in batches of up to
+    max_batch events, or whatever arrived within max_delay of the first one,
+    on its own thread and connection. The database runs in WAL mode so
+    dashboard readers never wait on these commits. When max_pending events are
+    queued or being committed, requests wait up to put_timeout for room and
+    then get 503 with Retry-After. The daily rollup days touched by events
+    are refreshed at most every rollup_interval seconds, since re-aggregating
+    today's rows on every micro-batch would cost more than the batch itself.
+    
+    A batch whose commit fails (a lock held past the busy timeout, a disk
+    error) keeps its events pending and is retried with backoff; after
+    commit_attempts it is written to dead_letter_path instead, so accepted
+    events are never dropped. A batch rejected for its events is split in
+    halves until only the events failing on their own are dead-lettered.
+    GET /health reports the writer's state and answers 503 while it is
+    retrying or has stopped.
+    """
+    
+    def __init__(self, db_path='hospital_data.db', max_batch=MAX_BATCH, max_delay=MAX_DELAY,
+                 max_pending=MAX_PENDING, put_timeout=PUT_TIMEOUT, rollup_interval=ROLLUP_INTERVAL,
+                 commit_attempts=COMMIT_ATTEMPTS, dead_letter_path=None):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.rollup_interval = rollup_interval
+        self.commit_attempts = commit_attempts
+        self.dead_letter_path = dead_letter_path or f"{db_path}.dead-letter.jsonl"
+        self.buffer = []
+        self.in_flight = []
+        self.pending = 0
+        self.dirty_days = set()
+        self.last_rollup = time.monotonic()
+        self.stats = {'accepted': 0, 'rejected': 0, 'invalid': 0, 'committed': 0, 'batches': 0,
+                      'last_batch_size': 0, 'last_commit_ms': 0.0, 'failed_commits': 0, 'dead_lettered': 0}
+        self.writer_state = 'ok'
+        self.last_error = None
+        self.writer_task = None
+        # One writer thread owns the connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = None
+    
+    # Writer side (runs on the executor thread)
+    def _open(self):
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        migrate(self.conn)
+    
+    def _commit(self, batch, flush_rollup=False):
+        start = time.perf_counter()
+        with self.conn:
+            cursor = self.conn.cursor()
+            # Appointments before payments, so a payment for an appointment in
+            # the same batch finds it
+            for table in EVENT_TABLES.values():
+                rows = [row for event_table, row in batch if event_table == table]
+                if rows:
+                    self.dirty_days |= upsert_rows(cursor, table, rows)
+            if self.dirty_days and (flush_rollup or time.monotonic() - self.last_rollup >= self.rollup_interval):
+                refresh_daily_rollup(cursor, self.dirty_days)
+                self.dirty_days = set()
+                self.last_rollup = time.monotonic()
+        return (time.perf_counter() - start) * 1000
+    
+    def _dead_letter(self, batch, error):
+        """Append events that could not be committed to the dead-letter file, one JSON line each"""
+        failed_at = datetime.now(timezone.utc).isoformat()
+        with open(self.dead_letter_path, 'a') as file:
+            for table, row in batch:
+                file.write(json.dumps({'table': table, 'row': list(row), 'error': error,
+                                       'failed_at': failed_at}) + '\n')
+    
+    # Event loop side
+    async def enqueue(self, events):
+        """Queue events, waiting up to put_timeout for room; False when the server is saturated"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.put_timeout
+        async with self.room:
+            while self.pending + len(events) > self.max_pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(self.room.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return False
+            self.buffer.extend(events)
+            self.pending += len(events)
+        self.arrived.set()
+        return True
+    
+    async def _next_batch(self):
+        """Wait for events, then until the batch is full or max_delay has passed"""
+        while not self.buffer:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), self.rollup_interval)
+            except asyncio.TimeoutError:
+                if self.dirty_days:
+                    # Gone quiet: an empty commit flushes the rollup
+                    return []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(self.buffer) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batch, self.buffer = self.buffer[:self.max_batch], self.buffer[self.max_batch:]
+        return batch
+    
+    def _log(self, message):
+        print(f"{datetime.now():%H:%M:%S} {message}", file=sys.stderr)
+    
+    async def _commit_batch(self, batch, flush_rollup=False):
+        """Commit a batch, retrying with backoff; the elapsed ms, or None if none of it was committed
+        
+        A failed rollup flush (an empty batch) is not retried, since its days
+        stay dirty for the next commit. A batch failing for its events is not
+        retried but split, each half committed the same way, so a bad event
+        only takes itself to the dead-letter file. When that file cannot be
+        written either, the events keep being retried rather than dropped.
+        """
+        loop = asyncio.get_running_loop()
+        delay = RETRY_DELAY
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                elapsed = await loop.run_in_executor(self.executor, self._commit, batch, flush_rollup)
+                self.stats['committed'] += len(batch)
+                self.writer_state = 'ok'
+                return elapsed
+            except (sqlite3.Error, ValueError, OSError) as error:
+                self.stats['failed_commits'] += 1
+                self.last_error = f"{type(error).__name__}: {error}"
+                self._log(f"Commit of {len(batch)} events failed (attempt {attempt}): {self.last_error}")
+                rejected = not isinstance(error, TRANSIENT_ERRORS)
+            if not batch:
+                return None
+            if rejected and len(batch) > 1:
+                middle = len(batch) // 2
+                elapsed = [await self._commit_batch(half, flush_rollup) for half in (batch[:middle], batch[middle:])]
+                committed = [ms for ms in elapsed if ms is not None]
+                return sum(committed) if committed else None
+            if rejected or attempt >= self.commit_attempts:
+                try:
+                    await loop.run_in_executor(self.executor, self._dead_letter, batch, self.last_error)
+                    self.stats['dead_lettered'] += len(batch)
+                    self.writer_state = 'ok'
+                    self._log(f"Moved {len(batch)} events to {self.dead_letter_path}")
+                    return None
+                except OSError as error:
+                    self.last_error = f"{type(error).__name__}: {error}"
+                    self._log(f"Could not write {self.dead_letter_path}: {self.last_error}")
+            self.writer_state = 'retrying'
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+    
+    async def _writer(self):
+        while True:
+            batch = self.in_flight = await self._next_batch()
+            try:
+                elapsed = await self._commit_batch(batch)
+                if batch and elapsed is not None:
+                    self.stats['batches'] += 1
+                    self.stats['last_batch_size'] = len(batch)
+                    self.stats['last_commit_ms'] = round(elapsed, 2)
+            finally:
+                self.in_flight = []
+                # Released however the batch ended, so backpressure never outlives it
+                if batch:
+                    async with self.room:
+                        self.pending -= len(batch)
+                        self.room.notify_all()
+    
+    def _health(self):
+        writer = 'stopped' if self.writer_task is None or self.writer_task.done() else self.writer_state
+        payload = {'status': 'ok' if writer == 'ok' else 'unavailable', 'writer': writer,
+                   'last_error': self.last_error, 'pending': self.pending,
+                   'failed_commits': self.stats['failed_commits'], 'dead_lettered': self.stats['dead_lettered']}
+        return (200 if writer == 'ok' else 503), payload
+    
+    async def _route(self, method, path, body):
+        if method == 'POST' and path == '/events':
+            try:
+                events = parse_events(body)
+            except (ValueError, TypeError, AttributeError) as error:
+                self.stats['invalid'] += 1
+                return 400, {'error': str(error)}
+            if len(events) > self.max_pending:
+                return 413, {'error': f"At most {self.max_pending} events per request"}
+            if not await self.enqueue(events):
+                self.stats['rejected'] += len(events)
+                return 503, {'error': "Ingestion queue is full, retry later"}
+            self.stats['accepted'] += len(events)
+            return 202, {'accepted': len(events)}
+        if method == 'GET' and path == '/stats':
+            return 200, dict(self.stats, pending=self.pending, queued=len(self.buffer), writer=self.writer_state)
+        if method == 'GET' and path == '/health':
+            return self._health()
+        return 404, {'error': f"No route for {method} {path}"}
+    
+    async def _handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one keep-alive connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._route(method, path, body)
+                content = json.dumps(payload).encode()
+                extra = 'Retry-After: 1\r\n' if status == 503 else ''
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n{extra}\r\n".encode() + content
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        """Run until SIGINT or SIGTERM, then commit whatever is still queued"""
+        loop = asyncio.get_running_loop()
+        self.room = asyncio.Condition()
+        self.arrived = asyncio.Event()
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+        await loop.run_in_executor(self.executor, self._open)
+        if unix_path:
+            server = await asyncio.start_unix_server(self._handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        self.writer_task = asyncio.create_task(self._writer())
+        self.writer_task.add_done_callback(self._writer_done)
+        print(f"Accepting events on {unix_path or f'http://{host}:{port}/events'}")
+        try:
+            async with server:
+                await stopping.wait()
+        finally:
+            # A batch cut short mid-retry is committed again with the rest;
+            # upserts make a second commit of the same events harmless
+            batch = self.in_flight + self.buffer
+            self.writer_task.cancel()
+            self.buffer = []
+            await self._commit_batch(batch, flush_rollup=True)
+            await loop.run_in_executor(self.executor, self.conn.close)
+    
+    def _writer_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.last_error = f"{type(task.exception()).__name__}: {task.exception()}"
+            self._log(f"Event writer stopped: {self.last_error}")
+
+# Load test
+class _ReadProbe(threading.Thread):
+    """Dashboard-style reads in a loop, timing each, while the load test writes"""
+    
+    def __init__(self, db_path):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.latencies = []
+        self.stopped = threading.Event()
+    
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        since = to_day_number(today_utc()) - 90
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            conn.execute("SELECT value FROM kpi_counters WHERE name = 'total_appointments'").fetchone()
+            conn.execute('SELECT day, SUM(appointments) FROM daily_rollup WHERE day >= ? GROUP BY day',
+                         (since,)).fetchall()
+            self.latencies.append(time.perf_counter() - start)
+            time.sleep(0.01)
+        conn.close()
+
+async def _load_client(host, port, source, events_per_request, deadline, results):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.monotonic() < deadline:
+            events = _take_events(source, events_per_request)
+            body = json.dumps(events).encode()
+            start = time.perf_counter()
+            writer.write(f"POST /events HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            results['latencies'].append(time.perf_counter() - start)
+            results['sent'] += len(events)
+            if status == 202:
+                results['accepted'] += len(events)
+            else:
+                results['rejected'] += len(events)
+                await asyncio.sleep(0.1)
+    finally:
+        writer.close()
+
+def _take_events(source, count):
+    """Pop count events from the simulated HMS log, ticking it when it runs dry"""
+    events = []
+    while len(events) < count:
+        if not source.log['appointments'] and not source.log['billing']:
+            source.tick(appointments=count, new_patients=0)
+        for kind, table in EVENT_TABLES.items():
+            while source.log[table] and len(events) < count:
+                events.append(dict(source.log[table].pop(0), type=kind))
+    return events
+
+async def load_test(db_path='hospital_data.db', host='127.0.0.1', port=8765, seconds=10, connections=8,
+                    events_per_request=50):
+    """Drive the server with simulated appointment and payment events and time concurrent reads"""
+    source = SimulatedHMSSource(db_path)
+    source.log['patients'] = []
+    results = {'sent': 0, 'accepted': 0, 'rejected': 0, 'latencies': []}
+    probe = _ReadProbe(db_path)
+    probe.start()
+    start = time.monotonic()
+    await asyncio.gather(*[
+        _load_client(host, port, source, events_per_request, start + seconds, results)
+        for _ in range(connections)
+    ])
+    elapsed = time.monotonic() - start
+    probe.stopped.set()
+    probe.join()
+    requests = np.array(results['latencies']) * 1000
+    reads = np.array(probe.latencies) * 1000
+    return {
+        'seconds': round(elapsed, 2),
+        'events_sent': results['sent'],
+        'events_accepted': results['accepted'],
+        'events_rejected': results['rejected'],
+        'accepted_per_second': round(results['accepted'] / elapsed, 1),
+        'request_p50_ms': round(float(np.percentile(requests, 50)), 2) if len(requests) else None,
+        'request_p99_ms': round(float(np.percentile(requests, 99)), 2) if len(requests) else None,
+        'reads': len(reads),
+        'read_p50_ms': round(float(np.percentile(reads, 50)), 2) if len(reads) else None,
+        'read_max_ms': round(float(reads.max()), 2) if len(reads) else None
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching event ingestion server and load-test client")
+    parser.add_argument('command', choices=['serve', 'load-test'])
+    parser.add_argument('--db', default='hospital_data.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-delay', type=float, default=MAX_DELAY, help="Seconds a batch waits to fill")
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING)
+    parser.add_argument('--rollup-interval', type=float, default=ROLLUP_INTERVAL)
+    parser.add_argument('--commit-attempts', type=int, default=COMMIT_ATTEMPTS,
+                        help="Commit attempts before a batch goes to the dead-letter file")
+    parser.add_argument('--dead-letter', help="Dead-letter file (default: <db>.dead-letter.jsonl)")
+    parser.add_argument('--seconds', type=float, default=10, help="Load test duration")
+    parser.add_argument('--connections', type=int, default=8, help="Concurrent load test clients")
+    parser.add_argument('--events-per-request', type=int, default=50)
+    args = parser.parse_args()
+    
+    if args.command == 'serve':
+        server = EventServer(args.db, args.max_batch, args.max_delay, args.max_pending,
+                             rollup_interval=args.rollup_interval, commit_attempts=args.commit_attempts,
+                             dead_letter_path=args.dead_letter)
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    else:
+        report = asyncio.run(load_test(args.db, args.host, args.port, args.seconds, args.connections,
+                                       args.events_per_request))
+        for name, value in report.items():
+            print(f"{name}: {value}")
@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+import pandas as pd
+import numpy as np
+from analytics_engine import AnalyticsEngine
+from benchmark import BENCHMARK_DB, WORKLOAD, build_benchmark_database, run_workload
+from sketches import register_sketch_functions
+
+# Tables the advisor is allowed to propose indexes on
+TARGET_TABLES = ('appointments', 'billing', 'services', 'doctors')
+
+MIGRATIONS_DIR = 'migrations'
+
+SQL_KEYWORDS = {
+    'ON', 'WHERE', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER', 'CROSS', 'GROUP',
+    'ORDER', 'HAVING', 'LIMIT', 'UNION', 'AS', 'USING'
+}
+
+CLAUSE_PATTERN = re.compile(
+    r"(?P<clause>GROUP\s+BY|ORDER\s+BY|\b(?:SELECT|FROM|JOIN|ON|WHERE|HAVING)\b)"
+    r"|(?P<alias>\w+)\.(?P<column>\w+)(?:\s*(?P<op>>=|<=|<>|!=|=|<|>|\bBETWEEN\b|\bIN\b)\s*(?P<rhs>\w+\.\w+)?)?",
+    re.IGNORECASE
+)
+
+# Workload collection
+def collect_workload(db_path, methods=WORKLOAD):
+    """Run the engine workload with query logging and return the distinct queries"""
+    engine = AnalyticsEngine(db_path, log_queries=True)
+    run_workload(engine, methods)
+    return deduplicate_queries(engine.query_log)
+
+def load_query_log(path):
+    """Load a query log written by AnalyticsEngine.save_query_log"""
+    with open(path) as f:
+        return deduplicate_queries(json.loads(line) for line in f if line.strip())
+
+def deduplicate_queries(entries):
+    """Keep one entry per distinct (query, params) pair"""
+    workload = {}
+    for entry in entries:
+        params = entry.get('params')
+        key = (entry['query'], json.dumps(params, sort_keys=True, default=str))
+        workload.setdefault(key, {'query': entry['query'], 'params': params})
+    return list(workload.values())
+
+def copy_database(db_path):
+    """Copy the database into memory so candidate indexes never touch the original
+    
+    The copy gets the sketch functions the engine's queries call (topk_union
+    and the like), as every engine connection does.
+    """
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(':memory:')
+    register_sketch_functions(target)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+    return target
+
+# Query plan analysis
+def explain_query(conn, query, params=None):
+    """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + query, params or ()).fetchall()
+    return [row[3] for row in rows]
+
+def find_plan_issues(plan, aliases):
+    """Find full table scans and temp B-trees in a query plan"""
+    issues = []
+    for detail in plan:
+        scan = re.match(r'SCAN (\w+)(.*)$', detail)
+        if scan and 'USING' not in scan.group(2):
+            issues.append(('full_scan', aliases.get(scan.group(1), scan.group(1))))
+        elif detail.startswith('USE TEMP B-TREE'):
+            issues.append(('temp_btree', detail[len('USE TEMP B-TREE FOR '):]))
+    return issues
+
+def analyze_query(query):
+    """Map aliases to tables and classify how each table's columns are used"""
+    aliases = {}
+    for match in re.finditer(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', query, re.IGNORECASE):
+        table, alias = match.group(1), match.group(2)
+        if alias is None or alias.upper() in SQL_KEYWORDS:
+            alias = table
+        aliases[alias] = table
+        aliases.setdefault(table, table)
+    
+    usage = {}
+    clause = None
+    for match in CLAUSE_PATTERN.finditer(query):
+        if match.group('clause'):
+            clause = re.sub(r'\s+', ' ', match.group('clause').upper())
+            continue
+        table = aliases.get(match.group('alias'))
+        if table is None:
+            continue
+        column = match.group('column')
+        op = (match.group('op') or '').upper()
+        table_usage = usage.setdefault(table, {
+            'equality': [], 'range': [], 'join': [], 'group': [], 'order': [], 'select': []
+        })
+        if clause == 'ON' or match.group('rhs'):
+            kind = 'join'
+        elif clause == 'WHERE' and op in ('=', 'IN'):
+            kind = 'equality'
+        elif clause == 'WHERE' and op:
+            kind = 'range'
+        elif clause == 'GROUP BY':
+            kind = 'group'
+        elif clause == 'ORDER BY':
+            kind = 'order'
+        else:
+            kind = 'select'
+        if column not in table_usage[kind]:
+            table_usage[kind].append(column)
+        # The right-hand side of a column = column condition is a join column too
+        if match.group('rhs'):
+            rhs_alias, rhs_column = match.group('rhs').split('.')
+            rhs_table = aliases.get(rhs_alias)
+            if rhs_table is not None:
+                rhs_usage = usage.setdefault(rhs_table, {
+                    'equality': [], 'range': [], 'join': [], 'group': [], 'order': [], 'select': []
+                })
+                if rhs_column not in rhs_usage['join']:
+                    rhs_usage['join'].append(rhs_column)
+    return aliases, usage
+
+# Candidate generation
+def get_existing_indexes(conn, table):
+    """Return the column tuples already indexed on a table, including the rowid key"""
+    indexed = []
+    for column in conn.execute(f"PRAGMA table_info({table})").fetchall():
+        if column[5]:
+            indexed.append((column[1],))
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = conn.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        indexed.append(tuple(c[2] for c in sorted(columns)))
+    return indexed
+
+def _unique(columns):
+    seen = []
+    for column in columns:
+        if column not in seen:
+            seen.append(column)
+    return tuple(seen)
+
+def propose_candidates(conn, workload, max_columns=5):
+    """Propose candidate indexes from the columns each workload query filters, joins and groups on"""
+    candidates = set()
+    for item in workload:
+        _, usage = analyze_query(item['query'])
+        for table, used in usage.items():
+            if table not in TARGET_TABLES:
+                continue
+            equality = _unique(used['equality'])
+            ranged = _unique(used['range'])[:1]
+            joins = _unique(used['join'])
+            groups = _unique(used['group'])
+            proposals = [(column,) for column in joins]
+            proposals.append(equality + ranged)
+            proposals.extend(equality + (column,) for column in joins)
+            proposals.append(equality + groups)
+            proposals.append(_unique(equality + ranged + joins + groups + tuple(used['select'])))
+            for columns in proposals:
+                columns = _unique(columns)[:max_columns]
+                if columns:
+                    candidates.add((table, columns))
+    
+    # Drop candidates already served by an existing index prefix
+    proposals = []
+    for table, columns in sorted(candidates):
+        existing = get_existing_indexes(conn, table)
+        if any(index[:len(columns)] == columns for index in existing):
+            continue
+        proposals.append((table, columns))
+    return proposals
+
+def index_name(table, columns):
+    """Build a deterministic index name"""
+    return f"idx_{table}_{'_'.join(columns)}"
+
+def create_index_sql(table, columns):
+    """CREATE INDEX statement for a candidate"""
+    return f"CREATE INDEX IF NOT EXISTS {index_name(table, columns)} ON {table} ({', '.join(columns)})"
+
+# Benefit measurement
+def measure_workload(conn, workload, repeat=3, budget=None):
+    """Total of the median execution time of every workload query
+    
+    When a time budget is given, a candidate that makes the workload slower
+    than the budget is interrupted and reported as infinitely slow.
+    """
+    deadline = time.perf_counter() + budget * repeat if budget else None
+    if deadline:
+        conn.set_progress_handler(lambda: time.perf_counter() > deadline, 10000)
+    total = 0.0
+    try:
+        for item in workload:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                conn.execute(item['query'], item['params'] or ()).fetchall()
+                timings.append(time.perf_counter() - start)
+            total += float(np.median(timings))
+    except sqlite3.OperationalError as error:
+        # Only the budget's interrupt means slow; any other error is a broken query
+        if deadline and 'interrupted' in str(error):
+            return float('inf')
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+    return total
+
+def evaluate_candidates(conn, workload, candidates, repeat=3, min_gain=0.02):
+    """Measure each candidate alone, then greedily keep the ones that still help together"""
+    baseline = measure_workload(conn, workload, repeat)
+    budget = 2 * baseline
+    
+    results = []
+    for table, columns in candidates:
+        conn.execute(create_index_sql(table, columns))
+        elapsed = measure_workload(conn, workload, repeat, budget)
+        conn.execute(f"DROP INDEX {index_name(table, columns)}")
+        results.append({
+            'table': table,
+            'columns': columns,
+            'index_name': index_name(table, columns),
+            'seconds': elapsed,
+            'benefit': baseline - elapsed
+        })
+    results = pd.DataFrame(results, columns=['table', 'columns', 'index_name', 'seconds', 'benefit'])
+    results = results.sort_values('benefit', ascending=False).reset_index(drop=True)
+    
+    selected = []
+    current = baseline
+    for row in results.itertuples():
+        if row.benefit < min_gain * baseline:
+            break
+        conn.execute(create_index_sql(row.table, row.columns))
+        elapsed = measure_workload(conn, workload, repeat, budget)
+        if current - elapsed >= min_gain * baseline:
+            selected.append(row.index_name)
+            current = elapsed
+        else:
+            conn.execute(f"DROP INDEX {row.index_name}")
+    results['selected'] = results['index_name'].isin(selected)
+    return baseline, current, results
+
+def plan_report(conn, workload):
+    """Summarize plan issues per workload query"""
+    rows = []
+    for item in workload:
+        aliases, _ = analyze_query(item['query'])
+        issues = find_plan_issues(explain_query(conn, item['query'], item['params']), aliases)
+        rows.append({
+            'query': ' '.join(item['query'].split())[:80],
+            'full_scans': ', '.join(sorted({i[1] for i in issues if i[0] == 'full_scan'})),
+            'temp_btrees': ', '.join(i[1] for i in issues if i[0] == 'temp_btree')
+        })
+    return pd.DataFrame(rows)
+
+# Migration output
+def write_migration(winners, directory=MIGRATIONS_DIR, baseline=None, optimized=None):
+    """Write the winning indexes as a numbered SQL migration and return its path"""
+    os.makedirs(directory, exist_ok=True)
+    numbers = [int(name.split('_')[0]) for name in os.listdir(directory)
+               if name.endswith('.sql') and name.split('_')[0].isdigit()]
+    path = os.path.join(directory, f"{max(numbers, default=0) + 1:03d}_index_advisor.sql")
+    lines = [f"-- Generated by index_advisor.py on {datetime.now():%Y-%m-%d %H:%M:%S}"]
+    if baseline is not None and optimized is not None:
+        lines.append(f"-- Benchmark workload: {baseline:.3f}s -> {optimized:.3f}s")
+    lines.extend(create_index_sql(table, columns) + ';' for table, columns in winners)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+def apply_migration(db_path, path):
+    """Apply a SQL migration file to a database"""
+    conn = sqlite3.connect(db_path)
+    try:
+        with open(path) as f:
+            conn.executescript(f.read())
+        conn.commit()
+    finally:
+        conn.close()
+
+def advise(db_path, workload=None, repeat=3, min_gain=0.02):
+    """Run the full advisor on an in-memory copy of the database"""
+    if workload is None:
+        workload = collect_workload(db_path)
+    conn = copy_database(db_path)
+    try:
+        before = plan_report(conn, workload)
+        candidates = propose_candidates(conn, workload)
+        baseline, optimized, results = evaluate_candidates(conn, workload, candidates, repeat, min_gain)
+        after = plan_report(conn, workload)
+    finally:
+        conn.close()
+    return {
+        'baseline_seconds': baseline,
+        'optimized_seconds': optimized,
+        'candidates': results,
+        'winners': [(r.table, r.columns) for r in results[results['selected']].itertuples()],
+        'plans_before': before,
+        'plans_after': after
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose indexes for the analytics engine workload")
+    parser.add_argument('--db', default=BENCHMARK_DB, help="Database to replay the workload against")
+    parser.add_argument('--log', help="Replay a saved query log instead of running the engine workload")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-gain', type=float, default=0.02,
+                        help="Minimum fraction of baseline time an index must save")
+    parser.add_argument('--output', default=MIGRATIONS_DIR, help="Directory for the generated migration")
+    parser.add_argument('--apply', help="Apply the generated migration to this database")
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.db):
+        print(f"Building benchmark database {args.db}...")
+        build_benchmark_database(args.db)
+    
+    workload = load_query_log(args.log) if args.log else None
+    report = advise(args.db, workload, args.repeat, args.min_gain)
+    
+    print("Plan issues before:")
+    print(report['plans_before'].to_string(index=False))
+    print("\nCandidates:")
+    print(report['candidates'][['index_name', 'benefit', 'selected']].to_string(index=False))
+    print(f"\nWorkload: {report['baseline_seconds']:.3f}s -> {report['optimized_seconds']:.3f}s")
+    
+    if report['winners']:
+        path = write_migration(report['winners'], args.output,
+                               report['baseline_seconds'], report['optimized_seconds'])
+        print(f"Migration written to {path}")
+        if args.apply:
+            apply_migration(args.apply, path)
+            print(f"Migration applied to {args.apply}")
+    else:
+        print("No index improved the workload enough to recommend")
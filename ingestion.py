@@ -0,0 +1,430 @@
+import argparse
+import bisect
+import glob
+import json
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timezone
+import pandas as pd
+from schema import (APPOINTMENT_STATUSES, PAYMENT_METHODS, PAYMENT_STATUSES, ROLLUP_REFRESH_CHUNK, encode,
+                    ensure_calendar, from_day_number, migrate, refresh_daily_rollup, to_day_number,
+                    to_minute_of_day, to_second_of_minute)
+from partitions import overlapping_partitions, partitioned_appointments
+
+# Change records carry the HMS columns (as produced by the data_generator
+# generate_* functions) plus the time of their last change in the HMS
+WATERMARK_COLUMN = 'updated_at'
+
+# Rows upserted per transaction
+BATCH_SIZE = 5000
+
+def _optional(value, convert):
+    return convert(value) if value is not None else None
+
+def _date_text(value):
+    return str(value)[:10]
+
+def _patient_row(record):
+    return (int(record['patient_id']), record['name'], _optional(record.get('age'), int), record.get('gender'),
+            record.get('contact'), record.get('address'), _optional(record.get('registration_date'), _date_text),
+            record.get('emergency_contact'))
+
+def _appointment_row(record):
+    return (int(record['appointment_id']), int(record['patient_id']), int(record['doctor_id']),
+            int(record['service_id']), to_day_number(record['appointment_date']),
+            to_minute_of_day(record['appointment_time']), to_second_of_minute(record['appointment_time']),
+            encode(APPOINTMENT_STATUSES, record['status']), record.get('notes'))
+
+def _billing_row(record):
+    return (int(record['billing_id']), int(record['appointment_id']), float(record['amount']),
+            _optional(record.get('payment_date'), to_day_number), encode(PAYMENT_STATUSES, record['payment_status']),
+            encode(PAYMENT_METHODS, record['payment_method']))
+
+# Ingested tables in load order (appointments reference patients, billing
+# references appointments): stored columns with the key first, the converter
+# from an HMS record to a stored row, and the appointment days a set of keys
+# contributes to the daily rollup
+INGESTED_TABLES = {
+    'patients': {
+        'columns': ['patient_id', 'name', 'age', 'gender', 'contact', 'address', 'registration_date',
+                    'emergency_contact'],
+        'row': _patient_row,
+        'days': None
+    },
+    'appointments': {
+        'columns': ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'appointment_day',
+                    'appointment_minute', 'appointment_second', 'status_code', 'notes'],
+        'row': _appointment_row,
+        'days': "SELECT appointment_day FROM appointments WHERE appointment_id IN ({keys})"
+    },
+    'billing': {
+        'columns': ['billing_id', 'appointment_id', 'amount', 'payment_day', 'payment_status_code',
+                    'payment_method_code'],
+        'row': _billing_row,
+        'days': """
+            SELECT a.appointment_day
+            FROM billing b
+            JOIN appointments a ON a.appointment_id = b.appointment_id
+            WHERE b.billing_id IN ({keys})
+        """
+    }
+}
+
+def upsert_sql(table):
+    """INSERT ... ON CONFLICT DO UPDATE for a table, so updates fire the KPI counter update triggers"""
+    key, *columns = INGESTED_TABLES[table]['columns']
+    updates = ', '.join(f"{column} = excluded.{column}" for column in columns)
+    return f"""
+        INSERT INTO {table} ({key}, {', '.join(columns)})
+        VALUES ({', '.join('?' * (len(columns) + 1))})
+        ON CONFLICT ({key}) DO UPDATE SET {updates}
+    """
+
+def convert_records(table, records):
+    """Validate HMS records of a table and convert them to stored rows"""
+    try:
+        return [INGESTED_TABLES[table]['row'](record) for record in records]
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid {table} change record: {error}") from error
+
+def touched_days(cursor, table, keys):
+    """Appointment days whose rollup rows depend on the given keys of a table"""
+    query = INGESTED_TABLES[table]['days']
+    days = set()
+    if query is None:
+        return days
+    for start in range(0, len(keys), ROLLUP_REFRESH_CHUNK):
+        chunk = keys[start:start + ROLLUP_REFRESH_CHUNK]
+        days.update(day for (day,) in cursor.execute(query.format(keys=', '.join('?' * len(chunk))), chunk))
+    return days
+
+def reject_partitioned(cursor, table, rows):
+    """Raise ValueError for converted rows that would change a year moved to a partition
+    
+    Upserts only see the main database, so they would add a second copy of
+    a partitioned appointment or its bill rather than update it.
+    """
+    years = {year for year, _ in overlapping_partitions(cursor.connection)}
+    if not years or table not in ('appointments', 'billing'):
+        return
+    columns = INGESTED_TABLES[table]['columns']
+    appointment_ids = [row[columns.index('appointment_id')] for row in rows]
+    partitioned = partitioned_appointments(cursor.connection, appointment_ids)
+    if table == 'appointments':
+        position = columns.index('appointment_day')
+        partitioned.update(row[0] for row in rows
+                           if row[position] is not None and from_day_number(row[position]).year in years)
+    if partitioned:
+        keys = [row[0] for row, appointment_id in zip(rows, appointment_ids) if appointment_id in partitioned]
+        raise ValueError(f"{len(keys)} {table} rows ({', '.join(map(str, keys[:5]))}"
+                         f"{', ...' if len(keys) > 5 else ''}) belong to partitioned years "
+                         f"{sorted(years)}; changes to a partitioned year are not supported")
+
+def upsert_rows(cursor, table, rows):
+    """Upsert converted rows inside the caller's transaction
+    
+    Returns the appointment days the rows touched, before and after the
+    change, for the caller to refresh in the daily rollup. Rows of a
+    partitioned year raise ValueError before anything is written.
+    """
+    reject_partitioned(cursor, table, rows)
+    keys = [row[0] for row in rows]
+    days = touched_days(cursor, table, keys)
+    cursor.executemany(upsert_sql(table), rows)
+    days |= touched_days(cursor, table, keys)
+    # Extending the calendar rewrites every day in range, so only do it for days it lacks
+    positions = [i for i, column in enumerate(INGESTED_TABLES[table]['columns']) if column.endswith('_day')]
+    stored_days = [row[i] for row in rows for i in positions if row[i] is not None]
+    if stored_days:
+        low, high = cursor.execute('SELECT MIN(day), MAX(day) FROM calendar').fetchone()
+        if low is None or min(stored_days) < low or max(stored_days) > high:
+            ensure_calendar(cursor)
+    return days
+
+def create_watermark_table(cursor):
+    """Create the per-source, per-table high-water marks"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingestion_watermarks (
+            source TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            watermark TEXT NOT NULL,
+            rows_loaded INTEGER NOT NULL DEFAULT 0,
+            loaded_at TEXT,
+            PRIMARY KEY (source, table_name)
+        )
+    ''')
+
+def normalize_timestamps(values):
+    """ISO 8601 change timestamps as fixed-width UTC text, so they compare as strings"""
+    stamps = pd.to_datetime(pd.Series(values), format='ISO8601', utc=True)
+    return stamps.dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def changed_since(changes, watermark):
+    """Records changed after a watermark, oldest first"""
+    if WATERMARK_COLUMN not in changes.columns:
+        raise ValueError(f"Change records need an {WATERMARK_COLUMN!r} column")
+    changes = changes.assign(**{WATERMARK_COLUMN: normalize_timestamps(changes[WATERMARK_COLUMN]).to_numpy()})
+    if watermark is not None:
+        changes = changes[changes[WATERMARK_COLUMN] > watermark]
+    return changes.sort_values(WATERMARK_COLUMN, kind='stable').reset_index(drop=True)
+
+def batches(changes, size=BATCH_SIZE):
+    """Split sorted changes into batches of about size rows, never splitting records that share a timestamp
+    
+    A batch commits its last timestamp as the watermark, so a timestamp
+    split across batches could leave records behind after a crash.
+    """
+    stamps = changes[WATERMARK_COLUMN].to_numpy()
+    start = 0
+    while start < len(changes):
+        end = min(start + size, len(changes))
+        while end < len(changes) and stamps[end] == stamps[end - 1]:
+            end += 1
+        yield changes.iloc[start:end]
+        start = end
+
+# Sources
+class DropDirectorySource:
+    """Change batches dropped by the HMS as <table>*.csv or <table>*.json files
+    
+    JSON drops hold a list of records or one record per line. Files stay in
+    place; the watermark filters out what was already loaded.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.name = f"drops:{os.path.abspath(directory)}"
+    
+    def _read(self, path):
+        if path.endswith('.csv'):
+            return pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''])
+        with open(path) as f:
+            text = f.read().strip()
+        if text.startswith('['):
+            return pd.DataFrame(json.loads(text))
+        return pd.DataFrame([json.loads(line) for line in text.splitlines() if line.strip()])
+    
+    def fetch(self, table, watermark):
+        """Records of a table changed after the watermark, oldest first"""
+        paths = sorted(path for path in glob.glob(os.path.join(self.directory, f'{table}*'))
+                       if path.endswith(('.csv', '.json')))
+        frames = [self._read(path) for path in paths]
+        frames = [frame for frame in frames if len(frame) > 0]
+        if not frames:
+            return pd.DataFrame(columns=[WATERMARK_COLUMN])
+        return changed_since(pd.concat(frames, ignore_index=True), watermark)
+
+class SimulatedHMSSource:
+    """Local stand-in for the HMS: a change log of new patients, appointments and bills
+    
+    Each tick registers patients, books and completes appointments for today
+    and bills the completed ones, mostly as Pending. Later ticks settle some
+    of the pending bills, re-emitting them as late Paid status changes.
+    
+    The log is kept in timestamp order, so a fetch starts at its watermark
+    and drops the records at or before it, which the caller has loaded.
+    """
+    
+    def __init__(self, db_path='hospital_data.db', seed=None):
+        self.name = 'simulated-hms'
+        self.random = random.Random(seed)
+        self.log = {table: [] for table in INGESTED_TABLES}
+        self.pending = []
+        self.stamp = ''
+        conn = sqlite3.connect(db_path)
+        try:
+            self.doctors = conn.execute('SELECT doctor_id, department_id FROM doctors').fetchall()
+            self.services = conn.execute('SELECT service_id, department_id, cost FROM services').fetchall()
+            self.next_ids = {
+                table: conn.execute(f'SELECT COALESCE(MAX({spec["columns"][0]}), 0) + 1 FROM {table}').fetchone()[0]
+                for table, spec in INGESTED_TABLES.items()
+            }
+        finally:
+            conn.close()
+        self.patient_ids = list(range(1, self.next_ids['patients']))
+    
+    def _next_id(self, table):
+        value = self.next_ids[table]
+        self.next_ids[table] += 1
+        return value
+    
+    def tick(self, appointments=50, new_patients=5, settle_rate=0.3):
+        """Append one round of changes to the log"""
+        now = datetime.now(timezone.utc)
+        # Normalized like the watermarks, and never behind an earlier tick
+        stamp = self.stamp = max(self.stamp, now.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        today = now.date().isoformat()
+        for _ in range(new_patients):
+            patient_id = self._next_id('patients')
+            self.patient_ids.append(patient_id)
+            self.log['patients'].append({
+                'patient_id': patient_id, 'name': f"Walk-in Patient {patient_id}",
+                'age': self.random.randint(18, 80), 'gender': self.random.choice(['Male', 'Female']),
+                'contact': f"0{self.random.randint(70, 77)}{self.random.randint(1000000, 9999999)}",
+                'address': f"Address {patient_id}, Matugama", 'registration_date': today,
+                'emergency_contact': None, WATERMARK_COLUMN: stamp
+            })
+        
+        # Settle bills raised by earlier ticks before raising new ones
+        still_pending = []
+        for bill in self.pending:
+            if self.random.random() < settle_rate:
+                self.log['billing'].append(dict(bill, payment_status='Paid', payment_date=today,
+                                                **{WATERMARK_COLUMN: stamp}))
+            else:
+                still_pending.append(bill)
+        self.pending = still_pending
+        
+        for _ in range(appointments):
+            doctor_id, department_id = self.random.choice(self.doctors)
+            services = [service for service in self.services if service[1] == department_id] or self.services
+            service_id, _, cost = self.random.choice(services)
+            appointment_id = self._next_id('appointments')
+            status = self.random.choice(['Completed', 'Completed', 'Completed', 'No-show', 'Cancelled'])
+            self.log['appointments'].append({
+                'appointment_id': appointment_id, 'patient_id': self.random.choice(self.patient_ids),
+                'doctor_id': doctor_id, 'service_id': service_id, 'appointment_date': today,
+                'appointment_time': f"{self.random.randint(8, 17)}:{self.random.randint(0, 59):02d}",
+                'status': status, 'notes': '', WATERMARK_COLUMN: stamp
+            })
+            if status == 'Completed':
+                bill = {
+                    'billing_id': self._next_id('billing'), 'appointment_id': appointment_id,
+                    'amount': round(cost * self.random.uniform(0.9, 1.1), 2), 'payment_date': today,
+                    'payment_status': self.random.choice(['Paid', 'Pending', 'Pending']),
+                    'payment_method': self.random.choice(list(PAYMENT_METHODS))
+                }
+                self.log['billing'].append(dict(bill, **{WATERMARK_COLUMN: stamp}))
+                if bill['payment_status'] == 'Pending':
+                    self.pending.append(bill)
+    
+    def fetch(self, table, watermark):
+        """Records of a table changed after the watermark, oldest first"""
+        log = self.log[table]
+        if watermark is not None:
+            del log[:bisect.bisect_right(log, watermark, key=lambda record: record[WATERMARK_COLUMN])]
+        if not log:
+            return pd.DataFrame(columns=[WATERMARK_COLUMN])
+        return changed_since(pd.DataFrame(log), watermark)
+
+class IngestionPipeline:
+    """Pull change batches from a source into the database
+    
+    Tables load in dependency order, each in batches of batch_size rows with
+    one transaction per batch. A batch upserts its rows, refreshes the daily
+    rollup for just the appointment days it touched (before and after the
+    change, so late billing status changes and rescheduled appointments fix
+    the days they left too) and moves the table's watermark, so a failure
+    leaves facts, rollup and watermark consistent and the next run resumes.
+    """
+    
+    def __init__(self, source, db_path='hospital_data.db', batch_size=BATCH_SIZE):
+        self.source = source
+        self.db_path = db_path
+        self.batch_size = batch_size
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        migrate(conn)
+        create_watermark_table(conn.cursor())
+        conn.commit()
+        return conn
+    
+    def _watermark(self, conn, table):
+        row = conn.execute(
+            'SELECT watermark FROM ingestion_watermarks WHERE source = ? AND table_name = ?',
+            (self.source.name, table)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def watermarks(self):
+        """High-water marks of this pipeline's source"""
+        conn = self._connect()
+        try:
+            return pd.read_sql_query(
+                'SELECT table_name, watermark, rows_loaded, loaded_at FROM ingestion_watermarks WHERE source = ?',
+                conn, params=(self.source.name,)
+            )
+        finally:
+            conn.close()
+    
+    def _load_batch(self, conn, table, batch):
+        """Upsert one batch and refresh what depends on it in a single transaction"""
+        rows = convert_records(table, batch.astype(object).where(batch.notna(), None).to_dict('records'))
+        with conn:
+            cursor = conn.cursor()
+            days = upsert_rows(cursor, table, rows)
+            if days:
+                refresh_daily_rollup(cursor, days)
+            cursor.execute('''
+                INSERT INTO ingestion_watermarks (source, table_name, watermark, rows_loaded, loaded_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source, table_name) DO UPDATE SET
+                    watermark = excluded.watermark,
+                    rows_loaded = rows_loaded + excluded.rows_loaded,
+                    loaded_at = excluded.loaded_at
+            ''', (self.source.name, table, batch[WATERMARK_COLUMN].iloc[-1], len(rows),
+                  datetime.now(timezone.utc).isoformat()))
+        return days
+    
+    def run_once(self):
+        """Load every change after the watermarks; returns rows, batches and rollup days per table"""
+        conn = self._connect()
+        report = []
+        try:
+            for table in INGESTED_TABLES:
+                start = time.perf_counter()
+                changes = self.source.fetch(table, self._watermark(conn, table))
+                count = 0
+                days = set()
+                for batch in batches(changes, self.batch_size):
+                    days |= self._load_batch(conn, table, batch)
+                    count += 1
+                report.append({
+                    'table': table,
+                    'rows': len(changes),
+                    'batches': count,
+                    'rollup_days': len(days),
+                    'watermark': self._watermark(conn, table),
+                    'seconds': time.perf_counter() - start
+                })
+        finally:
+            conn.close()
+        return pd.DataFrame(report)
+    
+    def run_forever(self, interval=60, rounds=None, before_round=None):
+        """Poll the source every interval seconds (for rounds rounds, or until interrupted)"""
+        completed = 0
+        while rounds is None or completed < rounds:
+            if before_round is not None:
+                before_round()
+            report = self.run_once()
+            print(f"{datetime.now():%H:%M:%S} " + ', '.join(
+                f"{row.table}: {row.rows} rows/{row.batches} batches/{row.rollup_days} days"
+                for row in report.itertuples()
+            ))
+            completed += 1
+            if rounds is None or completed < rounds:
+                time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally ingest HMS changes into the database")
+    parser.add_argument('--db', default='hospital_data.db')
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--drops', help="Directory the HMS drops <table>*.csv / *.json change files into")
+    source_group.add_argument('--simulate', action='store_true', help="Ingest from the local stand-in HMS")
+    parser.add_argument('--interval', type=float, default=60, help="Seconds between polls")
+    parser.add_argument('--rounds', type=int, help="Stop after this many polls (default: run until interrupted)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    
+    if args.simulate:
+        source = SimulatedHMSSource(args.db)
+        before_round = source.tick
+    else:
+        source = DropDirectorySource(args.drops)
+        before_round = None
+    pipeline = IngestionPipeline(source, args.db, args.batch_size)
+    pipeline.run_forever(args.interval, args.rounds, before_round)
@@ -46,8 +46,13 @@ st.markdown('<h2 style="text-align: center; color: #666;">Healthcare Data Analyt
 
 # Import analytics modules
 from data_generator import generate_sample_data
-from analytics_engine import AnalyticsEngine
-from visualization_utils import create_visualizations
+from analytics_engine import AnalyticsEngine, ROLLING_WINDOWS, TABLE_LISTINGS, load_branches
+from schema import migrate_database
+from visualization_utils import (create_visualizations, create_appointment_trends_chart,
+                                 create_multi_line_chart, create_spending_patterns_scatter,
+                                 create_binned_density_chart, create_error_band_chart,
+                                 create_moving_average_chart, FIGURE_CACHE,
+                                 SCATTER_WEBGL_THRESHOLD, SCATTER_DENSITY_THRESHOLD)
 
 # Initialize session state
 if 'data_loaded' not in st.session_state:
@@ -79,6 +84,8 @@ def load_data():
         patients = pd.read_sql_query("SELECT * FROM patients", conn)
         conn.close()
         if len(patients) > 0:
+            # Upgrade databases created by older versions of the app
+            migrate_database()
             return True
     except:
         pass
@@ -93,8 +100,144 @@ if not st.session_state.data_loaded:
         load_data()
         st.session_state.data_loaded = True
 
-# Initialize analytics engine
-analytics = AnalyticsEngine()
+# Branch databases listed in branches.json are analysed together; without
+# the file the app reads hospital_data.db alone
+BRANCHES = load_branches()
+branches = None
+compare_branches = False
+if BRANCHES:
+    st.sidebar.title("🏢 Branches")
+    selected_branches = st.sidebar.multiselect("Branches", list(BRANCHES), default=list(BRANCHES))
+    branches = {name: BRANCHES[name] for name in selected_branches} or BRANCHES
+    compare_branches = st.sidebar.checkbox("Compare branches", help="Split every chart by branch")
+    
+    @st.cache_resource
+    def migrate_branches(paths):
+        """Upgrade branch databases created by older versions of the app, once per process"""
+        for path in paths:
+            migrate_database(path)
+    
+    migrate_branches(tuple(BRANCHES.values()))
+
+# Unique patient counts are merged from the per-day patient sketches, with
+# their 95% margin shown, unless exact counts are asked for
+st.sidebar.title("🎯 Accuracy")
+exact_distinct = st.sidebar.checkbox("Exact unique patient counts",
+                                     help="Count distinct patients from the appointments instead of "
+                                          "merging HyperLogLog sketches (about ±1.6%)")
+approximate = st.sidebar.checkbox("Fast approximate charts",
+                                  help="Estimate the additive charts from a stratified 10% sample of the "
+                                       "appointments, with 95% error bars")
+
+# Initialize analytics engine; additive group-bys are answered from the
+# in-memory OLAP cube, rebuilt only when the database changes
+analytics = AnalyticsEngine(use_cube=True, branches=branches, by_branch=compare_branches,
+                            exact_distinct=exact_distinct, approximate=approximate)
+
+# Above this many patients, per-patient results are streamed and summarized
+STREAMING_PATIENT_THRESHOLD = 100000
+
+# Approximate plot width of a half-page chart and the number of series shown
+# before the rest are collapsed into "Other"
+CHART_WIDTH_PX = 700
+MAX_CHART_SERIES = 10
+
+# Rows fetched and rendered per page in the full listings
+TABLE_PAGE_SIZE = 25
+
+def by_branch(data, argument='color', **options):
+    """Chart arguments splitting a result by branch when branches are compared"""
+    return {argument: 'branch', **options} if 'branch' in data.columns else {}
+
+def error_bars(data, y):
+    """Chart arguments drawing the 95% margin of an estimated column as error bars"""
+    return {'error_y': f'{y}_margin'} if f'{y}_margin' in data.columns else {}
+
+def head_per_branch(data, rows):
+    """First rows of a result, or of each branch's rows when branches are compared"""
+    return data.groupby('branch', observed=True).head(rows) if 'branch' in data.columns else data.head(rows)
+
+def render_paginated_table(listing, page_size=TABLE_PAGE_SIZE):
+    """Show a listing one page at a time; sorting, filtering and paging run in SQL"""
+    spec = TABLE_LISTINGS[listing]
+    # Directories are kept per branch
+    engine = analytics
+    if BRANCHES:
+        engine = AnalyticsEngine(BRANCHES[st.selectbox("Branch", list(BRANCHES), key=f"{listing}_branch")])
+    controls = st.columns(2 + len(spec['filterable']))
+    search = controls[0].text_input("Search by name", key=f"{listing}_search")
+    sort_by = controls[1].selectbox("Sort by", spec['sortable'], key=f"{listing}_sort_by")
+    filters = {}
+    for control, column in zip(controls[2:], spec['filterable']):
+        selected = control.multiselect(column.replace('_', ' ').title(),
+                                       engine.get_listing_filter_options(listing, column),
+                                       key=f"{listing}_{column}")
+        if selected:
+            filters[column] = selected
+    descending = st.checkbox("Descending", key=f"{listing}_descending")
+    
+    # Cursors of the pages visited so far; a new sort or filter starts over
+    query_state = (search, sort_by, descending, tuple((k, tuple(v)) for k, v in filters.items()))
+    if st.session_state.get(f"{listing}_query") != query_state:
+        st.session_state[f"{listing}_query"] = query_state
+        st.session_state[f"{listing}_cursors"] = [None]
+    cursors = st.session_state[f"{listing}_cursors"]
+    
+    page, next_cursor = engine.get_table_page(listing, sort_by, descending, cursors[-1],
+                                              filters, search, page_size)
+    st.dataframe(page, hide_index=True, use_container_width=True)
+    
+    total_rows = engine.count_table_rows(listing, filters, search)
+    first_row = (len(cursors) - 1) * page_size
+    previous_col, status_col, next_col = st.columns([1, 3, 1])
+    previous_col.button("◀ Previous", key=f"{listing}_previous", disabled=len(cursors) == 1,
+                        on_click=lambda: cursors.pop())
+    status_col.caption(f"Page {len(cursors)} · rows {first_row + min(1, len(page))}–"
+                       f"{first_row + len(page)} of {total_rows:,}")
+    next_col.button("Next ▶", key=f"{listing}_next", disabled=next_cursor is None,
+                    on_click=lambda: cursors.append(next_cursor))
+
+# Cross-filters: picked in the sidebar or by clicking a bar or point, and
+# passed to the engine methods of the Services, Doctors and Billing pages
+CROSS_FILTERS = {
+    'department': "Department",
+    'doctor': "Doctor",
+    'service_type': "Service Type",
+    'payment_method': "Payment Method"
+}
+CROSS_FILTER_MODULES = ["Most Utilized Services", "Doctor Performance", "Billing & Revenue"]
+
+def apply_chart_selection(chart_key, dimension, field):
+    """on_select callback: copy the labels clicked in a chart into its cross-filter"""
+    points = st.session_state[chart_key]['selection']['points']
+    values = []
+    for point in points:
+        value = point.get(field)
+        if isinstance(value, list):
+            value = value[0]
+        if value is not None and value not in values:
+            values.append(value)
+    if values:
+        st.session_state[f"filter_{dimension}"] = values
+
+def clear_cross_filters():
+    for dimension in CROSS_FILTERS:
+        st.session_state[f"filter_{dimension}"] = []
+
+def plot_with_cross_filter(fig, chart_key, dimension, field='x'):
+    """Render a chart whose clicked bars or points filter the rest of the page"""
+    st.plotly_chart(fig, use_container_width=True, key=chart_key, selection_mode='points',
+                    on_select=lambda: apply_chart_selection(chart_key, dimension, field))
+
+filters = {}
+if module in CROSS_FILTER_MODULES:
+    st.sidebar.title("🔎 Cross-filters")
+    for dimension, label in CROSS_FILTERS.items():
+        selected = st.sidebar.multiselect(label, analytics.get_filter_options(dimension),
+                                          key=f"filter_{dimension}")
+        if selected:
+            filters[dimension] = selected
+    st.sidebar.button("Clear filters", on_click=clear_cross_filters, disabled=not filters)
 
 # Main content based on selected module
 if module == "Dashboard Overview":
@@ -104,8 +247,9 @@ if module == "Dashboard Overview":
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_patients = analytics.get_total_patients()
-        st.metric("Total Patients", f"{total_patients:,}")
+        total_patients = analytics.get_patient_count()
+        margin = f" ± {total_patients['margin']:,}" if total_patients['margin'] else ""
+        st.metric("Total Patients", f"{total_patients['total_patients']:,}{margin}")
     
     with col2:
         total_revenue = analytics.get_total_revenue()
@@ -125,22 +269,22 @@ if module == "Dashboard Overview":
     with col1:
         st.subheader("Revenue Trend (Last 12 Months)")
         revenue_trend = analytics.get_revenue_trend()
-        fig = px.line(revenue_trend, x='month', y='revenue', 
-                     title='Monthly Revenue Trend')
+        fig = FIGURE_CACHE.figure(create_error_band_chart, revenue_trend, 'month', 'revenue', 'Monthly Revenue Trend',
+                                  by_branch(revenue_trend).get('color'))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Service Utilization Distribution")
         service_util = analytics.get_service_utilization()
-        fig = px.pie(service_util, values='count', names='service_name',
-                     title='Services by Utilization')
+        fig = FIGURE_CACHE.figure(px.pie, service_util, values='count', names='service_name',
+                                  title='Services by Utilization', **by_branch(service_util, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
 
 elif module == "Most Utilized Services":
     st.header("🔬 Most Utilized Services Analysis")
     
     # Service utilization metrics
-    service_analysis = analytics.analyze_service_utilization()
+    service_analysis = analytics.analyze_service_utilization(filters)
     
     col1, col2 = st.columns(2)
     
@@ -149,29 +293,37 @@ elif module == "Most Utilized Services":
         st.dataframe(service_analysis['top_services'])
         
         st.subheader("Service Revenue Analysis")
-        revenue_by_service = analytics.get_revenue_by_service()
-        fig = px.bar(revenue_by_service.head(10), x='service_name', y='total_revenue',
-                     title='Top 10 Services by Revenue')
+        revenue_by_service = analytics.get_revenue_by_service(filters)
+        fig = FIGURE_CACHE.figure(px.bar, head_per_branch(revenue_by_service, 10), x='service_name', y='total_revenue',
+                                  title='Top 10 Services by Revenue', **error_bars(revenue_by_service, 'total_revenue'),
+                                  **by_branch(revenue_by_service, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Service Utilization Trends")
-        service_trends = analytics.get_service_trends()
-        fig = px.line(service_trends, x='month', y='appointments', 
-                     color='service_name', title='Service Utilization Trends')
+        service_trends = analytics.get_service_trends(filters)
+        fig = FIGURE_CACHE.figure(create_multi_line_chart, service_trends, 'month', 'appointments', 'service_name',
+                                  'Service Utilization Trends', MAX_CHART_SERIES, CHART_WIDTH_PX,
+                                  **by_branch(service_trends, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Department-wise Service Distribution")
-        dept_services = analytics.get_department_service_distribution()
-        fig = px.treemap(dept_services, path=['department_name', 'service_name'], 
-                        values='count', title='Service Distribution by Department')
+        dept_services = analytics.get_department_service_distribution(filters)
+        path = ['department_name', 'service_name']
+        if 'branch' in dept_services.columns:
+            path = ['branch'] + path
+        fig = FIGURE_CACHE.figure(px.treemap, dept_services, path=path, 
+                                  values='count', title='Service Distribution by Department')
         st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("All Services")
+    render_paginated_table('services')
 
 elif module == "Doctor Performance":
     st.header("👨‍⚕️ Doctor Performance Analysis")
     
     # Doctor performance metrics
-    doctor_analysis = analytics.analyze_doctor_performance()
+    doctor_analysis = analytics.analyze_doctor_performance(filters)
     
     col1, col2 = st.columns(2)
     
@@ -180,24 +332,30 @@ elif module == "Doctor Performance":
         st.dataframe(doctor_analysis['top_doctors'])
         
         st.subheader("Doctor Performance Comparison")
-        performance_metrics = analytics.get_doctor_performance_metrics()
-        fig = px.scatter(performance_metrics, x='appointments_handled', y='revenue_generated',
-                        size='patient_satisfaction', hover_data=['doctor_name'],
-                        title='Doctor Performance: Appointments vs Revenue')
-        st.plotly_chart(fig, use_container_width=True)
+        performance_metrics = analytics.get_doctor_performance_metrics(filters)
+        fig = FIGURE_CACHE.figure(px.scatter, performance_metrics, x='appointments_handled', y='revenue_generated',
+                                  size='patient_satisfaction', hover_data=['doctor_name'],
+                                  title='Doctor Performance: Appointments vs Revenue',
+                                  **by_branch(performance_metrics))
+        plot_with_cross_filter(fig, 'doctor_performance_chart', 'doctor', 'customdata')
     
     with col2:
         st.subheader("Doctor Revenue Trends")
-        doctor_revenue_trends = analytics.get_doctor_revenue_trends()
-        fig = px.line(doctor_revenue_trends, x='month', y='revenue', 
-                     color='doctor_name', title='Monthly Revenue by Doctor')
+        doctor_revenue_trends = analytics.get_doctor_revenue_trends(filters)
+        fig = FIGURE_CACHE.figure(create_multi_line_chart, doctor_revenue_trends, 'month', 'revenue', 'doctor_name',
+                                  'Monthly Revenue by Doctor', MAX_CHART_SERIES, CHART_WIDTH_PX,
+                                  **by_branch(doctor_revenue_trends, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Department-wise Doctor Performance")
-        dept_performance = analytics.get_department_doctor_performance()
-        fig = px.bar(dept_performance, x='department_name', y='avg_revenue_per_doctor',
-                     title='Average Revenue per Doctor by Department')
+        dept_performance = analytics.get_department_doctor_performance(filters)
+        fig = FIGURE_CACHE.figure(px.bar, dept_performance, x='department_name', y='avg_revenue_per_doctor',
+                                  title='Average Revenue per Doctor by Department',
+                                  **by_branch(dept_performance, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("All Doctors")
+    render_paginated_table('doctors')
 
 elif module == "Patient Trends":
     st.header("📅 Patient Trends Analysis")
@@ -210,97 +368,213 @@ elif module == "Patient Trends":
     with col1:
         st.subheader("Daily Appointment Trends")
         daily_trends = analytics.get_daily_appointment_trends()
-        fig = px.line(daily_trends, x='date', y='appointments', 
-                     title='Daily Appointment Trends')
+        fig = FIGURE_CACHE.figure(create_appointment_trends_chart, daily_trends, CHART_WIDTH_PX,
+                                  **by_branch(daily_trends))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Weekly Appointment Patterns")
         weekly_patterns = analytics.get_weekly_appointment_patterns()
-        fig = px.bar(weekly_patterns, x='day_of_week', y='appointments',
-                     title='Appointments by Day of Week')
+        fig = FIGURE_CACHE.figure(px.bar, weekly_patterns, x='day_of_week', y='appointments',
+                                  title='Appointments by Day of Week',
+                                  **by_branch(weekly_patterns, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Monthly Appointment Trends")
         monthly_trends = analytics.get_monthly_appointment_trends()
-        fig = px.line(monthly_trends, x='month', y='appointments',
-                     title='Monthly Appointment Trends')
+        fig = FIGURE_CACHE.figure(px.line, monthly_trends, x='month', y='appointments',
+                                  title='Monthly Appointment Trends', **by_branch(monthly_trends))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Seasonal Appointment Analysis")
         seasonal_analysis = analytics.get_seasonal_appointment_analysis()
-        fig = px.bar(seasonal_analysis, x='season', y='appointments',
-                     title='Appointments by Season')
+        fig = FIGURE_CACHE.figure(px.bar, seasonal_analysis, x='season', y='appointments',
+                                  title='Appointments by Season',
+                                  **by_branch(seasonal_analysis, barmode='group'))
+        st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("Moving Averages")
+    rolling_days = st.radio("Range", [90, 365, 1095], format_func=lambda days: f"Last {days} days", horizontal=True)
+    rolling_trends = analytics.get_rolling_daily_trends(rolling_days)
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        fig = FIGURE_CACHE.figure(create_moving_average_chart, rolling_trends, 'date', 'appointments', ROLLING_WINDOWS,
+                                  'Daily Appointments', by_branch(rolling_trends).get('color'))
+        st.plotly_chart(fig, use_container_width=True)
+    
+    with col2:
+        fig = FIGURE_CACHE.figure(create_moving_average_chart, rolling_trends, 'date', 'revenue', ROLLING_WINDOWS,
+                                  'Daily Paid Revenue', by_branch(rolling_trends).get('color'))
+        st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("Unique Patients")
+    col1, col2 = st.columns([1, 3])
+    
+    with col1:
+        if len(date_range) == 2:
+            unique_patients = analytics.get_unique_patients(*date_range)
+            margin = f" ± {unique_patients['margin']:,}" if unique_patients['margin'] else ""
+            st.metric("Patients Seen in Date Range", f"{unique_patients['unique_patients']:,}{margin}")
+        period = st.radio("Per", ['month', 'quarter', 'year'], format_func=str.title, horizontal=True)
+    
+    with col2:
+        unique_trends = analytics.get_unique_patient_trends(period, months=36)
+        fig = FIGURE_CACHE.figure(px.bar, unique_trends, x='period', y='unique_patients',
+                                  title=f'Unique Patients per {period.title()}',
+                                  **error_bars(unique_trends, 'unique_patients'),
+                                  **by_branch(unique_trends, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
 
 elif module == "Patient Behavior":
     st.header("👥 Patient Behavior Analysis")
     
     # Patient behavior analysis
-    behavior_analysis = analytics.analyze_patient_behavior()
+    use_streaming = analytics.get_total_patients() > STREAMING_PATIENT_THRESHOLD
+    behavior_analysis = analytics.analyze_patient_behavior(streaming=use_streaming)
     
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Patient Visit Frequency Distribution")
-        visit_frequency = analytics.get_patient_visit_frequency()
-        fig = px.histogram(visit_frequency, x='visit_count', nbins=20,
-                          title='Distribution of Patient Visit Frequency')
+        visit_frequency = behavior_analysis['visit_frequency']
+        fig = FIGURE_CACHE.figure(px.histogram, visit_frequency, x='visit_count', nbins=20,
+                                  title='Distribution of Patient Visit Frequency',
+                                  **by_branch(visit_frequency, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Patient Spending Patterns")
-        spending_patterns = analytics.get_patient_spending_patterns()
-        fig = px.scatter(spending_patterns, x='total_visits', y='total_spent',
-                        size='avg_spend_per_visit', title='Patient Spending vs Visits')
+        if use_streaming:
+            fig = FIGURE_CACHE.figure(create_binned_density_chart, behavior_analysis['spending_density'],
+                                      'total_visits', 'spend_bin', 'patients',
+                                      'Patient Spending vs Visits', "Total Visits",
+                                      "Total Spent (Rs.)")
+        else:
+            spending_patterns = behavior_analysis['spending_patterns']
+            fig = FIGURE_CACHE.figure(create_spending_patterns_scatter, spending_patterns, SCATTER_WEBGL_THRESHOLD,
+                                      SCATTER_DENSITY_THRESHOLD,
+                                      **by_branch(spending_patterns))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Patient Segmentation by Value")
-        patient_segments = analytics.get_patient_segments()
-        fig = px.pie(patient_segments, values='count', names='segment',
-                     title='Patient Segmentation')
+        patient_segments = behavior_analysis['patient_segments']
+        fig = FIGURE_CACHE.figure(px.pie, patient_segments, values='count', names='segment',
+                                  title='Patient Segmentation', **by_branch(patient_segments, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Service Preference Analysis")
         service_preferences = analytics.get_service_preferences()
-        fig = px.bar(service_preferences, x='service_name', y='preference_score',
-                     title='Patient Service Preferences')
+        fig = FIGURE_CACHE.figure(px.bar, service_preferences, x='service_name', y='preference_score',
+                                  title='Patient Service Preferences',
+                                  **error_bars(service_preferences, 'preference_score'),
+                                  **by_branch(service_preferences, barmode='group'))
         st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("Patient Directory")
+    render_paginated_table('patients')
 
 elif module == "Billing & Revenue":
     st.header("💰 Billing & Revenue Analysis")
     
     # Revenue analysis
-    revenue_analysis = analytics.analyze_revenue()
+    revenue_analysis = analytics.analyze_revenue(filters)
     
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Monthly Revenue Trends")
-        monthly_revenue = analytics.get_monthly_revenue_trends()
-        fig = px.line(monthly_revenue, x='month', y='revenue',
-                     title='Monthly Revenue Trends')
+        monthly_revenue = revenue_analysis['monthly_trends']
+        fig = FIGURE_CACHE.figure(px.line, monthly_revenue, x='month', y='revenue',
+                                  title='Monthly Revenue Trends', **by_branch(monthly_revenue))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Revenue by Department")
-        dept_revenue = analytics.get_revenue_by_department()
-        fig = px.bar(dept_revenue, x='department_name', y='total_revenue',
-                     title='Revenue by Department')
-        st.plotly_chart(fig, use_container_width=True)
+        dept_revenue = revenue_analysis['department_revenue']
+        fig = FIGURE_CACHE.figure(px.bar, dept_revenue, x='department_name', y='total_revenue',
+                                  title='Revenue by Department', **error_bars(dept_revenue, 'total_revenue'),
+                                  **by_branch(dept_revenue, barmode='group'))
+        plot_with_cross_filter(fig, 'department_revenue_chart', 'department')
     
     with col2:
         st.subheader("Revenue by Service Type")
-        service_revenue = analytics.get_revenue_by_service_type()
-        fig = px.pie(service_revenue, values='revenue', names='service_type',
-                     title='Revenue Distribution by Service Type')
+        service_revenue = revenue_analysis['service_type_revenue']
+        fig = FIGURE_CACHE.figure(px.pie, service_revenue, values='revenue', names='service_type',
+                                  title='Revenue Distribution by Service Type',
+                                  **by_branch(service_revenue, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Revenue per Doctor Analysis")
-        doctor_revenue = analytics.get_revenue_per_doctor()
-        fig = px.bar(doctor_revenue.head(15), x='doctor_name', y='total_revenue',
-                     title='Top 15 Doctors by Revenue')
+        doctor_revenue = analytics.get_revenue_per_doctor(filters)
+        fig = FIGURE_CACHE.figure(px.bar, head_per_branch(doctor_revenue, 15), x='doctor_name', y='total_revenue',
+                                  title='Top 15 Doctors by Revenue', **error_bars(doctor_revenue, 'total_revenue'),
+                                  **by_branch(doctor_revenue, barmode='group'))
+        plot_with_cross_filter(fig, 'doctor_revenue_chart', 'doctor')
+    
+    st.subheader("Month-over-Month and Year-over-Year Growth")
+    growth = analytics.get_monthly_growth(12, filters)
+    st.dataframe(growth, hide_index=True, column_config={
+        column: st.column_config.NumberColumn(format="%+.1f%%") for column in growth.columns if column.endswith('_pct')
+    })
+    
+    st.subheader("Revenue by Payment Method")
+    payment_revenue = revenue_analysis['payment_method_revenue']
+    fig = FIGURE_CACHE.figure(px.bar, payment_revenue, x='payment_method', y='revenue',
+                              title='Revenue by Payment Method', **error_bars(payment_revenue, 'revenue'),
+                              **by_branch(payment_revenue, barmode='group'))
+    plot_with_cross_filter(fig, 'payment_method_revenue_chart', 'payment_method')
+    
+    # Percentiles merged from the per-day t-digests over the sidebar date range
+    percentile_range = date_range if len(date_range) == 2 else (None, None)
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.subheader("Bill Amount Percentiles by Service")
+        amount_percentiles = analytics.get_bill_amount_percentiles(*percentile_range, filters)
+        st.dataframe(amount_percentiles.rename(columns={'p50': 'median'}), hide_index=True)
+    
+    with col2:
+        st.subheader("Payment Lag by Payment Method")
+        lag_percentiles = analytics.get_payment_lag_percentiles(*percentile_range, filters)
+        lag_long = lag_percentiles.melt(id_vars=[column for column in ('branch', 'payment_method')
+                                                 if column in lag_percentiles.columns],
+                                        value_vars=['p50', 'p90', 'p99'], var_name='percentile', value_name='days')
+        fig = FIGURE_CACHE.figure(px.bar, lag_long, x='payment_method', y='days', color='percentile', barmode='group',
+                                  title='Days from Appointment to Payment (Paid Bills)',
+                                  **by_branch(lag_long, 'facet_col'))
         st.plotly_chart(fig, use_container_width=True)
 
+# Performance panel
+with st.sidebar.expander("⚙️ Performance"):
+    cube = analytics.get_cube()
+    st.caption(f"{'Sample' if analytics.approximate else 'OLAP'} cube: {len(cube.cells):,} cells, "
+               f"{cube.nbytes / 1024:,.1f} KB")
+    cache_stats = FIGURE_CACHE.stats()
+    st.caption(
+        f"Figure cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%}), {cache_stats['entries']} figures, "
+        f"{cache_stats['bytes'] / 1024:,.1f} KB"
+    )
+    if cache_stats['raw_bytes']:
+        st.caption(
+            f"Chart payload compaction: {cache_stats['raw_bytes'] / 1024:,.1f} KB → "
+            f"{cache_stats['bytes'] / 1024:,.1f} KB "
+            f"({1 - cache_stats['bytes'] / cache_stats['raw_bytes']:.0%} smaller)"
+        )
+    memory_report = analytics.get_memory_report()
+    if len(memory_report) > 0:
+        st.caption(
+            f"Result memory: {memory_report['bytes_before'].sum() / 1024:,.1f} KB → "
+            f"{memory_report['bytes_after'].sum() / 1024:,.1f} KB"
+        )
+        st.dataframe(memory_report, hide_index=True)
+    if st.button("Reconcile KPI counters"):
+        kpi_report = analytics.check_kpi_counters(reconcile=True)
+        drifted = int((~kpi_report['consistent']).sum())
+        st.caption(f"KPI counters: {drifted} of {len(kpi_report)} drifted from a full scan and were reset"
+                   if drifted else "KPI counters match a full scan")
+        st.dataframe(kpi_report, hide_index=True)
+
 # Footer
 st.markdown("---")
 st.markdown("""
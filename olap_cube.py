@@ -0,0 +1,313 @@
+import os
+import sqlite3
+from datetime import date
+import pandas as pd
+import numpy as np
+from schema import APPOINTMENT_STATUSES, PAYMENT_STATUSES, PAYMENT_METHODS, from_day_number, to_day_number
+from partitions import partition_batches, reads_partitioned_tables
+
+# Measures summed in every cell. Row counts follow the SQL methods, which count
+# appointments joined to their (at most one) billing record
+MEASURES = ['appointments', 'billed', 'revenue']
+COUNT_MEASURES = ['appointments', 'billed']
+
+# A sample cube holds Horvitz-Thompson estimates of the measures (weighted by
+# 1 / inclusion probability) and their estimated variances, which add up
+# across cells like the measures do
+SAMPLE_MEASURES = MEASURES + [f'{measure}_variance' for measure in MEASURES]
+
+# Dimensions stored as cell keys, and derived dimensions that roll up from the
+# service of each appointment
+BASE_DIMENSIONS = ['month', 'payment_month', 'service', 'doctor', 'status', 'payment_status', 'payment_method']
+DERIVED_DIMENSIONS = {'department': 'department_name', 'service_type': 'type'}
+DIMENSIONS = BASE_DIMENSIONS + list(DERIVED_DIMENSIONS)
+
+# Payment status and method code stored for appointments without a billing record
+NO_PAYMENT = 0
+
+# Calendar alias of each month dimension in the cells queries
+MONTH_CALENDARS = {'month': 'c', 'payment_month': 'pc'}
+
+CELLS_QUERY = """
+SELECT
+    c.month_key as month,
+    COALESCE(pc.month_key, 0) as payment_month,
+    a.service_id as service,
+    a.doctor_id as doctor,
+    a.status_code as status,
+    COALESCE(b.payment_status_code, 0) as payment_status,
+    COALESCE(b.payment_method_code, 0) as payment_method,
+    COUNT(*) as appointments,
+    COUNT(b.billing_id) as billed,
+    COALESCE(SUM(b.amount), 0) as revenue
+FROM appointments a
+JOIN calendar c ON c.day = a.appointment_day
+LEFT JOIN billing b ON b.appointment_id = a.appointment_id
+LEFT JOIN calendar pc ON pc.day = b.payment_day{where}
+GROUP BY 1, 2, 3, 4, 5, 6, 7
+"""
+
+SERVICES_QUERY = """
+SELECT s.service_id, s.name, s.type, d.name as department_name, s.cost
+FROM services s
+JOIN departments d ON s.department_id = d.department_id
+"""
+
+SAMPLE_CELLS_QUERY = """
+SELECT
+    c.month_key as month,
+    COALESCE(pc.month_key, 0) as payment_month,
+    s.service_id as service,
+    s.doctor_id as doctor,
+    s.status_code as status,
+    COALESCE(s.payment_status_code, 0) as payment_status,
+    COALESCE(s.payment_method_code, 0) as payment_method,
+    SUM(s.weight) as appointments,
+    TOTAL(CASE WHEN s.billing_id IS NOT NULL THEN s.weight END) as billed,
+    TOTAL(s.weight * s.amount) as revenue,
+    SUM(s.weight * (s.weight - 1)) as appointments_variance,
+    TOTAL(CASE WHEN s.billing_id IS NOT NULL THEN s.weight * (s.weight - 1) END) as billed_variance,
+    TOTAL(s.weight * (s.weight - 1) * s.amount * s.amount) as revenue_variance
+FROM appointment_sample s
+JOIN calendar c ON c.day = s.day
+LEFT JOIN calendar pc ON pc.day = s.payment_day{where}
+GROUP BY 1, 2, 3, 4, 5, 6, 7
+"""
+
+DOCTORS_QUERY = """
+SELECT doc.doctor_id, doc.name, doc.specialization, d.name as department_name
+FROM doctors doc
+JOIN departments d ON doc.department_id = d.department_id
+"""
+
+def data_version(db_path):
+    """Cheap signature of the database contents: size and mtime of the file and its WAL"""
+    version = []
+    for path in (db_path, db_path + '-wal'):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+def month_key(day):
+    """YYYYMM month key of a day number"""
+    value = from_day_number(day)
+    return value.year * 100 + value.month
+
+def month_label(key):
+    """'YYYY-MM' label of a YYYYMM month key"""
+    return f"{key // 100:04d}-{key % 100:02d}"
+
+def _smallest_integer(values):
+    return pd.to_numeric(values, downcast='integer')
+
+class OLAPCube:
+    """Pre-aggregated appointment and billing facts with roll-up, slice and dice
+    
+    Cells hold the measures for each combination of appointment month, payment
+    month, service, doctor, status, payment status and payment method. Department and service
+    type are derived from the service. Filters take labels (service and doctor
+    names, status names, 'YYYY-MM' months) and return a new cube sharing the
+    dimension tables, so they can be chained.
+    """
+    
+    def __init__(self, cells, services, doctors, version=None, measures=MEASURES):
+        self.cells = cells
+        self.services = services
+        self.doctors = doctors
+        self.version = version
+        self.measures = measures
+    
+    @classmethod
+    def build(cls, conn, version=None, cells_query=CELLS_QUERY, measures=MEASURES, where='', params=()):
+        """Aggregate the fact tables (or the appointment sample) of an open connection into a cube
+        
+        where, an SQL condition on the facts starting with AND, narrows them.
+        Year partitions are attached as many at a time as the connection
+        allows; cells are keyed by appointment month, so each batch's cells
+        are its own.
+        """
+        cells_query = cells_query.format(where=f"\nWHERE 1 = 1 {where}" if where else '')
+        if reads_partitioned_tables(cells_query):
+            cells = pd.concat([pd.read_sql_query(cells_query, conn, params=params or None)
+                               for _ in partition_batches(conn)], ignore_index=True)
+        else:
+            cells = pd.read_sql_query(cells_query, conn, params=params or None)
+        services = pd.read_sql_query(SERVICES_QUERY, conn).set_index('service_id')
+        doctors = pd.read_sql_query(DOCTORS_QUERY, conn).set_index('doctor_id')
+        
+        for column in BASE_DIMENSIONS + COUNT_MEASURES:
+            cells[column] = _smallest_integer(cells[column])
+        for dimension, attribute in DERIVED_DIMENSIONS.items():
+            labels = services[attribute].astype('category')
+            cells[dimension] = pd.Categorical(cells['service'].map(labels), categories=labels.cat.categories)
+        return cls(cells, services, doctors, version, measures)
+    
+    @property
+    def nbytes(self):
+        """Memory used by the cells and dimension tables"""
+        return int(sum(frame.memory_usage(deep=True).sum()
+                       for frame in (self.cells, self.services, self.doctors)))
+    
+    def _codes(self, dimension, values):
+        """Translate labels of a dimension to the values stored in the cells"""
+        if dimension in ('month', 'payment_month'):
+            return [int(str(value).replace('-', '')) for value in values]
+        if dimension == 'service':
+            return self.services.index[self.services['name'].isin(values)].tolist()
+        if dimension == 'doctor':
+            return self.doctors.index[self.doctors['name'].isin(values)].tolist()
+        if dimension == 'status':
+            return [APPOINTMENT_STATUSES[value] for value in values]
+        if dimension == 'payment_status':
+            return [PAYMENT_STATUSES[value] if value is not None else NO_PAYMENT for value in values]
+        if dimension == 'payment_method':
+            return [PAYMENT_METHODS[value] if value is not None else NO_PAYMENT for value in values]
+        if dimension in DERIVED_DIMENSIONS:
+            return list(values)
+        raise ValueError(f"Unknown dimension {dimension!r}; expected one of {DIMENSIONS}")
+    
+    def _filtered(self, mask):
+        return OLAPCube(self.cells[mask], self.services, self.doctors, self.version, self.measures)
+    
+    def dice(self, **criteria):
+        """Keep cells whose dimensions take any of the given values (a label or a list of labels)"""
+        mask = np.ones(len(self.cells), dtype=bool)
+        for dimension, values in criteria.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            mask &= self.cells[dimension].isin(self._codes(dimension, values)).to_numpy()
+        return self._filtered(mask)
+    
+    def slice(self, dimension, value):
+        """Fix one dimension to a single value"""
+        return self.dice(**{dimension: [value]})
+    
+    def since(self, dimension, day, first_month=None):
+        """Keep cells from the month containing a day number onwards on a month dimension
+        
+        Cells are kept at month grain, so that month is whole unless
+        first_month, a cube of its days from day on (load_month_from),
+        stands in for it.
+        """
+        if dimension not in MONTH_CALENDARS:
+            raise ValueError(f"{dimension!r} is not a month dimension")
+        if first_month is None:
+            return self._filtered((self.cells[dimension] >= month_key(day)).to_numpy())
+        later = self.cells[self.cells[dimension] > month_key(day)]
+        # The first month's cells are a subset of the month's, so they fit the cube's dtypes
+        first = first_month.cells.astype(self.cells.dtypes.to_dict())
+        return OLAPCube(pd.concat([later, first], ignore_index=True), self.services, self.doctors,
+                        self.version, self.measures)
+    
+    def roll_up(self, *dimensions, attributes=None):
+        """Sum the measures up to the given dimensions
+        
+        attributes maps 'service' or 'doctor' to extra columns of its dimension
+        table to include, e.g. {'doctor': ['specialization']}. Adds
+        avg_amount, the mean billed amount per billed appointment.
+        """
+        dimensions = list(dimensions)
+        if dimensions:
+            result = (self.cells.groupby(dimensions, observed=True, sort=False)[self.measures]
+                      .sum().reset_index())
+        else:
+            result = pd.DataFrame([self.cells[self.measures].sum()])
+        position = len(dimensions)
+        for dimension, columns in (attributes or {}).items():
+            table = self.services if dimension == 'service' else self.doctors
+            for column in columns:
+                result.insert(position, column, result[dimension].map(table[column]).to_numpy())
+                position += 1
+        result['avg_amount'] = result['revenue'] / result['billed'].where(result['billed'] > 0)
+        return self._decode(result, dimensions)
+    
+    def _decode(self, result, dimensions):
+        """Replace stored codes with labels"""
+        statuses = {code: name for name, code in APPOINTMENT_STATUSES.items()}
+        payment_statuses = {code: name for name, code in PAYMENT_STATUSES.items()}
+        payment_methods = {code: name for name, code in PAYMENT_METHODS.items()}
+        for dimension in dimensions:
+            column = result[dimension]
+            if dimension in ('month', 'payment_month'):
+                result[dimension] = [month_label(key) if key else None for key in column]
+            elif dimension == 'service':
+                result[dimension] = column.map(self.services['name']).to_numpy()
+            elif dimension == 'doctor':
+                result[dimension] = column.map(self.doctors['name']).to_numpy()
+            elif dimension == 'status':
+                result[dimension] = column.map(statuses).to_numpy()
+            elif dimension == 'payment_status':
+                result[dimension] = column.map(payment_statuses).to_numpy()
+            elif dimension == 'payment_method':
+                result[dimension] = column.map(payment_methods).to_numpy()
+            else:
+                result[dimension] = column.astype(str)
+        return result
+    
+    def total(self):
+        """Measures summed over the whole cube"""
+        return self.roll_up().iloc[0]
+
+# Cubes survive Streamlit reruns; each database keeps the cube for its latest version
+_CUBES = {}
+_SAMPLE_CUBES = {}
+_FIRST_MONTHS = {}
+
+def load_cube(db_path='hospital_data.db'):
+    """Cube for the current data version of a database, rebuilt only when the file changes"""
+    key = os.path.abspath(db_path)
+    version = data_version(db_path)
+    cube = _CUBES.get(key)
+    if cube is None or cube.version != version:
+        conn = sqlite3.connect(db_path)
+        try:
+            cube = OLAPCube.build(conn, version)
+        finally:
+            conn.close()
+        _CUBES[key] = cube
+    return cube
+
+def load_sample_cube(db_path='hospital_data.db'):
+    """Cube of estimates from the stratified appointment sample, rebuilt only when the file changes
+    
+    The sample lives in the main database file, so year partitions are never read.
+    """
+    key = os.path.abspath(db_path)
+    version = data_version(db_path)
+    cube = _SAMPLE_CUBES.get(key)
+    if cube is None or cube.version != version:
+        conn = sqlite3.connect(db_path)
+        try:
+            cube = OLAPCube.build(conn, version, SAMPLE_CELLS_QUERY, SAMPLE_MEASURES)
+        finally:
+            conn.close()
+        _SAMPLE_CUBES[key] = cube
+    return cube
+
+def load_month_from(db_path, dimension, day, sample=False):
+    """Cube of the month containing a day number, from that day on along a month dimension
+    
+    For trailing windows that start mid-month (see OLAPCube.since); rebuilt
+    when the file changes or the day moves on. sample reads the stratified
+    appointment sample like load_sample_cube.
+    """
+    if dimension not in MONTH_CALENDARS:
+        raise ValueError(f"{dimension!r} is not a month dimension")
+    key = (os.path.abspath(db_path), dimension, sample)
+    version = (data_version(db_path), day)
+    cube = _FIRST_MONTHS.get(key)
+    if cube is None or cube.version != version:
+        first = from_day_number(day)
+        month_index = first.year * 12 + first.month
+        month_end = to_day_number(date(month_index // 12, month_index % 12 + 1, 1)) - 1
+        conn = sqlite3.connect(db_path)
+        try:
+            cube = OLAPCube.build(conn, version, SAMPLE_CELLS_QUERY if sample else CELLS_QUERY,
+                                  SAMPLE_MEASURES if sample else MEASURES,
+                                  f"AND {MONTH_CALENDARS[dimension]}.day BETWEEN ? AND ?",
+                                  (day, month_end))
+        finally:
+            conn.close()
+        _FIRST_MONTHS[key] = cube
+    return cube
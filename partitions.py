@@ -0,0 +1,290 @@
+import argparse
+import os
+import re
+import sqlite3
+import stat
+from datetime import date
+from pathlib import Path
+import pandas as pd
+from schema import (KPI_COUNTERS, create_appointments_table, create_billing_table, refresh_kpi_counters,
+                    to_day_number, today_utc)
+
+# Fact tables split into per-year files. Billing rows follow their appointment,
+# so a partition holds a year of appointments and every bill raised for them
+PARTITIONED_TABLES = ['appointments', 'billing']
+
+# Databases a connection can attach: SQLite's default SQLITE_LIMIT_ATTACHED,
+# for Pythons before 3.11, whose connections cannot report their limit
+MAX_ATTACHED = 10
+
+# Appointment ids looked up in a partition per query
+ID_CHUNK = 500
+
+# A query reads the partitioned tables if it names one after FROM or JOIN
+PARTITIONED_TABLE_PATTERN = re.compile(rf"\b(?:FROM|JOIN)\s+(?:{'|'.join(PARTITIONED_TABLES)})\b", re.IGNORECASE)
+
+def create_partition_table(cursor):
+    """Create the registry of year partitions in the main database"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS partitions (
+            year INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            first_day INTEGER,
+            last_day INTEGER,
+            appointments INTEGER NOT NULL DEFAULT 0,
+            billing INTEGER NOT NULL DEFAULT 0,
+            read_only INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def partition_path(db_path, year):
+    """File holding one year of a database, next to it: hospital_data_2023.db"""
+    root, extension = os.path.splitext(db_path)
+    return f"{root}_{year}{extension or '.db'}"
+
+def _main_path(conn):
+    return next(row[2] for row in conn.execute('PRAGMA database_list') if row[1] == 'main')
+
+def _columns(conn, table, stored_only=False, schema='main'):
+    """Column names of a table; stored_only leaves out generated columns"""
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_xinfo({table})')
+            if not (stored_only and row[6] != 0)]
+
+def _select_columns(conn, table, schema, columns):
+    """Select list reading main's columns from a partition written before some of them existed"""
+    present = set(_columns(conn, table, schema=schema))
+    return ', '.join(column if column in present else f'NULL AS {column}' for column in columns)
+
+def reads_partitioned_tables(query):
+    """Whether a query reads appointments or billing, whose older years may be in partitions"""
+    return PARTITIONED_TABLE_PATTERN.search(query) is not None
+
+def attach_limit(conn):
+    """Partitions that can still be attached to a connection"""
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, 'getlimit') else MAX_ATTACHED
+    attached = [row for row in conn.execute('PRAGMA database_list') if row[1] not in ('main', 'temp')]
+    return limit - len(attached)
+
+def overlapping_partitions(conn, start_day=None, end_day=None):
+    """(year, path) of the registered partitions holding days of a range, oldest first"""
+    if conn.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'partitions'").fetchone() is None:
+        return []
+    return conn.execute('''
+        SELECT year, path FROM main.partitions
+        WHERE (? IS NULL OR last_day >= ?) AND (? IS NULL OR first_day <= ?)
+        ORDER BY year
+    ''', (start_day, start_day, end_day, end_day)).fetchall()
+
+def attach_partitions(conn, start_day=None, end_day=None, partitions=None, include_main=True):
+    """Attach the partitions overlapping a day range and shadow the fact tables with UNION ALL views
+    
+    The views are TEMP objects named like the tables, so unqualified SQL on
+    this connection reads the main database and the attached years alike.
+    Partitions whose days fall outside the range are not attached at all.
+    partitions, (year, path) rows, replaces the ones overlapping the range,
+    and without include_main the views read only them. More partitions than
+    the connection can attach raise ValueError: partition_batches reads
+    them a batch at a time instead. Returns the years attached.
+    """
+    rows = overlapping_partitions(conn, start_day, end_day) if partitions is None else partitions
+    if not rows:
+        return []
+    limit = attach_limit(conn)
+    if len(rows) > limit:
+        raise ValueError(f"{len(rows)} partitions overlap the range but only {limit} can be attached; "
+                         "read them with partition_batches")
+    directory = os.path.dirname(_main_path(conn))
+    for year, path in rows:
+        path = os.path.join(directory, path)
+        # ATTACH would silently create an empty database in place of a missing partition
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Partition {year} is registered but {path} is missing")
+        conn.execute('ATTACH DATABASE ? AS ?', (path, f'p{year}'))
+    for table in PARTITIONED_TABLES:
+        columns = _columns(conn, table)
+        selects = ([f"SELECT {', '.join(columns)} FROM main.{table}"] if include_main else []) + [
+            f'SELECT {_select_columns(conn, table, f"p{year}", columns)} FROM p{year}.{table}' for year, _ in rows
+        ]
+        conn.execute(f"CREATE TEMP VIEW {table} AS {' UNION ALL '.join(selects)}")
+    return [year for year, _ in rows]
+
+def detach_partitions(conn):
+    """Drop the fact-table views and detach every partition"""
+    for table in PARTITIONED_TABLES:
+        conn.execute(f'DROP VIEW IF EXISTS temp.{table}')
+    for _, name, _ in conn.execute('PRAGMA database_list').fetchall():
+        if re.fullmatch(r'p\d+', name):
+            conn.execute(f'DETACH DATABASE {name}')
+
+def partition_batches(conn, start_day=None, end_day=None):
+    """Attach the partitions overlapping a day range as many at a time as the connection allows
+    
+    Yields the years of each batch. Only the first batch's views read the
+    main database too, so every row is read in exactly one batch; with
+    few enough partitions there is a single batch, as attach_partitions
+    gives. Each batch is detached before the next.
+    """
+    rows = overlapping_partitions(conn, start_day, end_day)
+    size = max(attach_limit(conn), 1)
+    for start in range(0, max(len(rows), 1), size):
+        batch = rows[start:start + size]
+        attach_partitions(conn, partitions=batch, include_main=start == 0)
+        try:
+            yield [year for year, _ in batch]
+        finally:
+            detach_partitions(conn)
+
+def kpi_counter_values(conn):
+    """Full-scan values of the KPI counters over the main database and every partition, a batch at a time"""
+    values = dict.fromkeys(KPI_COUNTERS, 0)
+    for batch, _ in enumerate(partition_batches(conn)):
+        for name, query in KPI_COUNTERS.items():
+            # Counters of unpartitioned tables (patients) are read once
+            if batch == 0 or reads_partitioned_tables(query):
+                values[name] += conn.execute(query).fetchone()[0]
+    return values
+
+def partitioned_appointments(conn, appointment_ids):
+    """The appointment ids among these that a year partition holds
+    
+    Partitions are opened on connections of their own, read-only, so this
+    works inside the caller's transaction.
+    """
+    ids = list(appointment_ids)
+    found = set()
+    if not ids:
+        return found
+    directory = os.path.dirname(_main_path(conn))
+    for _, path in overlapping_partitions(conn):
+        partition = sqlite3.connect(f"{Path(os.path.join(directory, path)).absolute().as_uri()}?mode=ro", uri=True)
+        try:
+            for start in range(0, len(ids), ID_CHUNK):
+                chunk = ids[start:start + ID_CHUNK]
+                found.update(appointment_id for (appointment_id,) in partition.execute(
+                    f"SELECT appointment_id FROM appointments WHERE appointment_id IN ({', '.join('?' * len(chunk))})",
+                    chunk))
+        finally:
+            partition.close()
+    return found
+
+def list_partitions(db_path):
+    """Registered partitions with their day range, row counts and file size"""
+    conn = sqlite3.connect(db_path)
+    try:
+        create_partition_table(conn.cursor())
+        partitions = pd.read_sql_query('SELECT * FROM partitions ORDER BY year', conn)
+    finally:
+        conn.close()
+    directory = os.path.dirname(os.path.abspath(db_path))
+    partitions['bytes'] = [os.path.getsize(os.path.join(directory, path)) for path in partitions['path']]
+    return partitions
+
+def partition_year(db_path, year, read_only=True, compact=True):
+    """Move a closed year of appointments and their billing into its own database file
+    
+    Indexes are mirrored in the partition. Deleting the rows from the main
+    database fires the KPI counter triggers, so the counters are refreshed
+    afterwards over all partitions. The daily rollup keeps the moved days.
+    A compacted partition is vacuumed; a read-only one is made unwritable
+    on disk. Later changes to a partitioned year are not supported.
+    """
+    if year >= today_utc().year:
+        raise ValueError(f"Only closed years can be partitioned; {year} is still open")
+    first, last = to_day_number(date(year, 1, 1)), to_day_number(date(year, 12, 31))
+    path = partition_path(db_path, year)
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        create_partition_table(cursor)
+        sealed = conn.execute('SELECT read_only FROM partitions WHERE year = ?', (year,)).fetchone()
+        if sealed and sealed[0]:
+            raise ValueError(f"Partition {year} is read-only")
+        cursor.execute('ATTACH DATABASE ? AS part', (path,))
+        create_appointments_table(cursor, 'part.appointments')
+        create_billing_table(cursor, 'part.billing')
+        appointment_columns, billing_columns = [
+            ', '.join(column for column in _columns(conn, table, stored_only=True)
+                      if column in _columns(conn, table, schema='part'))
+            for table in PARTITIONED_TABLES
+        ]
+        with conn:
+            cursor.execute(f'''
+                INSERT INTO part.appointments ({appointment_columns})
+                SELECT {appointment_columns} FROM main.appointments WHERE appointment_day BETWEEN ? AND ?
+            ''', (first, last))
+            cursor.execute(f'''
+                INSERT INTO part.billing ({billing_columns})
+                SELECT {billing_columns} FROM main.billing
+                WHERE appointment_id IN (SELECT appointment_id FROM main.appointments
+                                         WHERE appointment_day BETWEEN ? AND ?)
+            ''', (first, last))
+            cursor.execute('''
+                DELETE FROM main.billing
+                WHERE appointment_id IN (SELECT appointment_id FROM main.appointments
+                                         WHERE appointment_day BETWEEN ? AND ?)
+            ''', (first, last))
+            cursor.execute('DELETE FROM main.appointments WHERE appointment_day BETWEEN ? AND ?', (first, last))
+            cursor.execute('''
+                INSERT OR REPLACE INTO partitions (year, path, first_day, last_day, appointments, billing, read_only)
+                SELECT ?, ?, MIN(low), MAX(high),
+                       (SELECT COUNT(*) FROM part.appointments), (SELECT COUNT(*) FROM part.billing), 0
+                FROM (
+                    SELECT MIN(appointment_day) as low, MAX(appointment_day) as high FROM part.appointments
+                    UNION ALL
+                    SELECT MIN(payment_day), MAX(payment_day) FROM part.billing
+                )
+            ''', (year, os.path.basename(path)))
+        # Mirror the main indexes once the rows are in
+        for (sql,) in conn.execute(f"""
+            SELECT sql FROM main.sqlite_master
+            WHERE type = 'index' AND tbl_name IN ({', '.join('?' * len(PARTITIONED_TABLES))}) AND sql IS NOT NULL
+        """, PARTITIONED_TABLES).fetchall():
+            cursor.execute(re.sub(r'^CREATE INDEX (IF NOT EXISTS )?', 'CREATE INDEX IF NOT EXISTS part.', sql))
+        conn.commit()
+        cursor.execute('DETACH DATABASE part')
+        
+        values = kpi_counter_values(conn)
+        with conn:
+            refresh_kpi_counters(cursor, values)
+    finally:
+        conn.close()
+    
+    if compact:
+        partition = sqlite3.connect(path)
+        partition.execute('VACUUM')
+        partition.close()
+    if read_only:
+        seal_partition(db_path, year)
+    return list_partitions(db_path)
+
+def seal_partition(db_path, year):
+    """Mark a partition read-only in the registry and on disk"""
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            conn.execute('UPDATE partitions SET read_only = 1 WHERE year = ?', (year,))
+    finally:
+        conn.close()
+    path = partition_path(db_path, year)
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split appointments and billing into per-year database files")
+    parser.add_argument('--db', default='hospital_data.db')
+    parser.add_argument('--year', type=int, action='append', default=[], help="Year to partition (repeatable)")
+    parser.add_argument('--before', type=int, help="Partition every year with appointments before this one")
+    parser.add_argument('--writable', action='store_true', help="Leave the new partitions writable")
+    parser.add_argument('--no-compact', action='store_true', help="Skip vacuuming the new partitions")
+    args = parser.parse_args()
+    
+    years = list(args.year)
+    if args.before:
+        conn = sqlite3.connect(args.db)
+        years += [int(year) for (year,) in conn.execute('''
+            SELECT DISTINCT CAST(strftime('%Y', appointment_day * 86400, 'unixepoch') AS INTEGER)
+            FROM appointments WHERE appointment_day < ?
+        ''', (to_day_number(date(args.before, 1, 1)),))]
+        conn.close()
+    for year in sorted(set(years)):
+        partition_year(args.db, year, read_only=not args.writable, compact=not args.no_compact)
+    print(list_partitions(args.db).to_string(index=False))
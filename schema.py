@@ -0,0 +1,813 @@
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+import numpy as np
+from sketches import grouped_digest_bytes, grouped_sketch_bytes, grouped_summary_bytes
+
+# Day numbers count days since 1970-01-01, matching julianday(x) - 2440587.5 in SQLite
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+JULIAN_EPOCH = 2440587.5
+
+# Fiscal year runs April to March
+FISCAL_YEAR_START_MONTH = 4
+
+# Fixed-date public holidays (Poya and other lunar holidays vary by year and are not included)
+FIXED_HOLIDAYS = {
+    (1, 14): 'Tamil Thai Pongal Day',
+    (2, 4): 'National Day',
+    (5, 1): 'May Day',
+    (12, 25): 'Christmas Day'
+}
+
+DAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+SEASONS = {
+    12: 'Winter', 1: 'Winter', 2: 'Winter',
+    3: 'Spring', 4: 'Spring', 5: 'Spring',
+    6: 'Summer', 7: 'Summer', 8: 'Summer',
+    9: 'Autumn', 10: 'Autumn', 11: 'Autumn'
+}
+
+# Dictionary codes for the low-cardinality text columns; the lookup tables are
+# seeded from these and the text columns are decoded from them
+APPOINTMENT_STATUSES = {'Completed': 1, 'No-show': 2, 'Cancelled': 3, 'Scheduled': 4}
+PAYMENT_STATUSES = {'Paid': 1, 'Pending': 2, 'Overdue': 3}
+PAYMENT_METHODS = {'Cash': 1, 'Card': 2, 'Bank Transfer': 3, 'Insurance': 4}
+
+LOOKUP_TABLES = {
+    'appointment_statuses': APPOINTMENT_STATUSES,
+    'payment_statuses': PAYMENT_STATUSES,
+    'payment_methods': PAYMENT_METHODS
+}
+
+COMPLETED = APPOINTMENT_STATUSES['Completed']
+PAID = PAYMENT_STATUSES['Paid']
+
+# Day number helpers
+def to_day_number(value):
+    """Convert a date, datetime or 'YYYY-MM-DD' string to a day number"""
+    if isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, date):
+        value = date.fromisoformat(str(value)[:10])
+    return value.toordinal() - EPOCH_ORDINAL
+
+def from_day_number(day):
+    """Convert a day number back to a date"""
+    return date.fromordinal(int(day) + EPOCH_ORDINAL)
+
+def to_minute_of_day(value):
+    """Convert a time, datetime or 'HH:MM[:SS]' string to minutes past midnight"""
+    if hasattr(value, 'hour'):
+        return value.hour * 60 + value.minute
+    hours, minutes = str(value).split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+def to_second_of_minute(value):
+    """Whole seconds past the minute of a time, datetime or 'HH:MM[:SS]' string"""
+    if hasattr(value, 'second'):
+        return value.second
+    parts = str(value).split(':')
+    return int(float(parts[2])) if len(parts) > 2 else 0
+
+def today_utc():
+    """Today's date as SQLite's date('now') sees it"""
+    return datetime.now(timezone.utc).date()
+
+def days_ago(days):
+    """Day number for date('now', '-N days')"""
+    return to_day_number(today_utc() - timedelta(days=days))
+
+def months_ago(months):
+    """Day number for date('now', '-N months'), overflowing short months like SQLite does"""
+    today = today_utc()
+    month_index = today.year * 12 + today.month - 1 - months
+    first = date(month_index // 12, month_index % 12 + 1, 1)
+    return to_day_number(first + timedelta(days=today.day - 1))
+
+# Dictionary encoding
+def encode(codes, value):
+    """Look up the integer code for a dictionary-encoded value"""
+    try:
+        return codes[value]
+    except KeyError:
+        raise ValueError(f"Unknown value {value!r}; expected one of {sorted(codes)}")
+
+def decode_sql(column, codes):
+    """SQL CASE expression turning a code column back into its text value"""
+    cases = ' '.join(f"WHEN {code} THEN '{name}'" for name, code in codes.items())
+    return f"CASE {column} {cases} END"
+
+def create_lookup_tables(cursor):
+    """Create and seed the status and payment method lookup tables"""
+    for table, codes in LOOKUP_TABLES.items():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                code INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        ''')
+        cursor.executemany(
+            f'INSERT OR IGNORE INTO {table} (code, name) VALUES (?, ?)',
+            [(code, name) for name, code in codes.items()]
+        )
+
+# Fact tables store dates as day numbers, times as minutes of day plus seconds
+# and statuses as dictionary codes; the text columns are virtual generated
+# columns so existing SQL keeps working
+def create_appointments_table(cursor, table='appointments'):
+    """Create the appointments table"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            appointment_id INTEGER PRIMARY KEY,
+            patient_id INTEGER,
+            doctor_id INTEGER,
+            service_id INTEGER,
+            appointment_date DATE GENERATED ALWAYS AS (date(appointment_day * 86400, 'unixepoch')) VIRTUAL,
+            appointment_time TIME GENERATED ALWAYS AS (printf('%02d:%02d:%02d', appointment_minute / 60, appointment_minute % 60, coalesce(appointment_second, 0))) VIRTUAL,
+            status TEXT GENERATED ALWAYS AS ({decode_sql('status_code', APPOINTMENT_STATUSES)}) VIRTUAL,
+            notes TEXT,
+            appointment_day INTEGER,
+            appointment_minute INTEGER,
+            status_code INTEGER,
+            appointment_second INTEGER,
+            FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
+            FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id),
+            FOREIGN KEY (service_id) REFERENCES services (service_id)
+        )
+    ''')
+
+def create_billing_table(cursor, table='billing'):
+    """Create the billing table"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            billing_id INTEGER PRIMARY KEY,
+            appointment_id INTEGER,
+            amount REAL,
+            payment_date DATE GENERATED ALWAYS AS (date(payment_day * 86400, 'unixepoch')) VIRTUAL,
+            payment_status TEXT GENERATED ALWAYS AS ({decode_sql('payment_status_code', PAYMENT_STATUSES)}) VIRTUAL,
+            payment_method TEXT GENERATED ALWAYS AS ({decode_sql('payment_method_code', PAYMENT_METHODS)}) VIRTUAL,
+            payment_day INTEGER,
+            payment_status_code INTEGER,
+            payment_method_code INTEGER,
+            FOREIGN KEY (appointment_id) REFERENCES appointments (appointment_id)
+        )
+    ''')
+
+# Calendar dimension
+def create_calendar_table(cursor):
+    """Create the calendar dimension keyed by day number"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS calendar (
+            day INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            year INTEGER,
+            month INTEGER,
+            month_key INTEGER,
+            month_label TEXT,
+            day_of_week INTEGER,
+            day_name TEXT,
+            season TEXT,
+            iso_year INTEGER,
+            iso_week INTEGER,
+            fiscal_year INTEGER,
+            fiscal_quarter INTEGER,
+            is_weekend INTEGER,
+            is_holiday INTEGER
+        )
+    ''')
+
+def calendar_row(day):
+    """Build the calendar attributes for one day number"""
+    d = from_day_number(day)
+    iso_year, iso_week, iso_weekday = d.isocalendar()
+    fiscal_offset = (d.month - FISCAL_YEAR_START_MONTH) % 12
+    return (
+        day,
+        d.isoformat(),
+        d.year,
+        d.month,
+        d.year * 100 + d.month,
+        f"{d.year:04d}-{d.month:02d}",
+        iso_weekday % 7,
+        DAY_NAMES[iso_weekday % 7],
+        SEASONS[d.month],
+        iso_year,
+        iso_week,
+        d.year if d.month >= FISCAL_YEAR_START_MONTH else d.year - 1,
+        fiscal_offset // 3 + 1,
+        int(iso_weekday >= 6),
+        int((d.month, d.day) in FIXED_HOLIDAYS)
+    )
+
+def populate_calendar(cursor, start_day, end_day):
+    """Insert any missing calendar rows between two day numbers (inclusive)"""
+    cursor.executemany(
+        'INSERT OR IGNORE INTO calendar VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (calendar_row(day) for day in range(start_day, end_day + 1))
+    )
+
+def ensure_calendar(cursor):
+    """Extend the calendar to cover every stored date and the coming year"""
+    low, high = cursor.execute('''
+        SELECT MIN(low), MAX(high) FROM (
+            SELECT MIN(appointment_day) as low, MAX(appointment_day) as high FROM appointments
+            UNION ALL
+            SELECT MIN(payment_day), MAX(payment_day) FROM billing
+        )
+    ''').fetchone()
+    today = to_day_number(today_utc())
+    start_day = min(low, today) if low is not None else today - 3 * 365
+    end_day = max(high, today) + 365 if high is not None else today + 365
+    populate_calendar(cursor, start_day, end_day)
+
+# Migrations
+def _has_column(cursor, table, column):
+    return any(row[1] == column for row in cursor.execute(f"PRAGMA table_xinfo({table})"))
+
+def _is_generated(cursor, table, column):
+    return any(row[1] == column and row[6] in (2, 3) for row in cursor.execute(f"PRAGMA table_xinfo({table})"))
+
+def _encode_sql(column, codes):
+    cases = ' '.join(f"WHEN '{name}' THEN {code}" for name, code in codes.items())
+    return f"CASE {column} {cases} END"
+
+def _rebuild_table(cursor, table, create_table, columns, expressions):
+    """Recreate a table with the current DDL, copying rows, indexes and triggers across"""
+    index_sql = [row[0] for row in cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)
+    )]
+    create_table(cursor, f'{table}_rebuild')
+    cursor.execute(f'''
+        INSERT INTO {table}_rebuild ({', '.join(columns)})
+        SELECT {', '.join(expressions)} FROM {table}
+    ''')
+    cursor.execute(f'DROP TABLE {table}')
+    # Triggers on other tables still name the dropped table; the legacy rename
+    # leaves them alone instead of failing to re-parse them
+    cursor.execute('PRAGMA legacy_alter_table = ON')
+    cursor.execute(f'ALTER TABLE {table}_rebuild RENAME TO {table}')
+    cursor.execute('PRAGMA legacy_alter_table = OFF')
+    for sql in index_sql:
+        cursor.execute(sql)
+
+def _migrate_day_keys(cursor):
+    """Version 1: integer day keys on appointments and billing plus the calendar"""
+    if not _has_column(cursor, 'appointments', 'appointment_day'):
+        cursor.execute('ALTER TABLE appointments ADD COLUMN appointment_day INTEGER')
+        cursor.execute(f'''
+            UPDATE appointments
+            SET appointment_day = CAST(julianday(appointment_date) - {JULIAN_EPOCH} AS INTEGER)
+        ''')
+    if not _has_column(cursor, 'billing', 'payment_day'):
+        cursor.execute('ALTER TABLE billing ADD COLUMN payment_day INTEGER')
+        cursor.execute(f'''
+            UPDATE billing
+            SET payment_day = CAST(julianday(payment_date) - {JULIAN_EPOCH} AS INTEGER)
+        ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_appointment_day ON appointments (appointment_day)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_billing_payment_day ON billing (payment_day)')
+    create_calendar_table(cursor)
+    ensure_calendar(cursor)
+
+def _migrate_integer_dates(cursor):
+    """Version 2: day numbers and minutes of day become the stored values"""
+    if not _is_generated(cursor, 'appointments', 'appointment_date'):
+        _rebuild_table(
+            cursor, 'appointments', create_appointments_table,
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             'appointment_day', 'appointment_minute', 'status_code'],
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             f'CAST(julianday(appointment_date) - {JULIAN_EPOCH} AS INTEGER)',
+             'CAST(substr(appointment_time, 1, 2) AS INTEGER) * 60 + CAST(substr(appointment_time, 4, 2) AS INTEGER)',
+             _encode_sql('status', APPOINTMENT_STATUSES)]
+        )
+    if not _is_generated(cursor, 'billing', 'payment_date'):
+        _rebuild_table(
+            cursor, 'billing', create_billing_table,
+            ['billing_id', 'appointment_id', 'amount', 'payment_day', 'payment_status_code', 'payment_method_code'],
+            ['billing_id', 'appointment_id', 'amount',
+             f'CAST(julianday(payment_date) - {JULIAN_EPOCH} AS INTEGER)',
+             _encode_sql('payment_status', PAYMENT_STATUSES),
+             _encode_sql('payment_method', PAYMENT_METHODS)]
+        )
+
+def _migrate_status_codes(cursor):
+    """Version 3: dictionary-encoded statuses and payment methods"""
+    create_lookup_tables(cursor)
+    if not _is_generated(cursor, 'appointments', 'status'):
+        _rebuild_table(
+            cursor, 'appointments', create_appointments_table,
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             'appointment_day', 'appointment_minute', 'status_code'],
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             'appointment_day', 'appointment_minute', _encode_sql('status', APPOINTMENT_STATUSES)]
+        )
+    if not _is_generated(cursor, 'billing', 'payment_status'):
+        _rebuild_table(
+            cursor, 'billing', create_billing_table,
+            ['billing_id', 'appointment_id', 'amount', 'payment_day', 'payment_status_code', 'payment_method_code'],
+            ['billing_id', 'appointment_id', 'amount', 'payment_day',
+             _encode_sql('payment_status', PAYMENT_STATUSES),
+             _encode_sql('payment_method', PAYMENT_METHODS)]
+        )
+
+def _migrate_listing_indexes(cursor):
+    """Version 4: indexes behind the sortable columns of the paginated patient listing"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_age ON patients (age)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_registration_date ON patients (registration_date)')
+
+def _migrate_filter_indexes(cursor):
+    """Version 5: indexes that serve the cross-filter conditions on appointments and billing"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_service_id ON appointments (service_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_doctor_id ON appointments (doctor_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_billing_payment_method_code '
+                   'ON billing (payment_method_code, appointment_id)')
+
+# KPI counters
+# Headline numbers kept in kpi_counters by triggers, with the full scans that
+# define them (used to seed and to check the counters)
+KPI_COUNTERS = {
+    'total_patients': "SELECT COUNT(*) FROM patients",
+    'total_appointments': "SELECT COUNT(*) FROM appointments",
+    'paid_completed_revenue': f"""
+        SELECT TOTAL(b.amount)
+        FROM billing b
+        JOIN appointments a ON b.appointment_id = a.appointment_id
+        WHERE a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}
+    """
+}
+
+def _billing_revenue_sql(row):
+    """Paid completed revenue contributed by one billing row (NEW or OLD)"""
+    return f"""(CASE WHEN {row}.payment_status_code = {PAID} AND EXISTS (
+            SELECT 1 FROM appointments
+            WHERE appointment_id = {row}.appointment_id AND status_code = {COMPLETED}
+        ) THEN COALESCE({row}.amount, 0) ELSE 0 END)"""
+
+def _appointment_revenue_sql(row):
+    """Paid completed revenue contributed by the billing of one appointment row (NEW or OLD)"""
+    return f"""(CASE WHEN {row}.status_code = {COMPLETED} THEN (
+            SELECT TOTAL(amount) FROM billing
+            WHERE appointment_id = {row}.appointment_id AND payment_status_code = {PAID}
+        ) ELSE 0 END)"""
+
+def _counter_update_sql(name, change):
+    return f"UPDATE kpi_counters SET value = value + {change} WHERE name = '{name}';"
+
+# Trigger name, event and body. Status transitions (an appointment becoming
+# Completed, a bill going Pending -> Paid) are updates, so the update triggers
+# add the new row's contribution and subtract the old one's. INSERT OR REPLACE
+# only fires the delete triggers with PRAGMA recursive_triggers on.
+KPI_TRIGGERS = [
+    ('kpi_patients_insert', 'AFTER INSERT ON patients', [_counter_update_sql('total_patients', '1')]),
+    ('kpi_patients_delete', 'AFTER DELETE ON patients', [_counter_update_sql('total_patients', '-1')]),
+    ('kpi_appointments_insert', 'AFTER INSERT ON appointments', [
+        _counter_update_sql('total_appointments', '1'),
+        _counter_update_sql('paid_completed_revenue', _appointment_revenue_sql('NEW'))
+    ]),
+    ('kpi_appointments_delete', 'AFTER DELETE ON appointments', [
+        _counter_update_sql('total_appointments', '-1'),
+        _counter_update_sql('paid_completed_revenue', f"-{_appointment_revenue_sql('OLD')}")
+    ]),
+    ('kpi_appointments_update', 'AFTER UPDATE OF appointment_id, status_code ON appointments', [
+        _counter_update_sql('paid_completed_revenue',
+                            f"{_appointment_revenue_sql('NEW')} - {_appointment_revenue_sql('OLD')}")
+    ]),
+    ('kpi_billing_insert', 'AFTER INSERT ON billing', [
+        _counter_update_sql('paid_completed_revenue', _billing_revenue_sql('NEW'))
+    ]),
+    ('kpi_billing_delete', 'AFTER DELETE ON billing', [
+        _counter_update_sql('paid_completed_revenue', f"-{_billing_revenue_sql('OLD')}")
+    ]),
+    ('kpi_billing_update', 'AFTER UPDATE OF appointment_id, amount, payment_status_code ON billing', [
+        _counter_update_sql('paid_completed_revenue',
+                            f"{_billing_revenue_sql('NEW')} - {_billing_revenue_sql('OLD')}")
+    ])
+]
+
+def create_kpi_counters(cursor):
+    """Create the kpi_counters table and the triggers that maintain it"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kpi_counters (
+            name TEXT PRIMARY KEY,
+            value NUMERIC NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.executemany('INSERT OR IGNORE INTO kpi_counters (name) VALUES (?)', [(name,) for name in KPI_COUNTERS])
+    # The appointment triggers look up billing by appointment
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_billing_appointment_id ON billing (appointment_id)')
+    for name, event, statements in KPI_TRIGGERS:
+        body = '\n            '.join(statements)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} {event}
+            BEGIN
+            {body}
+            END
+        ''')
+
+def refresh_kpi_counters(cursor, values=None):
+    """Reset every counter from a full scan, or from values already scanned by name"""
+    for name, query in KPI_COUNTERS.items():
+        if values is None:
+            cursor.execute(f'UPDATE kpi_counters SET value = ({query}) WHERE name = ?', (name,))
+        else:
+            cursor.execute('UPDATE kpi_counters SET value = ? WHERE name = ?', (values[name], name))
+
+def check_kpi_counters(conn, reconcile=False, tolerance=0.005, values=None):
+    """Compare each counter with a full scan, optionally resetting the ones that drifted
+    
+    Revenue is summed in floating point, so differences below tolerance count
+    as consistent. values, by name, stands in for the scan.
+    """
+    report = []
+    for name, query in KPI_COUNTERS.items():
+        counter = conn.execute('SELECT value FROM kpi_counters WHERE name = ?', (name,)).fetchone()[0]
+        actual = conn.execute(query).fetchone()[0] if values is None else values[name]
+        consistent = abs(counter - actual) <= tolerance
+        report.append({'name': name, 'counter': counter, 'actual': actual, 'consistent': consistent})
+        if reconcile and not consistent:
+            conn.execute('UPDATE kpi_counters SET value = ? WHERE name = ?', (actual, name))
+    conn.commit()
+    return report
+
+def _migrate_kpi_counters(cursor):
+    """Version 6: trigger-maintained KPI counters"""
+    create_kpi_counters(cursor)
+    refresh_kpi_counters(cursor)
+
+# Daily rollup
+# Appointments and their billing pre-aggregated per appointment day, service
+# and status. Writers that only touch a few days refresh just those days
+DAILY_ROLLUP_QUERY = f"""
+    SELECT
+        a.appointment_day,
+        a.service_id,
+        a.status_code,
+        COUNT(*),
+        COUNT(b.billing_id),
+        TOTAL(b.amount),
+        TOTAL(CASE WHEN b.payment_status_code = {PAID} THEN b.amount END)
+    FROM appointments a
+    LEFT JOIN billing b ON b.appointment_id = a.appointment_id
+    WHERE a.appointment_day IS NOT NULL{{where}}
+    GROUP BY 1, 2, 3
+"""
+
+# HyperLogLog sketches of the patients behind the rollup, per appointment day,
+# service and payment month (0 when unbilled): every patient seen, and those
+# with a paid bill for a completed appointment. Distinct patients over any
+# range of days, months, departments or services are a merge of these.
+# The sketches are built in numpy from the rows, sorted by sketch key
+PATIENT_SKETCHES_QUERY = f"""
+    SELECT
+        a.appointment_day,
+        a.service_id,
+        COALESCE(pc.month_key, 0),
+        a.patient_id,
+        a.status_code = {COMPLETED} AND COALESCE(b.payment_status_code = {PAID}, 0)
+    FROM appointments a
+    LEFT JOIN billing b ON b.appointment_id = a.appointment_id
+    LEFT JOIN calendar pc ON pc.day = b.payment_day
+    WHERE a.appointment_day IS NOT NULL AND a.patient_id IS NOT NULL{{where}}
+    ORDER BY 1, 2, 3
+"""
+
+# t-digests of the bill amounts per appointment day and service, and of the
+# days from appointment to payment of paid bills per appointment day and
+# payment method, so percentiles over any range of days are a merge of these.
+# Built in numpy from the values, sorted by digest key
+AMOUNT_DIGESTS_QUERY = """
+    SELECT a.appointment_day, a.service_id, b.amount
+    FROM appointments a
+    JOIN billing b ON b.appointment_id = a.appointment_id
+    WHERE a.appointment_day IS NOT NULL AND b.amount IS NOT NULL{where}
+    ORDER BY 1, 2
+"""
+
+PAYMENT_LAG_DIGESTS_QUERY = f"""
+    SELECT a.appointment_day, b.payment_method_code, b.payment_day - a.appointment_day
+    FROM appointments a
+    JOIN billing b ON b.appointment_id = a.appointment_id
+    WHERE a.appointment_day IS NOT NULL AND b.payment_status_code = {PAID} AND b.payment_day IS NOT NULL{{where}}
+    ORDER BY 1, 2
+"""
+
+# Heavy-hitters summaries per appointment day of the services by completed
+# appointments, and of the doctors by paid revenue of completed appointments
+# (with a second summary of those appointments), so leaderboards over any
+# range of days merge a few hundred small summaries. Built from per-day counts
+TOP_SERVICES_QUERY = f"""
+    SELECT a.appointment_day, a.service_id, COUNT(*)
+    FROM appointments a
+    WHERE a.appointment_day IS NOT NULL AND a.service_id IS NOT NULL AND a.status_code = {COMPLETED}{{where}}
+    GROUP BY 1, 2
+"""
+
+TOP_DOCTORS_QUERY = f"""
+    SELECT a.appointment_day, a.doctor_id, TOTAL(b.amount), COUNT(*)
+    FROM appointments a
+    JOIN billing b ON b.appointment_id = a.appointment_id
+    WHERE a.appointment_day IS NOT NULL AND a.doctor_id IS NOT NULL
+    AND a.status_code = {COMPLETED} AND b.payment_status_code = {PAID}{{where}}
+    GROUP BY 1, 2
+"""
+
+# Stratified sample of appointments (with their billing) behind the
+# approximate query mode. Each month and department is a stratum sampled at
+# SAMPLE_RATE, or at a higher rate that keeps about SAMPLE_MIN_PER_STRATUM of
+# its appointments. Appointments are picked by a multiplicative hash of their
+# id, so the sample is stable across refreshes, and each row keeps its weight
+# (1 / inclusion probability) for Horvitz-Thompson estimates
+SAMPLE_RATE = 0.1
+SAMPLE_MIN_PER_STRATUM = 100
+SAMPLE_HASH_MULTIPLIER = 2654435761
+
+APPOINTMENT_SAMPLE_QUERY = f"""
+    SELECT
+        a.appointment_day,
+        a.appointment_id,
+        a.service_id,
+        a.doctor_id,
+        a.status_code,
+        b.billing_id,
+        b.amount,
+        b.payment_day,
+        b.payment_status_code,
+        b.payment_method_code,
+        1.0 / st.rate
+    FROM appointments a
+    JOIN calendar c ON c.day = a.appointment_day
+    LEFT JOIN services s ON s.service_id = a.service_id
+    JOIN (
+        SELECT
+            c.month_key,
+            s.department_id,
+            MIN(1.0, MAX({SAMPLE_RATE}, {SAMPLE_MIN_PER_STRATUM} * 1.0 / SUM(r.appointments))) as rate
+        FROM daily_rollup r
+        JOIN calendar c ON c.day = r.day
+        LEFT JOIN services s ON s.service_id = r.service_id
+        GROUP BY 1, 2
+    ) st ON st.month_key = c.month_key AND st.department_id IS s.department_id
+    LEFT JOIN billing b ON b.appointment_id = a.appointment_id
+    WHERE a.appointment_day IS NOT NULL
+    AND (a.appointment_id * {SAMPLE_HASH_MULTIPLIER}) % 4294967296 < st.rate * 4294967296{{where}}
+"""
+
+# Days refreshed per statement, well under SQLite's bound parameter limit
+ROLLUP_REFRESH_CHUNK = 500
+
+def create_daily_rollup_table(cursor):
+    """Create the daily rollup keyed by appointment day, service and status, and the tables refreshed with it"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            day INTEGER NOT NULL,
+            service_id INTEGER,
+            status_code INTEGER,
+            appointments INTEGER NOT NULL,
+            billed INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            paid_revenue REAL NOT NULL,
+            UNIQUE (day, service_id, status_code)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_patient_sketches (
+            day INTEGER NOT NULL,
+            service_id INTEGER,
+            payment_month INTEGER NOT NULL,
+            patients BLOB NOT NULL,
+            paying_patients BLOB NOT NULL,
+            UNIQUE (day, service_id, payment_month)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_amount_digests (
+            day INTEGER NOT NULL,
+            service_id INTEGER,
+            amounts BLOB NOT NULL,
+            UNIQUE (day, service_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_payment_lag_digests (
+            day INTEGER NOT NULL,
+            payment_method_code INTEGER,
+            payment_lags BLOB NOT NULL,
+            UNIQUE (day, payment_method_code)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_top_services (
+            day INTEGER PRIMARY KEY,
+            appointments BLOB NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_top_doctors (
+            day INTEGER PRIMARY KEY,
+            revenue BLOB NOT NULL,
+            appointments BLOB NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointment_sample (
+            day INTEGER NOT NULL,
+            appointment_id INTEGER NOT NULL,
+            service_id INTEGER,
+            doctor_id INTEGER,
+            status_code INTEGER,
+            billing_id INTEGER,
+            amount REAL,
+            payment_day INTEGER,
+            payment_status_code INTEGER,
+            payment_method_code INTEGER,
+            weight REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointment_sample_day ON appointment_sample (day)')
+
+def _partitioned_day_ranges(cursor):
+    """First and last appointment day of every year moved to a partition"""
+    if cursor.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'partitions'").fetchone() is None:
+        return []
+    return [(to_day_number(date(year, 1, 1)), to_day_number(date(year, 12, 31)))
+            for (year,) in cursor.execute('SELECT year FROM main.partitions ORDER BY year').fetchall()]
+
+def _day_chunks(cursor, table, days):
+    """Delete a per-day table's rows for the given appointment days, or for every day
+    
+    Yields the WHERE suffix and parameters selecting the facts to recompute them from.
+    Every day leaves out partitioned years: their facts are not in the main
+    database, so their rows are kept as they were when the year was moved.
+    """
+    if days is None:
+        ranges = _partitioned_day_ranges(cursor)
+        kept = ' AND '.join(['{column} NOT BETWEEN ? AND ?'] * len(ranges))
+        params = [day for day_range in ranges for day in day_range]
+        cursor.execute(f'DELETE FROM {table}' + (f" WHERE {kept.format(column='day')}" if ranges else ''), params)
+        yield (f" AND {kept.format(column='a.appointment_day')}" if ranges else ''), params
+        return
+    days = sorted({int(day) for day in days if day is not None})
+    for start in range(0, len(days), ROLLUP_REFRESH_CHUNK):
+        chunk = days[start:start + ROLLUP_REFRESH_CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM {table} WHERE day IN ({placeholders})', chunk)
+        yield f' AND a.appointment_day IN ({placeholders})', chunk
+
+def refresh_patient_sketches(cursor, days=None):
+    """Recompute the patient sketches of the given appointment days, or of every day"""
+    for where, params in _day_chunks(cursor, 'daily_patient_sketches', days):
+        rows = cursor.execute(PATIENT_SKETCHES_QUERY.format(where=where), params).fetchall()
+        if not rows:
+            continue
+        keys = [row[:3] for row in rows]
+        starts = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1]]
+        groups = np.repeat(np.arange(len(starts)), np.diff(starts + [len(keys)]))
+        patients = np.array([row[3] for row in rows], dtype=np.int64)
+        paying = np.array([row[4] for row in rows], dtype=bool)
+        cursor.executemany(
+            'INSERT INTO daily_patient_sketches VALUES (?, ?, ?, ?, ?)',
+            [key + (all_sketch, paying_sketch) for key, all_sketch, paying_sketch in zip(
+                [keys[i] for i in starts],
+                grouped_sketch_bytes(groups, patients, len(starts)),
+                grouped_sketch_bytes(groups[paying], patients[paying], len(starts))
+            )]
+        )
+
+def _refresh_digests(cursor, table, query, days):
+    """Recompute a per-day digest table, keyed by day and one dimension, from the (day, key, value) rows of query"""
+    for where, params in _day_chunks(cursor, table, days):
+        rows = cursor.execute(query.format(where=where), params).fetchall()
+        if not rows:
+            continue
+        keys = [row[:2] for row in rows]
+        starts = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1]]
+        groups = np.repeat(np.arange(len(starts)), np.diff(starts + [len(keys)]))
+        values = np.array([row[2] for row in rows], dtype=np.float64)
+        cursor.executemany(f'INSERT INTO {table} VALUES (?, ?, ?)',
+                           [key + (digest,) for key, digest in zip([keys[i] for i in starts],
+                                                                   grouped_digest_bytes(groups, values, len(starts)))])
+
+def refresh_billing_digests(cursor, days=None):
+    """Recompute the bill amount and payment lag digests of the given appointment days, or of every day"""
+    _refresh_digests(cursor, 'daily_amount_digests', AMOUNT_DIGESTS_QUERY, days)
+    _refresh_digests(cursor, 'daily_payment_lag_digests', PAYMENT_LAG_DIGESTS_QUERY, days)
+
+def refresh_top_k(cursor, days=None):
+    """Recompute the service and doctor heavy-hitters summaries of the given appointment days, or of every day"""
+    for table, query in (('daily_top_services', TOP_SERVICES_QUERY), ('daily_top_doctors', TOP_DOCTORS_QUERY)):
+        for where, params in _day_chunks(cursor, table, days):
+            rows = np.array(cursor.execute(query.format(where=where), params).fetchall(), dtype=np.float64)
+            if not len(rows):
+                continue
+            summary_days, groups = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+            keys = rows[:, 1].astype(np.int64)
+            summaries = [grouped_summary_bytes(groups, keys, rows[:, column], len(summary_days))
+                         for column in range(2, rows.shape[1])]
+            placeholders = ', '.join('?' * (len(summaries) + 1))
+            cursor.executemany(f'INSERT INTO {table} VALUES ({placeholders})',
+                               zip(summary_days.tolist(), *summaries))
+
+def refresh_appointment_sample(cursor, days=None):
+    """Redraw the sampled appointments of the given appointment days, or of every day
+    
+    Stratum sizes come from the daily rollup, so refresh it first.
+    """
+    for where, params in _day_chunks(cursor, 'appointment_sample', days):
+        cursor.execute('INSERT INTO appointment_sample ' + APPOINTMENT_SAMPLE_QUERY.format(where=where), params)
+
+def refresh_daily_rollup(cursor, days=None):
+    """Recompute the rollup and the tables refreshed with it for the given appointment days, or for every day"""
+    for where, params in _day_chunks(cursor, 'daily_rollup', days):
+        cursor.execute('INSERT INTO daily_rollup ' + DAILY_ROLLUP_QUERY.format(where=where), params)
+    refresh_patient_sketches(cursor, days)
+    refresh_billing_digests(cursor, days)
+    refresh_top_k(cursor, days)
+    refresh_appointment_sample(cursor, days)
+
+def _migrate_daily_rollup(cursor):
+    """Version 7: daily rollup refreshed per affected day by incremental ingestion"""
+    create_daily_rollup_table(cursor)
+    refresh_daily_rollup(cursor)
+
+def _migrate_patient_sketches(cursor):
+    """Version 8: HyperLogLog sketches of the patients per appointment day, service and payment month"""
+    create_daily_rollup_table(cursor)
+    refresh_patient_sketches(cursor)
+
+def _migrate_appointment_sample(cursor):
+    """Version 9: stratified appointment sample for approximate queries"""
+    create_daily_rollup_table(cursor)
+    refresh_appointment_sample(cursor)
+
+def _migrate_billing_digests(cursor):
+    """Version 10: t-digests of bill amounts and payment lags per appointment day and service or payment method"""
+    create_daily_rollup_table(cursor)
+    refresh_billing_digests(cursor)
+
+def _migrate_top_k(cursor):
+    """Version 11: heavy-hitters summaries of services and doctors per appointment day"""
+    create_daily_rollup_table(cursor)
+    refresh_top_k(cursor)
+
+def _migrate_appointment_seconds(cursor):
+    """Version 12: seconds past the minute are stored so appointment_time keeps them"""
+    if not _has_column(cursor, 'appointments', 'appointment_second'):
+        _rebuild_table(
+            cursor, 'appointments', create_appointments_table,
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             'appointment_day', 'appointment_minute', 'status_code', 'appointment_second'],
+            ['appointment_id', 'patient_id', 'doctor_id', 'service_id', 'notes',
+             'appointment_day', 'appointment_minute', 'status_code', '0']
+        )
+
+def _migrate_search_indexes(cursor):
+    """Version 13: case-insensitive name indexes behind the listings' prefix search"""
+    for table in ('patients', 'doctors', 'services'):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_name_nocase ON {table} (name COLLATE NOCASE)')
+
+def _migrate_compressed_digests(cursor):
+    """Version 14: rebuild the per-day digests compressed to their centroid budget, however few values they hold"""
+    refresh_billing_digests(cursor)
+
+MIGRATIONS = [
+    (1, _migrate_day_keys),
+    (2, _migrate_integer_dates),
+    (3, _migrate_status_codes),
+    (4, _migrate_listing_indexes),
+    (5, _migrate_filter_indexes),
+    (6, _migrate_kpi_counters),
+    (7, _migrate_daily_rollup),
+    (8, _migrate_patient_sketches),
+    (9, _migrate_appointment_sample),
+    (10, _migrate_billing_digests),
+    (11, _migrate_top_k),
+    (12, _migrate_appointment_seconds),
+    (13, _migrate_search_indexes),
+    (14, _migrate_compressed_digests)
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate(conn):
+    """Bring a database up to the current schema version"""
+    cursor = conn.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION})")
+    for target, migration in MIGRATIONS:
+        if version < target:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {target}')
+    conn.commit()
+    assert cursor.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+
+def migrate_database(db_path='hospital_data.db'):
+    """Open a database file and migrate it"""
+    conn = sqlite3.connect(db_path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,566 @@
+import hashlib
+import json
+import numpy as np
+
+# Register index bits of a HyperLogLog: 2^14 registers (16 KB per sketch)
+# give a relative standard error of 1.04 / sqrt(16384), about 0.8%
+DEFAULT_PRECISION = 14
+
+# Normal quantile of the error bounds reported with estimates (95%)
+CONFIDENCE_Z = 1.96
+
+# Set on the precision byte of a serialized sketch stored as (register, rank)
+# pairs: a day's sketch of a few dozen patients takes bytes instead of 16 KB
+SPARSE_FLAG = 0x80
+
+# Centroid budget of a t-digest: about compression / 2 centroids, which keeps
+# p99 within about 0.15% of rank and the median within about 0.8%
+DEFAULT_COMPRESSION = 200
+
+# Set on the flag byte of a serialized t-digest holding its raw values (every
+# centroid of weight 1): in-memory digests of up to `compression` values, and
+# stored digests of a few dozen, are exact
+UNIT_WEIGHTS_FLAG = 0x01
+
+# Keys kept by a heavy-hitters summary: counts are exact while a window has
+# at most this many distinct keys, and overestimate by at most total / capacity
+DEFAULT_CAPACITY = 100
+
+# Set on the flag byte of a serialized heavy-hitters summary that never
+# dropped a key, stored without its error bounds
+EXACT_COUNTS_FLAG = 0x01
+
+def hash64(values):
+    """64-bit hashes of integer ids (splitmix64) or of any other values (BLAKE2b), as uint64"""
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        x = values.astype(np.uint64)
+        with np.errstate(over='ignore'):
+            x = x + np.uint64(0x9E3779B97F4A7C15)
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+    if values.dtype.kind == 'f' and np.all(values == np.floor(values)):
+        return hash64(values.astype(np.int64))
+    return np.array([int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'little')
+                     for value in values.ravel()], dtype=np.uint64)
+
+def _registers(values, precision):
+    """Register index and rank of each value"""
+    hashes = hash64([value for value in values if value is not None]
+                    if not isinstance(values, np.ndarray) else values)
+    index = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    # Position of the first set bit in the remaining 64 - p bits. frexp is
+    # exact below 2^53, so wider values are shifted down first
+    shift = max(0, 64 - precision - 52)
+    _, bit_length = np.frexp((rest >> np.uint64(shift)).astype(np.float64))
+    bit_length = np.where(bit_length > 0, bit_length + shift, 0)
+    return index, (64 - precision - bit_length + 1).astype(np.uint8)
+
+def _sigma(x):
+    if x == 1:
+        return np.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous, z = z, z + x * y
+        y += y
+        if z == previous:
+            return z
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = np.sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+class HyperLogLog:
+    """Mergeable approximate distinct counter
+    
+    Sketches of the same precision merge by taking the register-wise maximum,
+    so the distinct count of a union of sets (branches, days, departments) is
+    estimated from their sketches without revisiting the values.
+    """
+    
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 18, not {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+    
+    @property
+    def relative_error(self):
+        """Relative standard error of the estimate"""
+        return 1.04 / np.sqrt(len(self.registers))
+    
+    def update(self, values):
+        """Add values (ids or labels); returns the sketch for chaining"""
+        index, rank = _registers(values, self.precision)
+        np.maximum.at(self.registers, index, rank)
+        return self
+    
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge sketches of precision {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+    
+    @classmethod
+    def union(cls, sketches, precision=DEFAULT_PRECISION):
+        """A new sketch of the union of sketches (or of their serialized bytes)
+        
+        Sparse serialized sketches are decoded together and folded in with one
+        scatter, so merging thousands of small daily sketches stays cheap.
+        """
+        sparse, dense = [], []
+        for sketch in sketches:
+            if sketch is None:
+                continue
+            if isinstance(sketch, (bytes, bytearray, memoryview)):
+                sketch = bytes(sketch)
+                if sketch[0] & SPARSE_FLAG:
+                    sparse.append(sketch)
+                    continue
+                sketch = cls.from_bytes(sketch)
+            dense.append(sketch)
+        precisions = {sketch.precision for sketch in dense} | {data[0] & ~SPARSE_FLAG for data in sparse}
+        if len(precisions) > 1:
+            raise ValueError(f"Cannot merge sketches of precisions {sorted(precisions)}")
+        result = cls(precisions.pop() if precisions else precision)
+        for sketch in dense:
+            result.merge(sketch)
+        if sparse:
+            index, ranks = _decode_sparse(sparse)
+            np.maximum.at(result.registers, index, ranks)
+        return result
+    
+    def count(self):
+        """Estimated number of distinct values added
+        
+        Uses Ertl's improved estimator, which is unbiased from empty sketches
+        to large ones without the classic small-range switch to linear counting.
+        """
+        m = len(self.registers)
+        q = 64 - self.precision
+        histogram = np.bincount(self.registers, minlength=q + 2).astype(np.float64)
+        if histogram[0] == m:
+            return 0
+        z = m * _tau(1 - histogram[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * _sigma(histogram[0] / m)
+        return int(round(m * m / (2 * np.log(2) * z)))
+    
+    def margin(self, count=None):
+        """Half-width of the confidence interval around an estimate (by default this sketch's count)"""
+        return margin_of_error(self.count() if count is None else count, self.precision)
+    
+    def to_bytes(self):
+        """Serialize, sparsely when fewer than a third of the registers are set"""
+        index = np.flatnonzero(self.registers)
+        if self.precision <= 16 and 3 * len(index) < len(self.registers):
+            return (bytes([self.precision | SPARSE_FLAG]) + index.astype('<u2').tobytes()
+                    + self.registers[index].tobytes())
+        return bytes([self.precision]) + self.registers.tobytes()
+    
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        precision = data[0] & ~SPARSE_FLAG
+        if not data[0] & SPARSE_FLAG:
+            return cls(precision, np.frombuffer(data, dtype=np.uint8, offset=1).copy())
+        registers = np.zeros(1 << precision, dtype=np.uint8)
+        index, ranks = _decode_sparse([data])
+        registers[index] = ranks
+        return cls(precision, registers)
+
+def _decode_sparse(sketches):
+    """Register indexes and ranks of all the pairs of sparse serialized sketches, decoded together"""
+    pairs = np.array([len(data) - 1 for data in sketches], dtype=np.intp) // 3
+    data = np.frombuffer(b''.join(sketches), dtype=np.uint8)
+    # Each sketch is a flag byte, its little-endian uint16 indexes, then its ranks
+    payload = np.cumsum(3 * pairs + 1) - 3 * pairs
+    sketch = np.repeat(np.arange(len(sketches)), pairs)
+    pair = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+    index_at = payload[sketch] + 2 * pair
+    index = data[index_at].astype(np.intp) | (data[index_at + 1].astype(np.intp) << 8)
+    return index, data[payload[sketch] + 2 * pairs[sketch] + pair]
+
+def grouped_sketch_bytes(groups, values, n_groups, precision=DEFAULT_PRECISION):
+    """Serialized sketch of the values of each group (codes 0 to n_groups - 1), built in one vectorized pass
+    
+    Sketches of few values are assembled sparse straight from the sorted
+    (register, rank) pairs, without allocating their dense registers.
+    """
+    groups = np.asarray(groups, dtype=np.intp)
+    index, rank = _registers(np.asarray(values), precision)
+    # Highest rank per group and register: sort by group, register, then rank and keep the last
+    order = np.lexsort((rank, index, groups))
+    groups, index, rank = groups[order], index[order], rank[order]
+    last = np.ones(len(groups), dtype=bool)
+    last[:-1] = (groups[1:] != groups[:-1]) | (index[1:] != index[:-1])
+    groups, index, rank = groups[last], index[last], rank[last]
+    bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+    packed_index = index.astype('<u2')
+    header = bytes([precision | SPARSE_FLAG])
+    sketches = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        if precision <= 16 and 3 * (high - low) < 1 << precision:
+            sketches.append(header + packed_index[low:high].tobytes() + rank[low:high].tobytes())
+        else:
+            registers = np.zeros(1 << precision, dtype=np.uint8)
+            registers[index[low:high]] = rank[low:high]
+            sketches.append(HyperLogLog(precision, registers).to_bytes())
+    return sketches
+
+def sketch_bytes(values, precision=DEFAULT_PRECISION):
+    """Serialized sketch of values"""
+    values = np.asarray(values)
+    return grouped_sketch_bytes(np.zeros(len(values), dtype=np.intp), values, 1, precision)[0]
+
+def margin_of_error(count, precision=DEFAULT_PRECISION):
+    """Half-width of the CONFIDENCE_Z interval around HyperLogLog estimates (a number or an array)"""
+    return np.rint(CONFIDENCE_Z * 1.04 / np.sqrt(1 << precision) * np.asarray(count, dtype=np.float64))
+
+def _compress(means, weights, compression, always=False):
+    """Sorted centroids merged into at most compression / 2 + 1, finer towards both tails
+    
+    Up to compression centroids are kept as they are unless always is set.
+    Each centroid falls in a unit bucket of the k1 scale function
+    k(q) = compression / (2 pi) * asin(2q - 1) at the quantile of its middle,
+    and the centroids of each bucket merge into one.
+    """
+    order = np.argsort(means, kind='stable')
+    means, weights = means[order], weights[order]
+    if len(means) <= (1 if always else compression):
+        return means, weights
+    cumulative = np.cumsum(weights)
+    middle = (cumulative - weights / 2) / cumulative[-1]
+    bucket = np.floor(compression / (2 * np.pi) * np.arcsin(np.clip(2 * middle - 1, -1, 1)))
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    merged = np.add.reduceat(weights, starts)
+    return np.add.reduceat(weights * means, starts) / merged, merged
+
+class TDigest:
+    """Mergeable quantile sketch (merging t-digest)
+    
+    Values are kept as weighted centroids, small near the tails and larger
+    towards the median. Digests merge by pooling their centroids and
+    compressing them again, so percentiles over any range of days come from
+    the per-day digests without sorting the values.
+    """
+    
+    def __init__(self, compression=DEFAULT_COMPRESSION, means=None, weights=None, minimum=None, maximum=None):
+        self.compression = compression
+        self.means = np.zeros(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.ones(len(self.means)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.minimum = minimum if minimum is not None or not len(self.means) else self.means.min()
+        self.maximum = maximum if maximum is not None or not len(self.means) else self.means.max()
+    
+    def count(self):
+        """Number of values added"""
+        return int(self.weights.sum())
+    
+    def update(self, values):
+        """Add values; returns the digest for chaining"""
+        values = np.asarray([value for value in values if value is not None], dtype=np.float64)
+        return self.merge(TDigest(self.compression, values))
+    
+    def merge(self, other):
+        """Fold another digest into this one"""
+        if not other.count():
+            return self
+        self.minimum = other.minimum if not self.count() else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if not self.count() else max(self.maximum, other.maximum)
+        self.means, self.weights = _compress(np.concatenate([self.means, other.means]),
+                                             np.concatenate([self.weights, other.weights]), self.compression)
+        return self
+    
+    @classmethod
+    def union(cls, digests, compression=DEFAULT_COMPRESSION):
+        """A new digest of the union of digests (or of their serialized bytes)
+        
+        The raw values of small serialized digests are read together and
+        everything is compressed once.
+        """
+        raw, dense = [], []
+        for digest in digests:
+            if digest is None:
+                continue
+            if isinstance(digest, TDigest):
+                dense.append(digest)
+            elif digest[0] & UNIT_WEIGHTS_FLAG:
+                raw.append(digest)
+            else:
+                dense.append(cls.from_bytes(digest, compression))
+        # Raw digests are read as one buffer with their flag bytes masked out
+        data = np.frombuffer(b''.join(raw), dtype=np.uint8)
+        flags = np.ones(len(data), dtype=bool)
+        flags[np.cumsum([0] + [len(digest) for digest in raw[:-1]], dtype=np.intp)[:len(raw)]] = False
+        values = data[flags].view('<f8')
+        means = np.concatenate([values] + [digest.means for digest in dense])
+        if not len(means):
+            return cls(compression)
+        weights = np.concatenate([np.ones(len(values))] + [digest.weights for digest in dense])
+        extremes = [values.min(), values.max()] if len(values) else []
+        extremes += [extreme for digest in dense if digest.count() for extreme in (digest.minimum, digest.maximum)]
+        means, weights = _compress(means, weights, compression)
+        return cls(compression, means, weights, min(extremes), max(extremes))
+    
+    def quantile(self, q):
+        """Estimated quantile(s) q in [0, 1], interpolated like numpy.quantile; NaN when empty
+        
+        Each centroid sits at the middle of the ranks it covers, with the
+        minimum and maximum at the ends, and ranks in between interpolate
+        linearly, which is exact while every centroid holds a single value.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if not self.count():
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        ranks = np.concatenate([[0.5], centers, [total - 0.5]])
+        values = np.concatenate([[self.minimum], self.means, [self.maximum]])
+        keep = np.r_[centers[0] > 0.5, np.ones(len(centers), dtype=bool), centers[-1] < total - 0.5]
+        result = np.interp(q * (total - 1) + 0.5, ranks[keep], values[keep])
+        return result if q.ndim else float(result)
+    
+    def to_bytes(self):
+        """Serialize: the raw values while every weight is 1, otherwise the extremes, means and weights"""
+        if np.all(self.weights == 1):
+            return bytes([UNIT_WEIGHTS_FLAG]) + self.means.astype('<f8').tobytes()
+        return (bytes([0]) + np.array([self.minimum, self.maximum], dtype='<f8').tobytes()
+                + self.means.astype('<f8').tobytes() + self.weights.astype('<u4').tobytes())
+    
+    @classmethod
+    def from_bytes(cls, data, compression=DEFAULT_COMPRESSION):
+        data = bytes(data)
+        if data[0] & UNIT_WEIGHTS_FLAG:
+            return cls(compression, np.frombuffer(data, dtype='<f8', offset=1))
+        minimum, maximum = np.frombuffer(data, dtype='<f8', count=2, offset=1)
+        centroids = (len(data) - 17) // 12
+        means = np.frombuffer(data, dtype='<f8', count=centroids, offset=17)
+        weights = np.frombuffer(data, dtype='<u4', count=centroids, offset=17 + 8 * centroids)
+        return cls(compression, means, weights.astype(np.float64), float(minimum), float(maximum))
+
+def grouped_digest_bytes(groups, values, n_groups, compression=DEFAULT_COMPRESSION):
+    """Serialized digest of the values of each group (codes 0 to n_groups - 1), sorted in one pass
+    
+    Every digest is compressed to at most compression / 2 + 1 centroids,
+    however few values it has, so merging the digests of a range of groups
+    (days) sorts at most that many per group rather than every value. A
+    group of a few dozen values keeps each in its own centroid and is exact.
+    """
+    groups = np.asarray(groups, dtype=np.intp)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+    digests = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        if high == low:
+            digests.append(bytes([UNIT_WEIGHTS_FLAG]))
+            continue
+        means, weights = _compress(values[low:high], np.ones(high - low), compression, always=True)
+        digests.append(TDigest(compression, means, weights, values[low], values[high - 1]).to_bytes())
+    return digests
+
+class SpaceSaving:
+    """Mergeable heavy-hitters summary (space-saving) of weighted counts per integer key
+    
+    Keeps the capacity largest counts, each an overestimate with an error
+    bound: a key's true count lies between count - error and count, and a
+    key that was dropped counts at most floor. Summaries merge by adding
+    counts, a key missing from a summary being charged that summary's floor.
+    """
+    
+    def __init__(self, capacity=DEFAULT_CAPACITY, keys=None, counts=None, errors=None, floor=0.0):
+        self.capacity = capacity
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.counts = np.zeros(len(self.keys)) if counts is None else np.asarray(counts, dtype=np.float64)
+        self.errors = np.zeros(len(self.keys)) if errors is None else np.asarray(errors, dtype=np.float64)
+        self.floor = floor
+    
+    @classmethod
+    def from_counts(cls, keys, counts=None, capacity=DEFAULT_CAPACITY):
+        """An exact summary of (possibly repeated) keys with their weights, truncated to capacity"""
+        keys, inverse = np.unique(np.asarray(keys, dtype=np.int64), return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+        return cls(capacity, keys, counts)._truncate()
+    
+    def _truncate(self):
+        order = np.argsort(-self.counts, kind='stable')
+        if len(order) > self.capacity:
+            self.floor = max(self.floor, self.counts[order[self.capacity]])
+            order = order[:self.capacity]
+        self.keys, self.counts, self.errors = self.keys[order], self.counts[order], self.errors[order]
+        return self
+    
+    def update(self, keys, weights=None):
+        """Count keys, with optional weights; returns the summary for chaining"""
+        return self.merge(SpaceSaving.from_counts(keys, weights, self.capacity))
+    
+    def merge(self, other):
+        """Fold another summary into this one"""
+        merged = SpaceSaving.union([self, other], self.capacity)
+        self.keys, self.counts, self.errors, self.floor = merged.keys, merged.counts, merged.errors, merged.floor
+        return self
+    
+    @classmethod
+    def union(cls, summaries, capacity=DEFAULT_CAPACITY):
+        """A new summary of the union of summaries (or of their serialized bytes)"""
+        summaries = [cls.from_bytes(summary, capacity) if isinstance(summary, (bytes, bytearray, memoryview))
+                     else summary for summary in summaries if summary is not None]
+        if not summaries:
+            return cls(capacity)
+        # Every summary contributes its floor to every key, and the excess
+        # over it to the keys it holds
+        floor = sum(summary.floor for summary in summaries)
+        keys, inverse = np.unique(np.concatenate([summary.keys for summary in summaries]), return_inverse=True)
+        excess = np.concatenate([summary.counts - summary.floor for summary in summaries])
+        error_excess = np.concatenate([summary.errors - summary.floor for summary in summaries])
+        counts = np.bincount(inverse, weights=excess, minlength=len(keys)) + floor
+        errors = np.bincount(inverse, weights=error_excess, minlength=len(keys)) + floor
+        return cls(capacity, keys, counts, errors, floor)._truncate()
+    
+    def count(self, key):
+        """Estimated (upper bound) count of a key"""
+        match = np.flatnonzero(self.keys == key)
+        return float(self.counts[match[0]]) if len(match) else self.floor
+    
+    def top(self, k=None):
+        """(key, count, error) of the k largest counts, largest first"""
+        return list(zip(self.keys[:k].tolist(), self.counts[:k].tolist(), self.errors[:k].tolist()))
+    
+    def to_bytes(self):
+        """Serialize: keys and counts, with the floor and errors once a key was dropped"""
+        if self.floor == 0 and not self.errors.any():
+            return bytes([EXACT_COUNTS_FLAG]) + self.keys.astype('<i8').tobytes() + self.counts.astype('<f8').tobytes()
+        return (bytes([0]) + np.array([self.floor], dtype='<f8').tobytes() + self.keys.astype('<i8').tobytes()
+                + self.counts.astype('<f8').tobytes() + self.errors.astype('<f8').tobytes())
+    
+    @classmethod
+    def from_bytes(cls, data, capacity=DEFAULT_CAPACITY):
+        data = bytes(data)
+        if data[0] & EXACT_COUNTS_FLAG:
+            n = (len(data) - 1) // 16
+            return cls(capacity, np.frombuffer(data, dtype='<i8', count=n, offset=1),
+                       np.frombuffer(data, dtype='<f8', count=n, offset=1 + 8 * n))
+        n = (len(data) - 9) // 24
+        floor = float(np.frombuffer(data, dtype='<f8', count=1, offset=1)[0])
+        return cls(capacity, np.frombuffer(data, dtype='<i8', count=n, offset=9),
+                   np.frombuffer(data, dtype='<f8', count=n, offset=9 + 8 * n),
+                   np.frombuffer(data, dtype='<f8', count=n, offset=9 + 16 * n), floor)
+
+def grouped_summary_bytes(groups, keys, counts, n_groups, capacity=DEFAULT_CAPACITY):
+    """Serialized heavy-hitters summary of the weighted keys of each group (codes 0 to n_groups - 1)"""
+    groups = np.asarray(groups, dtype=np.intp)
+    order = np.argsort(groups, kind='stable')
+    groups, keys, counts = groups[order], np.asarray(keys)[order], np.asarray(counts, dtype=np.float64)[order]
+    bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+    return [SpaceSaving.from_counts(keys[low:high], counts[low:high], capacity).to_bytes()
+            for low, high in zip(bounds[:-1], bounds[1:])]
+
+class HLLAggregate:
+    """SQLite aggregate hll_sketch(value): the serialized sketch of a group's values"""
+    
+    def __init__(self):
+        self.values = []
+    
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+    
+    def finalize(self):
+        return sketch_bytes(self.values)
+
+class HLLUnionAggregate:
+    """SQLite aggregate hll_union(sketch): the serialized union of a group's sketches"""
+    
+    def __init__(self):
+        self.sketches = []
+    
+    def step(self, sketch):
+        if sketch is not None:
+            self.sketches.append(sketch)
+    
+    def finalize(self):
+        return HyperLogLog.union(self.sketches).to_bytes()
+
+def hll_count(sketch):
+    """SQLite function hll_count(sketch): the estimated distinct count of a serialized sketch"""
+    return HyperLogLog.from_bytes(sketch).count() if sketch is not None else 0
+
+class TDigestAggregate:
+    """SQLite aggregate tdigest_sketch(value): the serialized digest of a group's values"""
+    
+    def __init__(self):
+        self.values = []
+    
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+    
+    def finalize(self):
+        # Not stored for merging over days, so kept exact up to compression values
+        return TDigest().update(self.values).to_bytes()
+
+class TDigestUnionAggregate:
+    """SQLite aggregate tdigest_union(digest): the serialized union of a group's digests"""
+    
+    def __init__(self):
+        self.digests = []
+    
+    def step(self, digest):
+        if digest is not None:
+            self.digests.append(digest)
+    
+    def finalize(self):
+        return TDigest.union(self.digests).to_bytes()
+
+def tdigest_quantile(digest, q):
+    """SQLite function tdigest_quantile(digest, q): the estimated quantile q of a serialized digest"""
+    if digest is None:
+        return None
+    value = TDigest.from_bytes(digest).quantile(q)
+    return None if np.isnan(value) else value
+
+class SpaceSavingUnionAggregate:
+    """SQLite aggregate topk_union(summary): the serialized union of a group's heavy-hitters summaries"""
+    
+    def __init__(self):
+        self.summaries = []
+    
+    def step(self, summary):
+        if summary is not None:
+            self.summaries.append(summary)
+    
+    def finalize(self):
+        return SpaceSaving.union(self.summaries).to_bytes()
+
+def topk_entries(summary):
+    """SQLite function topk_entries(summary): a JSON array of [key, count, error], largest first, for json_each()"""
+    return json.dumps(SpaceSaving.from_bytes(summary).top() if summary is not None else [])
+
+def topk_count(summary, key):
+    """SQLite function topk_count(summary, key): the estimated count of a key in a serialized summary"""
+    return SpaceSaving.from_bytes(summary).count(key) if summary is not None else 0.0
+
+def register_sketch_functions(conn):
+    """Make the HyperLogLog (hll_*), t-digest (tdigest_*) and heavy-hitters (topk_*) functions available on a connection"""
+    conn.create_aggregate('hll_sketch', 1, HLLAggregate)
+    conn.create_aggregate('hll_union', 1, HLLUnionAggregate)
+    conn.create_function('hll_count', 1, hll_count, deterministic=True)
+    conn.create_aggregate('tdigest_sketch', 1, TDigestAggregate)
+    conn.create_aggregate('tdigest_union', 1, TDigestUnionAggregate)
+    conn.create_function('tdigest_quantile', 2, tdigest_quantile, deterministic=True)
+    conn.create_aggregate('topk_union', 1, SpaceSavingUnionAggregate)
+    conn.create_function('topk_entries', 1, topk_entries, deterministic=True)
+    conn.create_function('topk_count', 2, topk_count, deterministic=True)
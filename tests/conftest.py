@@ -0,0 +1,13 @@
+import random
+import numpy as np
+import pytest
+from data_generator import generate_sample_data
+
+@pytest.fixture(scope='session')
+def db_path(tmp_path_factory):
+    """A year of generated data: about 16,000 appointments and 10,000 bills"""
+    path = str(tmp_path_factory.mktemp('data') / 'hospital_data.db')
+    random.seed(0)
+    np.random.seed(0)
+    generate_sample_data(path, num_patients=300, days=365, appointments_per_day=(400, 500))
+    return path
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from analytics_engine import AnalyticsEngine
+from benchmark import shard_database
+
+@pytest.fixture(scope='module')
+def branches(db_path):
+    return shard_database(db_path, 3)
+
+def test_total_patients_exact_across_branches(db_path, branches):
+    # Every branch keeps all patients, so each counts once
+    expected = AnalyticsEngine(db_path).get_patient_count()
+    engine = AnalyticsEngine(db_path, branches=branches, workers=1, exact_distinct=True)
+    assert engine.get_patient_count() == expected
+    assert engine.get_total_patients() == expected['total_patients']
+
+def test_estimated_total_patients_has_margin(db_path, branches):
+    expected = AnalyticsEngine(db_path).get_total_patients()
+    count = AnalyticsEngine(db_path, branches=branches, workers=1, exact_distinct=False).get_patient_count()
+    assert count['margin'] > 0
+    assert abs(count['total_patients'] - expected) <= count['margin']
+
+def test_satisfaction_is_weighted_mean_of_branches(db_path, branches):
+    merged = AnalyticsEngine(db_path, compact_results=False, branches=branches, workers=1,
+                             by_branch=True).get_doctor_performance_metrics()
+    combined = AnalyticsEngine(db_path, compact_results=False, branches=branches,
+                               workers=1).get_doctor_performance_metrics().set_index('doctor_name')
+    # The score carries up to 0.4 of noise drawn per query, rounded to 0.01
+    for doctor, rows in merged.groupby('doctor_name', observed=True):
+        expected = np.average(rows['patient_satisfaction'], weights=rows['appointments_handled'])
+        assert combined.loc[doctor, 'patient_satisfaction'] == pytest.approx(expected, abs=0.41)
@@ -0,0 +1,27 @@
+import sqlite3
+import pandas as pd
+import pytest
+from analytics_engine import AnalyticsEngine
+from olap_cube import OLAPCube, load_cube
+from schema import months_ago
+
+@pytest.mark.parametrize('method', ['get_revenue_trend', 'get_service_trends', 'get_doctor_revenue_trends'])
+@pytest.mark.parametrize('filters', [None, {'service_type': ['Consultation']}])
+def test_cube_windows_match_sql(db_path, method, filters):
+    # The trailing windows start mid-month, on the same day a year back
+    expected = getattr(AnalyticsEngine(db_path, compact_results=False), method)(filters)
+    result = getattr(AnalyticsEngine(db_path, compact_results=False, use_cube=True), method)(filters)
+    keys = list(expected.columns)
+    assert len(expected)
+    pd.testing.assert_frame_equal(result[keys].sort_values(keys).reset_index(drop=True),
+                                  expected.sort_values(keys).reset_index(drop=True), check_dtype=False)
+
+def test_empty_first_month_keeps_measure_dtypes(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        empty = OLAPCube.build(conn, where='AND c.day < ?', params=(0,))
+    finally:
+        conn.close()
+    result = load_cube(db_path).since('month', months_ago(12), empty).roll_up('month')
+    assert pd.api.types.is_float_dtype(result['revenue'])
+    assert pd.api.types.is_integer_dtype(result['appointments'])
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import shutil
+import sqlite3
+import pytest
+from event_server import EventServer, _take_events, parse_events
+from ingestion import SimulatedHMSSource
+
+@pytest.fixture
+def server(db_path, tmp_path):
+    path = str(tmp_path / 'events.db')
+    shutil.copy(db_path, path)
+    server = EventServer(path, dead_letter_path=str(tmp_path / 'dead-letter.jsonl'))
+    yield server
+    server.executor.shutdown()
+
+def _events(server, count):
+    source = SimulatedHMSSource(server.db_path, seed=0)
+    source.log['patients'] = []
+    return parse_events(json.dumps(_take_events(source, count), default=str))
+
+async def _commit(server, batch):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(server.executor, server._open)
+    try:
+        return await server._commit_batch(batch)
+    finally:
+        await loop.run_in_executor(server.executor, server.conn.close)
+
+def test_only_bad_events_are_dead_lettered(server, monkeypatch):
+    batch = _events(server, 40)
+    bad = {batch[5][1][0], batch[31][1][0]}
+    commit = server._commit
+    
+    def reject_bad(events, flush_rollup=False):
+        if any(row[0] in bad for _, row in events):
+            raise sqlite3.IntegrityError('constraint failed')
+        return commit(events, flush_rollup)
+    
+    monkeypatch.setattr(server, '_commit', reject_bad)
+    assert asyncio.run(_commit(server, batch)) is not None
+    assert server.stats['committed'] == len(batch) - 2
+    assert server.stats['dead_lettered'] == 2
+    with open(server.dead_letter_path) as file:
+        assert {json.loads(line)['row'][0] for line in file} == bad
+    assert server.writer_state == 'ok'
@@ -0,0 +1,39 @@
+import math
+import pytest
+from benchmark import WORKLOAD
+from index_advisor import advise, collect_workload, copy_database, explain_query, measure_workload
+
+@pytest.fixture(scope='module')
+def workload(db_path):
+    return collect_workload(db_path)
+
+def test_workload_includes_sketch_queries(workload):
+    # The leaderboards merge per-day summaries with topk_union
+    assert any('topk_union' in item['query'] for item in workload)
+
+def test_copy_runs_every_workload_query(db_path, workload):
+    conn = copy_database(db_path)
+    try:
+        for item in workload:
+            assert explain_query(conn, item['query'], item['params'])
+            conn.execute(item['query'], item['params'] or ()).fetchall()
+        assert math.isfinite(measure_workload(conn, workload, repeat=1))
+    finally:
+        conn.close()
+
+def test_advise_default_workload(db_path):
+    report = advise(db_path, repeat=1)
+    assert math.isfinite(report['baseline_seconds'])
+    assert math.isfinite(report['optimized_seconds'])
+    assert report['optimized_seconds'] <= report['baseline_seconds']
+    assert len(report['plans_before']) == len(report['plans_after'])
+    # A candidate that blows the time budget is scored inf; a broken query would have raised
+    assert len(report['candidates']) and (report['candidates']['seconds'] > 0).all()
+
+def test_broken_query_is_not_scored_as_slow(db_path):
+    conn = copy_database(db_path)
+    try:
+        with pytest.raises(Exception, match='no such function'):
+            measure_workload(conn, [{'query': 'SELECT missing_function(1)', 'params': None}], repeat=1)
+    finally:
+        conn.close()
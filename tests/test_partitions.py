@@ -0,0 +1,91 @@
+import random
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from analytics_engine import AnalyticsEngine
+from data_generator import generate_sample_data
+from ingestion import upsert_rows
+from partitions import MAX_ATTACHED, kpi_counter_values, partition_batches, partition_path, partition_year
+from schema import refresh_daily_rollup, to_day_number, today_utc
+
+# Closed years partitioned: more than a connection can attach at once
+YEARS = MAX_ATTACHED + 2
+
+def _generate(path):
+    random.seed(0)
+    np.random.seed(0)
+    generate_sample_data(str(path), num_patients=100, days=365 * (YEARS + 1), appointments_per_day=(5, 10))
+
+@pytest.fixture(scope='module')
+def databases(tmp_path_factory):
+    """The same generated history twice, one copy with every closed year in its own partition"""
+    directory = tmp_path_factory.mktemp('partitions')
+    partitioned, reference = directory / 'hospital_data.db', directory / 'reference.db'
+    _generate(partitioned)
+    _generate(reference)
+    for year in range(today_utc().year - YEARS, today_utc().year):
+        partition_year(str(partitioned), year)
+    return str(partitioned), str(reference)
+
+def _rollup(path):
+    conn = sqlite3.connect(path)
+    try:
+        return pd.read_sql_query('SELECT * FROM daily_rollup ORDER BY day, service_id, status_code', conn)
+    finally:
+        conn.close()
+
+def test_batches_read_every_row_once(databases):
+    partitioned, reference = databases
+    conn, reference_conn = sqlite3.connect(partitioned), sqlite3.connect(reference)
+    try:
+        batches = list(partition_batches(conn))
+        assert len(batches) == 2 and sum(len(years) for years in batches) == YEARS
+        assert kpi_counter_values(conn) == pytest.approx(kpi_counter_values(reference_conn))
+    finally:
+        conn.close()
+        reference_conn.close()
+
+@pytest.mark.parametrize('method', ['get_total_appointments', 'get_revenue_by_department', 'get_patient_segments',
+                                    'get_patient_spending_patterns', 'get_department_doctor_performance'])
+def test_engine_merges_partition_batches(databases, method):
+    partitioned, reference = databases
+    engine = AnalyticsEngine(partitioned, compact_results=False)
+    assert engine.batches_partitions
+    result, expected = getattr(engine, method)(), getattr(AnalyticsEngine(reference, compact_results=False), method)()
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    else:
+        assert result == pytest.approx(expected)
+
+def test_cube_reads_partition_batches(databases):
+    partitioned, reference = databases
+    cube = AnalyticsEngine(partitioned, use_cube=True).get_cube()
+    assert cube.total()['appointments'] == AnalyticsEngine(reference, use_cube=True).get_cube().total()['appointments']
+
+def test_full_rollup_refresh_keeps_partitioned_years(databases):
+    partitioned, reference = databases
+    conn = sqlite3.connect(partitioned)
+    try:
+        with conn:
+            refresh_daily_rollup(conn.cursor())
+    finally:
+        conn.close()
+    pd.testing.assert_frame_equal(_rollup(partitioned), _rollup(reference))
+
+def test_writes_to_partitioned_years_are_rejected(databases):
+    partitioned, _ = databases
+    conn = sqlite3.connect(partitioned)
+    try:
+        sealed_day = to_day_number(today_utc().replace(year=today_utc().year - 1, month=6, day=1))
+        with pytest.raises(ValueError, match='partitioned'):
+            upsert_rows(conn.cursor(), 'appointments', [(10 ** 7, 1, 1, 1, sealed_day, 600, 0, 1, None)])
+        # A bill for an appointment held by a partition
+        partition = sqlite3.connect(partition_path(partitioned, today_utc().year - 1))
+        (appointment_id,) = partition.execute('SELECT appointment_id FROM appointments LIMIT 1').fetchone()
+        partition.close()
+        with pytest.raises(ValueError, match='partitioned'):
+            upsert_rows(conn.cursor(), 'billing', [(10 ** 7, appointment_id, 10.0, None, 1, 1)])
+        conn.rollback()
+    finally:
+        conn.close()
@@ -0,0 +1,274 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from analytics_engine import AnalyticsEngine
+from benchmark import shard_database
+from schema import PAID, from_day_number
+from sketches import DEFAULT_COMPRESSION, UNIT_WEIGHTS_FLAG, TDigest, grouped_digest_bytes, tdigest_quantile
+
+# Quantiles checked, including both tails and the extremes
+QUANTILES = np.array([0.0, 0.001, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999, 1.0])
+
+# Rank error allowed at quantile q: RANK_ERROR * sqrt(q (1 - q)), the 0.8% at
+# the median and 0.15% at p99 that DEFAULT_COMPRESSION is documented to keep,
+# plus RANK_SLACK values for small samples, whose tail centroids still hold
+# more than one value
+RANK_ERROR = 0.016
+RANK_SLACK = 2
+
+def rank_error(values, estimates, quantiles):
+    """Distance of each estimate's rank among the values from its quantile, as a fraction of the values
+    
+    An estimate between two values may stand for either of them, since
+    interpolating between centroids of tied values (whole days, say) lands
+    between the values.
+    """
+    values = np.sort(values)
+    below = np.searchsorted(values, estimates, 'left')
+    at_most = np.searchsorted(values, estimates, 'right')
+    between = below == at_most
+    # Ranks of the neighbouring values, ties included
+    lower = values[np.maximum(below - 1, 0)]
+    upper = values[np.minimum(at_most, len(values) - 1)]
+    low = np.where(between, np.searchsorted(values, lower, 'left'), below) / len(values)
+    high = np.where(between, np.searchsorted(values, upper, 'right'), at_most) / len(values)
+    return np.maximum(0, np.maximum(low - quantiles, quantiles - high))
+
+def assert_within_rank_error(values, estimates, quantiles=QUANTILES):
+    """Each estimate's rank error is within the bound at its quantile"""
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    errors = rank_error(values, np.asarray(estimates, dtype=np.float64), quantiles)
+    bounds = RANK_ERROR * np.sqrt(quantiles * (1 - quantiles)) + RANK_SLACK / len(values)
+    assert (errors <= bounds).all(), f"Rank errors {errors[errors > bounds]} over {bounds[errors > bounds]} " \
+                                     f"at quantiles {quantiles[errors > bounds]}"
+
+def sample_values(kind, size, seed):
+    """Continuous, skewed, tied and bill-like values"""
+    rng = np.random.default_rng(seed)
+    if kind == 'uniform':
+        return rng.uniform(0, 1, size)
+    if kind == 'lognormal':
+        return rng.lognormal(8, 1, size)
+    if kind == 'integers':
+        return rng.integers(0, 60, size).astype(np.float64)
+    return np.round(rng.choice([500, 1500, 2500, 5000, 15000, 75000], size) * rng.uniform(0.9, 1.1, size), 2)
+
+DISTRIBUTIONS = ['uniform', 'lognormal', 'integers', 'amounts']
+
+# Centroids a stored digest keeps at most
+MAX_CENTROIDS = DEFAULT_COMPRESSION // 2 + 1
+
+# Digests
+@pytest.mark.parametrize('kind', DISTRIBUTIONS)
+def test_digest_within_rank_error(kind):
+    values = sample_values(kind, 100000, seed=1)
+    digest = TDigest().update(values)
+    assert digest.count() == len(values)
+    assert len(digest.means) <= DEFAULT_COMPRESSION
+    assert_within_rank_error(values, digest.quantile(QUANTILES))
+
+@pytest.mark.parametrize('kind', DISTRIBUTIONS)
+def test_merged_digests_within_rank_error(kind):
+    values = sample_values(kind, 100000, seed=2)
+    digest = TDigest()
+    for part in np.array_split(values, 4):
+        digest.merge(TDigest().update(part))
+    assert digest.count() == len(values)
+    assert_within_rank_error(values, digest.quantile(QUANTILES))
+
+@pytest.mark.parametrize('kind', DISTRIBUTIONS)
+def test_grouped_digest_union_within_rank_error(kind):
+    # Per-day digests, most of them raw, merged per branch and then across branches
+    values = sample_values(kind, 100000, seed=3)
+    days = np.random.default_rng(3).integers(0, 400, len(values))
+    branches = [TDigest.union(grouped_digest_bytes(days[days % 4 == branch] // 4, values[days % 4 == branch], 100))
+                for branch in range(4)]
+    for branch, digest in enumerate(branches):
+        assert_within_rank_error(values[days % 4 == branch], digest.quantile(QUANTILES))
+    merged = TDigest.union([digest.to_bytes() for digest in branches])
+    assert merged.count() == len(values)
+    assert_within_rank_error(values, merged.quantile(QUANTILES))
+
+def test_grouped_digest_bytes_per_group():
+    values = sample_values('lognormal', 5000, seed=4)
+    groups = np.random.default_rng(4).choice([0, 2, 3, 4], len(values), p=[0.9, 0.08, 0.012, 0.008])
+    digests = grouped_digest_bytes(groups, values, 5)
+    assert len(digests) == 5
+    for group, data in enumerate(digests):
+        digest = TDigest.from_bytes(data)
+        group_values = values[groups == group]
+        assert digest.count() == len(group_values)
+        assert len(digest.means) <= MAX_CENTROIDS
+        if len(group_values) <= 60:
+            # A few dozen values keep a centroid each and are stored raw and exact
+            assert data[0] & UNIT_WEIGHTS_FLAG
+            if len(group_values):
+                np.testing.assert_allclose(digest.quantile(QUANTILES), np.quantile(group_values, QUANTILES))
+        else:
+            assert not data[0] & UNIT_WEIGHTS_FLAG
+            assert (digest.minimum, digest.maximum) == (group_values.min(), group_values.max())
+            assert_within_rank_error(group_values, digest.quantile(QUANTILES))
+
+def pooled_centroids(days, values_per_day, seed):
+    """Centroids a union of one digest per day sorts, for a given number of values per day"""
+    values = sample_values('lognormal', days * values_per_day, seed)
+    digests = grouped_digest_bytes(np.repeat(np.arange(days), values_per_day), values, days)
+    return sum(len(TDigest.from_bytes(data).means) for data in digests), values, digests
+
+def test_merge_cost_grows_with_days_not_values():
+    counts = {}
+    for days, values_per_day in ((100, 20), (100, 200), (100, 2000), (400, 2000)):
+        counts[days, values_per_day], values, digests = pooled_centroids(days, values_per_day, seed=days)
+        merged = TDigest.union(digests)
+        assert merged.count() == len(values)
+        assert_within_rank_error(values, merged.quantile(QUANTILES))
+    # Tiny days are exact; past the centroid budget more values per day cost nothing more
+    assert counts[100, 20] == 100 * 20
+    assert counts[100, 200] <= 100 * MAX_CENTROIDS
+    assert counts[100, 2000] <= 100 * MAX_CENTROIDS
+    assert counts[100, 2000] <= 1.2 * counts[100, 200]
+    # while four times the days cost four times as much
+    assert 3.5 * counts[100, 2000] <= counts[400, 2000] <= 400 * MAX_CENTROIDS
+
+def test_small_digest_is_exact():
+    values = sample_values('amounts', DEFAULT_COMPRESSION, seed=5)
+    digest = TDigest.union(grouped_digest_bytes(np.arange(len(values)) % 7, values, 7))
+    np.testing.assert_allclose(digest.quantile(QUANTILES), np.quantile(values, QUANTILES))
+
+def test_empty_digest():
+    digest = TDigest()
+    assert digest.count() == 0
+    assert np.isnan(digest.quantile(0.5))
+    assert np.isnan(digest.quantile(QUANTILES)).all()
+    assert digest.merge(TDigest()).count() == 0
+    assert TDigest().update([None]).count() == 0
+    assert TDigest.union([]).count() == 0
+    assert TDigest.union([None, TDigest()]).count() == 0
+    # An empty group is an empty raw digest, which merges away
+    empty, filled = grouped_digest_bytes([1, 1], [3.0, 5.0], 2)
+    assert empty == bytes([UNIT_WEIGHTS_FLAG])
+    assert TDigest.from_bytes(empty).count() == 0
+    assert tdigest_quantile(empty, 0.5) is None
+    assert tdigest_quantile(None, 0.5) is None
+    assert TDigest.union([empty, filled]).quantile(0.5) == 4.0
+    assert TDigest.union([empty, TDigest.from_bytes(empty)]).count() == 0
+    assert TDigest().merge(TDigest.from_bytes(filled)).quantile(1.0) == 5.0
+
+def test_raw_serialization_round_trip():
+    values = sample_values('lognormal', 50, seed=6)
+    digest = TDigest().update(values)
+    data = digest.to_bytes()
+    assert data[0] & UNIT_WEIGHTS_FLAG
+    assert len(data) == 1 + 8 * len(values)
+    restored = TDigest.from_bytes(data)
+    np.testing.assert_array_equal(restored.means, np.sort(values))
+    np.testing.assert_array_equal(restored.weights, np.ones(len(values)))
+    assert (restored.minimum, restored.maximum) == (values.min(), values.max())
+    np.testing.assert_array_equal(restored.quantile(QUANTILES), digest.quantile(QUANTILES))
+    assert restored.to_bytes() == data
+
+def test_dense_serialization_round_trip():
+    values = sample_values('lognormal', 20000, seed=7)
+    digest = TDigest().update(values)
+    data = digest.to_bytes()
+    assert not data[0] & UNIT_WEIGHTS_FLAG
+    assert len(data) == 17 + 12 * len(digest.means)
+    restored = TDigest.from_bytes(data)
+    np.testing.assert_array_equal(restored.means, digest.means)
+    np.testing.assert_array_equal(restored.weights, digest.weights)
+    assert (restored.minimum, restored.maximum) == (values.min(), values.max())
+    np.testing.assert_array_equal(restored.quantile(QUANTILES), digest.quantile(QUANTILES))
+    assert restored.to_bytes() == data
+    # Raw and dense serialized digests merge together
+    small = sample_values('lognormal', 100, seed=8)
+    merged = TDigest.union([data, TDigest().update(small).to_bytes()])
+    assert merged.count() == len(values) + len(small)
+    assert_within_rank_error(np.concatenate([values, small]), merged.quantile(QUANTILES))
+
+# Engine percentiles against the bills they summarize (db_path is in conftest.py)
+AMOUNTS_QUERY = """
+    SELECT s.name as service_name, b.amount as value
+    FROM appointments a
+    JOIN services s ON a.service_id = s.service_id
+    JOIN billing b ON a.appointment_id = b.appointment_id
+    WHERE b.amount IS NOT NULL AND a.appointment_day BETWEEN ? AND ?{where}
+"""
+
+PAYMENT_LAGS_QUERY = f"""
+    SELECT b.payment_method, b.payment_day - a.appointment_day as value
+    FROM appointments a
+    JOIN billing b ON a.appointment_id = b.appointment_id
+    WHERE b.payment_status_code = {PAID} AND b.payment_day IS NOT NULL
+    AND a.appointment_day BETWEEN ? AND ?{{where}}
+"""
+
+def exact_values(db_path, query, where='', params=(), first_day=0, last_day=10 ** 6):
+    conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query(query.format(where=where), conn, params=(first_day, last_day) + params)
+    finally:
+        conn.close()
+
+def assert_percentiles(result, exact, key, count_column):
+    """Every group of the exact values is reported with its count and percentiles within rank error"""
+    groups = exact.groupby(key)['value']
+    assert sorted(result[key].astype(str)) == sorted(groups.groups)
+    assert result[count_column].is_monotonic_decreasing
+    quantiles = [0.5, 0.9, 0.99]
+    for row in result.itertuples(index=False):
+        values = groups.get_group(getattr(row, key)).to_numpy(dtype=np.float64)
+        assert getattr(row, count_column) == len(values)
+        estimates = np.array([row.p50, row.p90, row.p99])
+        if len(values) <= DEFAULT_COMPRESSION:
+            np.testing.assert_allclose(estimates, np.quantile(values, quantiles))
+        else:
+            assert_within_rank_error(values, estimates, quantiles)
+
+def test_bill_amount_percentiles(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    result = engine.get_bill_amount_percentiles()
+    counts = result['bills']
+    # Both raw and compressed digests are covered
+    assert counts.min() <= DEFAULT_COMPRESSION < counts.max()
+    assert_percentiles(result, exact_values(db_path, AMOUNTS_QUERY), 'service_name', 'bills')
+
+def test_bill_amount_percentiles_in_date_range(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    conn = sqlite3.connect(db_path)
+    first, last = conn.execute('SELECT MIN(appointment_day) + 30, MAX(appointment_day) - 60 FROM appointments').fetchone()
+    conn.close()
+    result = engine.get_bill_amount_percentiles(from_day_number(first), from_day_number(last))
+    assert_percentiles(result, exact_values(db_path, AMOUNTS_QUERY, first_day=first, last_day=last),
+                       'service_name', 'bills')
+
+def test_bill_amount_percentiles_filtered(db_path):
+    # A payment method filter digests the matching bills instead of the daily digests
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    result = engine.get_bill_amount_percentiles(filters={'payment_method': ['Cash']})
+    exact = exact_values(db_path, AMOUNTS_QUERY, " AND b.payment_method = 'Cash'")
+    assert_percentiles(result, exact, 'service_name', 'bills')
+
+def test_payment_lag_percentiles(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    result = engine.get_payment_lag_percentiles()
+    assert_percentiles(result, exact_values(db_path, PAYMENT_LAGS_QUERY), 'payment_method', 'payments')
+
+def test_payment_lag_percentiles_filtered(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    result = engine.get_payment_lag_percentiles(filters={'service_type': ['Consultation']})
+    exact = exact_values(db_path, PAYMENT_LAGS_QUERY, """ AND a.service_id IN (
+        SELECT service_id FROM services WHERE type = 'Consultation')""")
+    assert_percentiles(result, exact, 'payment_method', 'payments')
+
+def test_percentiles_across_branches(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False, branches=shard_database(db_path, 3), workers=1)
+    assert_percentiles(engine.get_bill_amount_percentiles(), exact_values(db_path, AMOUNTS_QUERY),
+                       'service_name', 'bills')
+    assert_percentiles(engine.get_payment_lag_percentiles(), exact_values(db_path, PAYMENT_LAGS_QUERY),
+                       'payment_method', 'payments')
+
+def test_empty_date_range(db_path):
+    engine = AnalyticsEngine(db_path, compact_results=False)
+    assert engine.get_bill_amount_percentiles('1990-01-01', '1990-12-31').empty
+    assert engine.get_payment_lag_percentiles('1990-01-01', '1990-12-31').empty
@@ -0,0 +1,31 @@
+import json
+import pandas as pd
+import plotly.express as px
+from visualization_utils import compact_figure
+
+def _figure(chart):
+    return json.loads(chart.to_json())
+
+def _labels(figure, trace, letter):
+    axis = figure['layout'][letter + 'axis']
+    return [axis['ticktext'][axis['tickvals'].index(code)] for code in trace[letter]]
+
+def test_repeated_categories_are_sent_as_codes():
+    methods = ['Bank Transfer', 'Insurance', 'Credit Card']
+    branches = ['Colombo', 'Kandy', 'Galle', 'Jaffna', 'Matara', 'Kurunegala']
+    data = pd.DataFrame([(method, branch, index) for index, method in enumerate(methods) for branch in branches],
+                        columns=['payment_method', 'branch', 'revenue'])
+    chart = px.bar(data, x='payment_method', y='revenue', color='branch', barmode='group')
+    raw, compact = _figure(chart), compact_figure(_figure(chart))
+    assert compact['layout']['xaxis']['ticktext'] == methods
+    for before, after in zip(raw['data'], compact['data']):
+        assert _labels(compact, after, 'x') == before['x']
+    assert len(json.dumps(compact)) < len(json.dumps(raw))
+
+def test_unrepeated_and_date_labels_stay_labels():
+    unique = compact_figure(_figure(px.bar(x=['Surgery', 'Radiology', 'Cardiology'], y=[3, 2, 1])))
+    assert unique['data'][0]['x'] == ['Surgery', 'Radiology', 'Cardiology']
+    months = pd.DataFrame({'month': ['2026-06', '2026-07'] * 3, 'service': ['ECG'] * 2 + ['MRI'] * 2 + ['X-Ray'] * 2,
+                           'appointments': range(6)})
+    lines = compact_figure(_figure(px.line(months, x='month', y='appointments', color='service')))
+    assert 'ticktext' not in lines['layout']['xaxis']
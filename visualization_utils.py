@@ -1,13 +1,362 @@
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+import base64
+import hashlib
+import json
+import re
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 
+# Default plot area width used to size downsampled series
+DEFAULT_CHART_WIDTH_PX = 800
+
+# Scatter plots switch to WebGL above the first threshold and to a server-side
+# binned density view above the second
+SCATTER_WEBGL_THRESHOLD = 10000
+SCATTER_DENSITY_THRESHOLD = 200000
+DENSITY_BINS = 60
+
+# Decimal places numeric trace data is rounded to when that only removes float
+# noise (sums of currency amounts); other values keep full precision
+PAYLOAD_DECIMALS = 2
+
+# Compacted payloads are only sent when they are at least this much smaller
+MIN_COMPACTION_SAVING = 0.05
+
 def create_visualizations():
     """Placeholder for visualization utilities"""
     pass
 
+# Figure cache
+def data_fingerprint(data):
+    """Fast content hash of a DataFrame or Series, including column names and dtypes"""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(data, pd.DataFrame):
+        digest.update(repr(list(zip(data.columns, data.dtypes.astype(str)))).encode())
+    else:
+        digest.update(repr((data.name, str(data.dtype))).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def _option_fingerprint(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return data_fingerprint(value)
+    return repr(value)
+
+# Payload compaction
+# Plotly typed-array integer dtypes, narrowest first
+TYPED_INTEGER_DTYPES = ['i1', 'u1', 'i2', 'u2', 'i4', 'u4']
+# Trace attributes Plotly declares as data arrays, by path within the trace;
+# only these are decoded from typed arrays (layout-like ones such as
+# domain.x are not)
+DATA_ARRAY_PATHS = [
+    ('x',), ('y',), ('z',), ('values',), ('customdata',), ('base',), ('width',),
+    ('text',), ('hovertext',), ('textposition',),
+    ('marker', 'size'), ('marker', 'color'), ('marker', 'opacity'), ('marker', 'symbol'),
+    ('error_x', 'array'), ('error_x', 'arrayminus'), ('error_y', 'array'), ('error_y', 'arrayminus')
+]
+# Positional attributes: hover labels go through axis formatting, so float32 is safe
+COORDINATE_PATHS = {('x',), ('y',), ('z',)}
+# Per-point attributes that Plotly also accepts as a single value
+SCALAR_OK_PATHS = {('text',), ('hovertext',), ('textposition',), ('marker', 'size'), ('marker', 'color'),
+                   ('marker', 'opacity'), ('marker', 'symbol')}
+# Trace types that accept x0/dx in place of an x array
+X0_DX_TRACE_TYPES = {'scatter', 'scattergl', 'bar'}
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+# Trace types whose category labels can be sent as integer codes
+CATEGORY_CODE_TRACE_TYPES = {'scatter', 'scattergl', 'bar'}
+# Past this many categories Plotly thins out a category axis's tick labels,
+# which an axis with a tick label at every code would not
+MAX_CODED_CATEGORIES = 20
+# Labels Plotly would read as dates rather than categories
+DATE_LABEL_PATTERN = re.compile(r'^\s*-?\d{4}(-|$)')
+# Axis settings that order or label the categories themselves
+CATEGORY_AXIS_KEYS = ('type', 'categoryorder', 'categoryarray', 'tickmode', 'tickvals', 'ticktext')
+
+def _is_typed_array(value):
+    return isinstance(value, dict) and 'bdata' in value and 'dtype' in value
+
+def decode_typed_array(spec):
+    """Decode a Plotly typed-array spec ({'dtype', 'bdata', 'shape'}) to a numpy array"""
+    array = np.frombuffer(base64.b64decode(spec['bdata']), dtype=np.dtype(spec['dtype']).newbyteorder('<'))
+    if 'shape' in spec:
+        array = array.reshape([int(n) for n in str(spec['shape']).split(',')])
+    return array
+
+def encode_typed_array(array):
+    """Encode a numpy array as a Plotly typed-array spec"""
+    little_endian = array.astype(array.dtype.newbyteorder('<'), copy=False)
+    spec = {'dtype': array.dtype.str[1:], 'bdata': base64.b64encode(little_endian.tobytes()).decode('ascii')}
+    if array.ndim > 1:
+        spec['shape'] = ', '.join(str(n) for n in array.shape)
+    return spec
+
+def compact_array(values, decimals=PAYLOAD_DECIMALS, coordinate=False):
+    """Encode a numeric array in the narrowest typed array that keeps its values
+    
+    Floats are rounded to decimals places only when that changes nothing but
+    float noise, so small fractions are never rounded away. Integer arrays
+    short enough to be smaller as plain JSON stay lists. Non-numeric arrays
+    (strings, dates, lists with gaps) are returned unchanged.
+    """
+    array = decode_typed_array(values) if _is_typed_array(values) else np.asarray(values)
+    if array.dtype.kind not in 'iuf' or array.size == 0:
+        return values
+    finite = np.isfinite(array)
+    rounded = False
+    if array.dtype.kind == 'f':
+        candidate = np.round(array, decimals)
+        if np.allclose(candidate, array, rtol=1e-9, atol=0, equal_nan=True):
+            array, rounded = candidate, True
+    if finite.all() and (array == np.round(array)).all():
+        low, high = array.min(), array.max()
+        for dtype in TYPED_INTEGER_DTYPES:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                spec = encode_typed_array(array.astype(dtype))
+                # Short integer arrays are smaller as plain JSON than in base64
+                plain = array.astype('int64').tolist()
+                return plain if len(json.dumps(plain)) < len(json.dumps(spec)) else spec
+    magnitude = np.abs(array[finite]).max() if finite.any() else 0
+    # float32 holds the rounded values exactly enough only below 2**24 display steps;
+    # other attributes keep their float width since hover shows them unformatted
+    if array.dtype == np.float32 or (coordinate and rounded and magnitude * 10 ** decimals < 2 ** 24):
+        return encode_typed_array(array.astype('f4'))
+    return encode_typed_array(array.astype('f8'))
+
+def _uniform_date_step(values):
+    """Step in milliseconds if values are evenly spaced YYYY-MM-DD strings, else None"""
+    if len(values) < 3 or not all(isinstance(v, str) and DATE_PATTERN.match(v) for v in values):
+        return None
+    steps = np.diff(pd.to_datetime(pd.Series(values), format='%Y-%m-%d').to_numpy().astype('datetime64[ms]').astype('int64'))
+    if steps[0] > 0 and (steps == steps[0]).all():
+        return int(steps[0])
+    return None
+
+def _compact_data_arrays(trace, decimals):
+    for path in DATA_ARRAY_PATHS:
+        container = trace
+        for key in path[:-1]:
+            container = container.get(key)
+            if not isinstance(container, dict):
+                break
+        else:
+            key = path[-1]
+            value = container.get(key)
+            if not (_is_typed_array(value) or (isinstance(value, list) and value
+                                               and not isinstance(value[0], (dict, list)))):
+                continue
+            if path in SCALAR_OK_PATHS and isinstance(value, list) and all(v == value[0] for v in value):
+                container[key] = value[0]
+            else:
+                container[key] = compact_array(value, decimals, coordinate=path in COORDINATE_PATHS)
+
+def _is_category_label(value):
+    if not isinstance(value, str) or DATE_LABEL_PATTERN.match(value):
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return True
+    return False
+
+def _axis_traces(figure):
+    """Cartesian traces grouped by (coordinate, layout axis name)"""
+    axes = {}
+    for trace in figure.get('data', []):
+        if trace.get('type', 'scatter') not in CATEGORY_CODE_TRACE_TYPES and 'x' not in trace and 'y' not in trace:
+            continue
+        for letter in 'xy':
+            name = letter + 'axis' + trace.get(letter + 'axis', letter)[1:]
+            axes.setdefault((letter, name), []).append(trace)
+    return axes
+
+def _code_categories(figure, decimals):
+    """Send repeated category labels once, as tick text, and integer codes in the traces
+    
+    A category axis places its labels in order of first appearance, so codes
+    in that order on a linear axis with the labels as tick text draw and
+    hover the same. Axes that order or label their categories themselves are
+    left alone, as are axes where the codes would not be smaller.
+    """
+    layout = figure.setdefault('layout', {})
+    for (letter, name), traces in _axis_traces(figure).items():
+        axis = layout.get(name) or {}
+        values = [trace.get(letter) for trace in traces]
+        if any(key in axis for key in CATEGORY_AXIS_KEYS) or not all(
+                trace.get('type', 'scatter') in CATEGORY_CODE_TRACE_TYPES and isinstance(labels, list) and labels
+                and all(_is_category_label(label) for label in labels) for trace, labels in zip(traces, values)):
+            continue
+        categories = list(dict.fromkeys(label for labels in values for label in labels))
+        if len(categories) > MAX_CODED_CATEGORIES:
+            continue
+        index = {label: code for code, label in enumerate(categories)}
+        codes = [[index[label] for label in labels] for labels in values]
+        ticks = {'type': 'linear', 'tickmode': 'array', 'tickvals': list(range(len(categories))), 'ticktext': categories}
+        coded_size = len(json.dumps(ticks)) + sum(len(json.dumps(compact_array(c, decimals))) for c in codes)
+        if coded_size >= sum(len(json.dumps(labels)) for labels in values):
+            continue
+        for trace, trace_codes in zip(traces, codes):
+            trace[letter] = trace_codes
+        layout[name] = {**axis, **ticks}
+
+def compact_figure(figure, decimals=PAYLOAD_DECIMALS):
+    """Shrink a figure dict's trace data before it is sent to the browser
+    
+    Stores the numeric data arrays as narrow typed arrays, collapses constant
+    per-point attributes to a single value, replaces evenly spaced date
+    labels with x0/dx and sends repeated category labels once as tick text.
+    Hover names stay as they are: a hovertemplate cannot look a customdata
+    index back up, so coding them would show the index.
+    """
+    _code_categories(figure, decimals)
+    for trace in figure.get('data', []):
+        x = trace.get('x')
+        if trace.get('type', 'scatter') in X0_DX_TRACE_TYPES and isinstance(x, list) and 'x0' not in trace:
+            step = _uniform_date_step(x)
+            if step is not None:
+                del trace['x']
+                trace['x0'] = x[0]
+                trace['dx'] = step
+        _compact_data_arrays(trace, decimals)
+    return figure
+
+class FigureCache:
+    """LRU cache of serialized Plotly figures keyed on the input data and chart options
+    
+    Builders must be named functions (px.line, create_* helpers) so that the
+    builder itself is part of the key. Cached figures are compacted with
+    compact_figure unless compact is False, or unless compacting saves less
+    than MIN_COMPACTION_SAVING of the payload.
+    """
+    
+    def __init__(self, max_entries=128, compact=True, decimals=PAYLOAD_DECIMALS):
+        self.max_entries = max_entries
+        self.compact = compact
+        self.decimals = decimals
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def figure(self, builder, data, *args, **kwargs):
+        """Return the figure dict for builder(data, *args, **kwargs), building it only on a miss"""
+        key = (
+            builder.__module__,
+            builder.__qualname__,
+            data_fingerprint(data),
+            tuple(_option_fingerprint(arg) for arg in args),
+            tuple((name, _option_fingerprint(value)) for name, value in sorted(kwargs.items()))
+        )
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            payload = builder(data, *args, **kwargs).to_json()
+            raw_bytes = len(payload)
+            if self.compact:
+                compacted = json.dumps(compact_figure(json.loads(payload), self.decimals), separators=(',', ':'))
+                if len(compacted) <= raw_bytes * (1 - MIN_COMPACTION_SAVING):
+                    payload = compacted
+            entry = self._entries[key] = (payload, raw_bytes)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return json.loads(entry[0])
+    
+    def stats(self):
+        """Hit/miss counts and the size of the cached payloads before and after compaction"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': sum(len(payload) for payload, _ in self._entries.values()),
+            'raw_bytes': sum(raw_bytes for _, raw_bytes in self._entries.values())
+        }
+    
+    def clear(self):
+        """Drop every cached figure and reset the statistics"""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Shared across Streamlit reruns because modules are only imported once
+FIGURE_CACHE = FigureCache()
+
+# Downsampling helpers
+def _numeric_x(values):
+    """Numeric positions for an x column of numbers, dates or date strings"""
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype='float64')
+    return pd.to_datetime(values).astype('int64').to_numpy(dtype='float64')
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: indices of the n_out points that best keep the shape"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+def minmax_indices(y, n_buckets):
+    """Indices of the minimum and maximum point in each of n_buckets equal-size buckets"""
+    n = len(y)
+    if n_buckets * 2 >= n:
+        return np.arange(n)
+    buckets = np.arange(n) * n_buckets // n
+    series = pd.Series(y)
+    grouped = series.groupby(buckets)
+    indices = np.concatenate([grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy(), [0, n - 1]])
+    return np.unique(indices)
+
+def downsample_series(data, x_col, y_col, width_px=DEFAULT_CHART_WIDTH_PX, method='lttb', group_col=None):
+    """Reduce a time series to about one point per pixel (two per pixel bucket for min/max)"""
+    if group_col is not None:
+        parts = [downsample_series(group, x_col, y_col, width_px, method)
+                 for _, group in data.groupby(group_col, sort=False, observed=True)]
+        return pd.concat(parts) if parts else data
+    data = data.sort_values(x_col, kind='stable')
+    if len(data) <= width_px:
+        return data
+    y = data[y_col].to_numpy(dtype='float64')
+    if method == 'minmax':
+        indices = minmax_indices(y, width_px // 2)
+    else:
+        indices = lttb_indices(_numeric_x(data[x_col]), y, width_px)
+    return data.iloc[indices]
+
+def collapse_top_n(data, x_col, y_col, color_col, top_n=10, other_label='Other'):
+    """Keep the top_n series by total value and sum the rest into a single 'Other' series"""
+    totals = data.groupby(color_col, observed=True)[y_col].sum()
+    if len(totals) <= top_n:
+        return data
+    top = totals.nlargest(top_n).index
+    keep = data[color_col].isin(top)
+    kept = data.loc[keep, [x_col, color_col, y_col]].copy()
+    kept[color_col] = kept[color_col].astype(object)
+    other = data.loc[~keep].groupby(x_col, observed=True, as_index=False)[y_col].sum()
+    other[color_col] = other_label
+    return pd.concat([kept, other[[x_col, color_col, y_col]]], ignore_index=True)
+
 def create_revenue_trend_chart(data):
     """Create revenue trend chart"""
     fig = px.line(data, x='month', y='revenue', 
@@ -39,9 +388,10 @@ def create_doctor_performance_scatter(data):
     )
     return fig
 
-def create_appointment_trends_chart(data):
+def create_appointment_trends_chart(data, width_px=DEFAULT_CHART_WIDTH_PX, color=None):
     """Create appointment trends chart"""
-    fig = px.line(data, x='date', y='appointments', 
+    data = downsample_series(data, 'date', 'appointments', width_px, group_col=color)
+    fig = px.line(data, x='date', y='appointments', color=color,
                   title='Daily Appointment Trends')
     fig.update_layout(
         xaxis_title="Date",
@@ -95,17 +445,57 @@ def create_visit_frequency_histogram(data):
     )
     return fig
 
-def create_spending_patterns_scatter(data):
-    """Create spending patterns scatter plot"""
-    fig = px.scatter(data, x='total_visits', y='total_spent',
-                     size='avg_spend_per_visit', title='Patient Spending vs Visits')
-    fig.update_layout(
-        xaxis_title="Total Visits",
-        yaxis_title="Total Spent (Rs.)",
-        hovermode='closest'
-    )
+def _bin_edges(values, bins):
+    """Histogram edges, aligned to whole numbers for small integer ranges"""
+    if np.issubdtype(values.dtype, np.integer) and len(values) and values.max() - values.min() < bins:
+        return np.arange(values.min(), values.max() + 2) - 0.5
+    return bins
+
+def bin_2d(x, y, bins=DENSITY_BINS):
+    """Vectorized 2D histogram of two numeric arrays; returns counts and bin centers"""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=[_bin_edges(x, bins), _bin_edges(y, bins)])
+    return counts, (x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2
+
+def create_density_heatmap(x_centers, y_centers, counts, title, x_title, y_title):
+    """Create a density heatmap from pre-binned counts (x bins by y bins)"""
+    z = np.where(counts > 0, counts, np.nan).T
+    fig = go.Figure(go.Heatmap(x=x_centers, y=y_centers, z=z, colorscale='Viridis',
+                               colorbar=dict(title='Patients'),
+                               hovertemplate=f'{x_title}: %{{x}}<br>{y_title}: %{{y}}<br>Patients: %{{z}}<extra></extra>'))
+    fig.update_layout(title=title, xaxis_title=x_title, yaxis_title=y_title)
+    return fig
+
+def create_binned_density_chart(data, x_col, y_col, count_col, title, x_title, y_title):
+    """Create a density heatmap from a long-format frame of already-binned counts"""
+    grid = data.pivot_table(index=x_col, columns=y_col, values=count_col, aggfunc='sum', fill_value=0)
+    return create_density_heatmap(grid.index.to_numpy(), grid.columns.to_numpy(), grid.to_numpy(),
+                                  title, x_title, y_title)
+
+def create_adaptive_scatter(data, x, y, title, size=None, hover_data=None, x_title=None, y_title=None,
+                            webgl_threshold=SCATTER_WEBGL_THRESHOLD,
+                            density_threshold=SCATTER_DENSITY_THRESHOLD, color=None):
+    """Scatter plot that switches to WebGL, then to a binned density view, as points grow"""
+    x_title = x_title or x
+    y_title = y_title or y
+    if len(data) > density_threshold:
+        counts, x_centers, y_centers = bin_2d(data[x].to_numpy(), data[y].to_numpy())
+        return create_density_heatmap(x_centers, y_centers, counts, title, x_title, y_title)
+    render_mode = 'webgl' if len(data) > webgl_threshold else 'svg'
+    fig = px.scatter(data, x=x, y=y, size=size, hover_data=hover_data, title=title, color=color,
+                     render_mode=render_mode)
+    fig.update_layout(xaxis_title=x_title, yaxis_title=y_title, hovermode='closest')
     return fig
 
+def create_spending_patterns_scatter(data, webgl_threshold=SCATTER_WEBGL_THRESHOLD,
+                                     density_threshold=SCATTER_DENSITY_THRESHOLD, color=None):
+    """Create spending patterns scatter plot"""
+    return create_adaptive_scatter(data, 'total_visits', 'total_spent', 'Patient Spending vs Visits',
+                                   size='avg_spend_per_visit', x_title="Total Visits",
+                                   y_title="Total Spent (Rs.)", webgl_threshold=webgl_threshold,
+                                   density_threshold=density_threshold, color=color)
+
 def create_service_preferences_chart(data):
     """Create service preferences chart"""
     fig = px.bar(data, x='service_name', y='preference_score',
@@ -123,9 +513,58 @@ def create_treemap_chart(data):
                       values='count', title='Service Distribution by Department')
     return fig
 
-def create_multi_line_chart(data, x_col, y_col, color_col, title):
-    """Create multi-line chart for time series data"""
+def _multi_line_series(data, x_col, y_col, color_col, top_n=None, width_px=DEFAULT_CHART_WIDTH_PX):
+    """Series of a multi-line chart: the top_n colors plus 'Other', downsampled to the plot width"""
+    if top_n is not None:
+        data = collapse_top_n(data, x_col, y_col, color_col, top_n)
+    return downsample_series(data, x_col, y_col, width_px, group_col=color_col)
+
+def create_multi_line_chart(data, x_col, y_col, color_col, title, top_n=None,
+                            width_px=DEFAULT_CHART_WIDTH_PX, facet_col=None):
+    """Create multi-line chart for time series data, optionally in one panel per facet_col value"""
+    if facet_col is not None:
+        panels = [_multi_line_series(panel, x_col, y_col, color_col, top_n, width_px).assign(**{facet_col: name})
+                  for name, panel in data.groupby(facet_col, sort=False, observed=True)]
+        data = pd.concat(panels, ignore_index=True) if panels else data
+    else:
+        data = _multi_line_series(data, x_col, y_col, color_col, top_n, width_px)
+    fig = px.line(data, x=x_col, y=y_col, color=color_col, facet_col=facet_col, title=title)
+    fig.update_layout(
+        xaxis_title=x_col.title(),
+        yaxis_title=y_col.title(),
+        hovermode='x unified'
+    )
+    return fig
+
+def create_error_band_chart(data, x_col, y_col, title, color_col=None):
+    """Line chart of an estimated column with its 95% margin ('<y_col>_margin') shaded around each line"""
     fig = px.line(data, x=x_col, y=y_col, color=color_col, title=title)
+    margin_col = f'{y_col}_margin'
+    if margin_col not in data.columns:
+        return fig
+    lines = {trace.name: trace.line.color for trace in fig.data}
+    groups = data.groupby(color_col, sort=False, observed=True) if color_col else [(None, data)]
+    for name, group in groups:
+        x = group[x_col].tolist()
+        upper = (group[y_col] + group[margin_col]).tolist()
+        lower = (group[y_col] - group[margin_col]).tolist()
+        fig.add_trace(go.Scatter(x=x + x[::-1], y=upper + lower[::-1], fill='toself', mode='lines',
+                                 line={'width': 0}, fillcolor=lines.get('' if name is None else str(name)),
+                                 opacity=0.2, hoverinfo='skip', showlegend=False))
+    return fig
+
+def create_moving_average_chart(data, x_col, y_col, windows, title, color_col=None):
+    """Line chart of a daily column with its trailing moving averages ('<y_col>_<window>d_avg')
+    
+    The series are told apart by color, or by dash when color_col already
+    colors the lines.
+    """
+    columns = {y_col: 'Daily', **{f'{y_col}_{window}d_avg': f'{window}-day average' for window in windows}}
+    long = data.melt(id_vars=[x_col] + ([color_col] if color_col else []), value_vars=list(columns),
+                     var_name='series', value_name='value')
+    long['series'] = long['series'].map(columns)
+    fig = px.line(long, x=x_col, y='value', title=title,
+                  **({'color': color_col, 'line_dash': 'series'} if color_col else {'color': 'series'}))
     fig.update_layout(
         xaxis_title=x_col.title(),
         yaxis_title=y_col.title(),